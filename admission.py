@@ -0,0 +1,134 @@
+"""
+Admission control for new generations (before the photo is downloaded or uploaded).
+
+The bot used to insert every request and answer "Posisi: 1" however long the
+queue was, so during a provider outage the queue grew without limit. Now
+handle_media_upload asks AdmissionController.check first:
+
+    ADMIT   queue is fine: create the task, show the real position and ETA
+    DEFER   queue is long (depth >= ADMISSION_DEFER_DEPTH or ETA >= ADMISSION_DEFER_ETA_SECONDS):
+            the user may still queue, cancel, or let the bot queue it when it is quiet
+    REJECT  queue is too long (the *_REJECT_* thresholds): cancel, or queue when quiet
+
+Depth is the number of pending shared-lane Telegram rows (BYOK tasks run on
+the user's own key and are always admitted). ETA = depth / throughput, where
+throughput is the in-process queue worker's claim capacity: tasks claimed per
+second of the last THROUGHPUT_WINDOW_SECONDS in which the queue was not empty
+(idle time would make a quiet hour look like a slow worker). Without a worker
+in this process (RUN_WORKER=0), or with fewer than THROUGHPUT_MIN_CLAIMS claims
+or THROUGHPUT_MIN_BUSY_SECONDS of backlog, only the depth thresholds apply.
+"""
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+ADMISSION_DEFER_DEPTH = int(os.getenv("ADMISSION_DEFER_DEPTH", "30"))
+ADMISSION_REJECT_DEPTH = int(os.getenv("ADMISSION_REJECT_DEPTH", "150"))
+ADMISSION_DEFER_ETA_SECONDS = int(os.getenv("ADMISSION_DEFER_ETA_SECONDS", str(15 * 60)))
+ADMISSION_REJECT_ETA_SECONDS = int(os.getenv("ADMISSION_REJECT_ETA_SECONDS", str(60 * 60)))
+DEPTH_CACHE_SECONDS = 5          # One count query per this many seconds, however many uploads arrive
+THROUGHPUT_WINDOW_SECONDS = 600
+THROUGHPUT_MIN_CLAIMS = 5        # Fewer claims in the window: ETA unknown (one claim after a restart is no rate)
+THROUGHPUT_MIN_BUSY_SECONDS = 30  # Less backlogged time than this: ETA unknown
+
+# "Antre saat sepi": re-check every OFF_PEAK_CHECK_SECONDS, give up after OFF_PEAK_MAX_WAIT_SECONDS
+OFF_PEAK_CHECK_SECONDS = 60
+OFF_PEAK_MAX_WAIT_SECONDS = 6 * 3600
+
+ADMIT = "admit"
+DEFER = "defer"
+REJECT = "reject"
+
+
+class Admission:
+    __slots__ = ("action", "depth", "eta_seconds")
+
+    def __init__(self, action, depth, eta_seconds=None):
+        self.action = action
+        self.depth = depth
+        self.eta_seconds = eta_seconds
+
+    @property
+    def position(self):
+        return self.depth + 1
+
+    def eta_text(self):
+        return format_eta(self.eta_seconds)
+
+
+def format_eta(seconds):
+    """'~12 menit' or '' when unknown."""
+    if seconds is None:
+        return ""
+    return f"~{max(1, round(seconds / 60))} menit"
+
+
+class AdmissionController:
+    def __init__(self, client, index=None):
+        self.client = client
+        self.index = index  # queue_index.QueueIndex: its length is the depth while it is kept fresh
+        self._lock = threading.Lock()
+        self._depth = 0
+        self._depth_at = 0.0
+        self.admitted = 0
+        self.deferred = 0
+        self.rejected = 0
+
+    def queue_depth(self):
+        """Pending shared-lane Telegram tasks (from the queue index, else a count cached for DEPTH_CACHE_SECONDS)."""
+        if self.index is not None and self.index.is_fresh():
+            self._depth = len(self.index)
+            return self._depth
+        with self._lock:
+            if time.monotonic() - self._depth_at < DEPTH_CACHE_SECONDS:
+                return self._depth
+        res = self.client.table("generations").select("id", count="exact") \
+            .eq("status", "pending").eq("source", "telegram").eq("lane", "shared") \
+            .limit(1).execute()
+        depth = res.count or 0
+        with self._lock:
+            self._depth, self._depth_at = depth, time.monotonic()
+        return depth
+
+    def note_enqueued(self):
+        """A task was just inserted: count it until the next depth query."""
+        with self._lock:
+            self._depth += 1
+
+    def check(self, worker=None, lane="shared"):
+        """Admission for one new task. worker: the in-process QueueWorker, if any (for throughput)."""
+        if lane == "byok":
+            return Admission(ADMIT, 0)
+        try:
+            depth = self.queue_depth()
+        except Exception as e:
+            # Never block users on a failed count
+            logger.error(f"[ADMISSION] Failed to read queue depth: {e}")
+            return Admission(ADMIT, 0)
+
+        throughput = worker.throughput(THROUGHPUT_WINDOW_SECONDS, THROUGHPUT_MIN_CLAIMS, THROUGHPUT_MIN_BUSY_SECONDS) if worker else 0.0
+        eta = depth / throughput if throughput > 0 else None
+
+        if depth >= ADMISSION_REJECT_DEPTH or (eta is not None and eta >= ADMISSION_REJECT_ETA_SECONDS):
+            action = REJECT
+        elif depth >= ADMISSION_DEFER_DEPTH or (eta is not None and eta >= ADMISSION_DEFER_ETA_SECONDS):
+            action = DEFER
+        else:
+            action = ADMIT
+        if action == REJECT:
+            self.rejected += 1
+        elif action == DEFER:
+            self.deferred += 1
+        else:
+            self.admitted += 1
+        if action != ADMIT:
+            eta_log = f"{int(eta)}s" if eta is not None else "unknown"
+            logger.warning(f"[ADMISSION] {action}: depth {depth}, throughput {throughput * 60:.1f}/min, ETA {eta_log}")
+        return Admission(action, depth, eta)
+
+    def describe(self):
+        return f"depth {self._depth}, admitted {self.admitted}, deferred {self.deferred}, rejected {self.rejected}"
@@ -0,0 +1,440 @@
+"""
+Conversation persistence shared by bot replicas.
+
+BotPersistence is a python-telegram-bot persistence backend that keeps the
+ConversationHandler states and context.user_data in the bot_persistence table
+(through Supabase, a direct Postgres connection or a local SQLite file), so a
+restarted or different replica can continue a conversation. Bot/chat/callback
+data are not used by this bot and not stored.
+
+Writes never happen on the handler path: PTB hands changed entries over every
+update_interval from its own background task, BotPersistence only buffers them
+(newest value per key wins) and a flush task writes the whole buffer in one
+batch shortly after. A failed batch stays buffered and is retried.
+
+Replicas only load persistence at startup. When the webhook router moves a
+chat to another replica (failover, replica added/removed) it flags the update,
+and the sync handler (a group before the conversation handler) reloads that
+chat's state and user_data from the store first.
+"""
+import os
+import json
+import time
+import asyncio
+import threading
+import logging
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from telegram import Update
+from telegram.ext import BasePersistence, ConversationHandler, PersistenceInput, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+# "supabase", "postgres" (DATABASE_URL), "sqlite:<path>" or "off"
+BOT_PERSISTENCE = os.getenv("BOT_PERSISTENCE", "supabase")
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "1"))
+FLUSH_COALESCE_SECONDS = 0.05  # Collect one PTB persistence round into one batch
+FLUSH_RETRY_SECONDS = 5
+
+PERSISTENCE_TABLE = "bot_persistence"
+USER_DATA = "user_data"
+PAGE_SIZE = 1000  # PostgREST returns at most 1000 rows per request
+
+
+def conversation_scope(name):
+    return f"conversation:{name}"
+
+
+def encode_key(key):
+    """(chat_id, user_id) -> '<chat_id>:<user_id>'"""
+    return ":".join(str(part) for part in key)
+
+
+def decode_key(text):
+    return tuple(int(part) if part.lstrip("-").isdigit() else part for part in text.split(":"))
+
+
+class SupabaseStore:
+    """bot_persistence rows through the Supabase client (blocking, run in a thread)."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def load(self, scope):
+        data = {}
+        start = 0
+        while True:
+            res = self.client.table(PERSISTENCE_TABLE) \
+                .select("key, data") \
+                .eq("scope", scope) \
+                .order("key") \
+                .range(start, start + PAGE_SIZE - 1) \
+                .execute()
+            rows = res.data or []
+            for row in rows:
+                data[row["key"]] = row["data"]
+            if len(rows) < PAGE_SIZE:
+                return data
+            start += PAGE_SIZE
+
+    def load_many(self, items):
+        """{(scope, key): data} for the given (scope, key) pairs, in one request."""
+        conditions = ",".join(f'and(scope.eq."{scope}",key.eq."{key}")' for scope, key in items)
+        res = self.client.table(PERSISTENCE_TABLE).select("scope, key, data").or_(conditions).execute()
+        return {(row["scope"], row["key"]): row["data"] for row in (res.data or [])}
+
+    def save_many(self, rows):
+        """Write [(scope, key, data)] in one upsert; data None deletes the row."""
+        now = datetime.now(timezone.utc).isoformat()
+        upserts = [{"scope": scope, "key": key, "data": data, "updated_at": now}
+                   for scope, key, data in rows if data is not None]
+        if upserts:
+            self.client.table(PERSISTENCE_TABLE).upsert(upserts).execute()
+        deletes = {}
+        for scope, key, data in rows:
+            if data is None:
+                deletes.setdefault(scope, []).append(key)
+        for scope, keys in deletes.items():
+            self.client.table(PERSISTENCE_TABLE).delete().eq("scope", scope).in_("key", keys).execute()
+
+
+class PostgresStore:
+    """Same rows over a direct Postgres connection (DATABASE_URL, psycopg2)."""
+
+    def __init__(self, dsn):
+        import psycopg2
+        from psycopg2.extras import execute_values, Json
+        self._execute_values = execute_values
+        self._json = Json
+        self.conn = psycopg2.connect(dsn)
+        self._lock = threading.Lock()  # One connection, calls come from several threads
+
+    def _query(self, sql, params):
+        with self._lock:
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute(sql, params)
+                    rows = cur.fetchall()
+                self.conn.commit()
+                return rows
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def load(self, scope):
+        rows = self._query(f"SELECT key, data FROM public.{PERSISTENCE_TABLE} WHERE scope = %s", (scope,))
+        return dict(rows)
+
+    def load_many(self, items):
+        rows = self._query(
+            f"SELECT scope, key, data FROM public.{PERSISTENCE_TABLE} "
+            f"WHERE (scope, key) IN (SELECT * FROM unnest(%s::text[], %s::text[]))",
+            ([scope for scope, _ in items], [key for _, key in items]),
+        )
+        return {(scope, key): data for scope, key, data in rows}
+
+    def save_many(self, rows):
+        upserts = [(scope, key, self._json(data)) for scope, key, data in rows if data is not None]
+        deletes = [(scope, key) for scope, key, data in rows if data is None]
+        with self._lock:
+            try:
+                with self.conn.cursor() as cur:
+                    if upserts:
+                        self._execute_values(cur, f"""
+                            INSERT INTO public.{PERSISTENCE_TABLE} (scope, key, data, updated_at)
+                            VALUES %s
+                            ON CONFLICT (scope, key) DO UPDATE SET data = EXCLUDED.data, updated_at = now()
+                        """, upserts, template="(%s, %s, %s, now())")
+                    if deletes:
+                        cur.execute(
+                            f"DELETE FROM public.{PERSISTENCE_TABLE} "
+                            f"WHERE (scope, key) IN (SELECT * FROM unnest(%s::text[], %s::text[]))",
+                            ([scope for scope, _ in deletes], [key for _, key in deletes]),
+                        )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+
+class SQLiteStore:
+    """Same rows in a local SQLite file (single host: local runs, several replicas on one VPS)."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS {PERSISTENCE_TABLE} (
+                    scope TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    updated_at TEXT,
+                    PRIMARY KEY (scope, key)
+                )
+            """)
+
+    @contextmanager
+    def _connect(self):
+        # New connection per call: calls come from asyncio.to_thread worker threads
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:  # commit / rollback
+                yield conn
+        finally:
+            conn.close()
+
+    def load(self, scope):
+        with self._connect() as conn:
+            rows = conn.execute(f"SELECT key, data FROM {PERSISTENCE_TABLE} WHERE scope = ?", (scope,)).fetchall()
+        return {key: json.loads(data) for key, data in rows}
+
+    def load_many(self, items):
+        out = {}
+        with self._connect() as conn:
+            for scope, key in items:
+                row = conn.execute(
+                    f"SELECT data FROM {PERSISTENCE_TABLE} WHERE scope = ? AND key = ?", (scope, key)
+                ).fetchone()
+                if row:
+                    out[(scope, key)] = json.loads(row[0])
+        return out
+
+    def save_many(self, rows):
+        now = datetime.now(timezone.utc).isoformat()
+        with self._connect() as conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO {PERSISTENCE_TABLE} (scope, key, data, updated_at) VALUES (?, ?, ?, ?)",
+                [(scope, key, json.dumps(data), now) for scope, key, data in rows if data is not None],
+            )
+            conn.executemany(
+                f"DELETE FROM {PERSISTENCE_TABLE} WHERE scope = ? AND key = ?",
+                [(scope, key) for scope, key, data in rows if data is None],
+            )
+
+
+class SyncedConversationHandler(ConversationHandler):
+    """
+    ConversationHandler whose state for one conversation can be replaced or
+    ended from outside a handler (replica handover, idle session eviction).
+    Both go through PTB's own state transition, so the change is tracked like a
+    state returned by a handler: the next persistence round writes it, and an
+    ended conversation deletes its stored row.
+    """
+
+    def key_for(self, chat_id, user_id):
+        """Conversation key of a chat / user, as PTB builds it from an update."""
+        key = []
+        if self.per_chat:
+            key.append(chat_id)
+        if self.per_user and user_id is not None:
+            key.append(user_id)
+        return tuple(key)
+
+    def set_state(self, key, state):
+        """Continue the conversation in `state` (None ends it)."""
+        if state is None:
+            self.end(key)
+        else:
+            self._update_state(state, key)
+
+    def end(self, key):
+        """End the conversation like its timeout would (TIMEOUT handlers are not run)."""
+        job = self.timeout_jobs.pop(key, None)
+        if job:
+            job.schedule_removal()
+        self._update_state(self.END, key)
+
+
+class BotPersistence(BasePersistence):
+    """Conversation states + user_data in a shared store (see module docstring)."""
+
+    def __init__(self, store, update_interval=PERSISTENCE_UPDATE_INTERVAL, user_data_type=None):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.store = store
+        # Class used for context.user_data (ContextTypes); must offer to_dict / from_dict / load.
+        # None means plain dicts.
+        self.user_data_type = user_data_type
+        self._stale_chats = set()
+        self._dirty = {}  # (scope, key) -> data (None = delete), newest wins
+        self._flush_task = None
+        self._write_lock = asyncio.Lock()
+        # Flush statistics (scripts/bench_persistence.py)
+        self.flushes = 0
+        self.rows_written = 0
+        self.flush_seconds = 0.0
+        self.failed_flushes = 0
+
+    def _buffer(self, scope, key, data):
+        """Queue a write; the flush task picks it up. Never waits on storage."""
+        if data is not None:
+            try:
+                json.dumps(data)
+            except (TypeError, ValueError) as e:
+                logger.error(f"[PERSISTENCE] {scope}/{key} is not JSON serializable, not saved: {e}")
+                return
+        self._dirty[(scope, key)] = data
+        self._schedule_flush(FLUSH_COALESCE_SECONDS)
+
+    def _schedule_flush(self, delay):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_after(delay))
+
+    async def _flush_after(self, delay):
+        await asyncio.sleep(delay)
+        # Entries buffered while a batch is being written go out in the next one
+        while self._dirty:
+            if not await self._write_dirty():
+                await asyncio.sleep(FLUSH_RETRY_SECONDS)
+
+    async def _write_dirty(self):
+        """Write the whole buffer in one batch. Returns False if the batch failed (kept for retry)."""
+        async with self._write_lock:
+            if not self._dirty:
+                return True
+            batch, self._dirty = self._dirty, {}
+            started = time.perf_counter()
+            try:
+                await asyncio.to_thread(self.store.save_many, [(s, k, d) for (s, k), d in batch.items()])
+            except Exception as e:
+                self.failed_flushes += 1
+                logger.error(f"[PERSISTENCE] Failed to write {len(batch)} entries, retrying in {FLUSH_RETRY_SECONDS}s: {e}")
+                for item, data in batch.items():
+                    self._dirty.setdefault(item, data)  # Keep newer values buffered meanwhile
+                return False
+            self.flushes += 1
+            self.rows_written += len(batch)
+            self.flush_seconds += time.perf_counter() - started
+            return True
+
+    # --- Loaded once at startup ---
+
+    async def get_user_data(self):
+        rows = await asyncio.to_thread(self.store.load, USER_DATA)
+        if self.user_data_type:
+            return {int(key): self.user_data_type.from_dict(data) for key, data in rows.items()}
+        return {int(key): data for key, data in rows.items()}
+
+    async def get_conversations(self, name):
+        rows = await asyncio.to_thread(self.store.load, conversation_scope(name))
+        return {decode_key(key): state for key, state in rows.items()}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- Written by PTB every update_interval for changed entries ---
+
+    async def update_conversation(self, name, key, new_state):
+        self._buffer(conversation_scope(name), encode_key(key), new_state)
+
+    async def update_user_data(self, user_id, data):
+        self._buffer(USER_DATA, str(user_id), data.to_dict() if self.user_data_type else dict(data))
+
+    async def drop_user_data(self, user_id):
+        self._buffer(USER_DATA, str(user_id), None)
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """Called by PTB on shutdown: write whatever is still buffered."""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_dirty()
+
+    # --- Replica handover ---
+
+    def mark_stale(self, chat_id):
+        """The next update of this chat must reload its state from the store first."""
+        self._stale_chats.add(chat_id)
+
+    def sync_handler(self, conv_handler):
+        """
+        TypeHandler (add in a group before conv_handler) that reloads state for
+        chats marked stale. conv_handler must be a SyncedConversationHandler.
+        """
+
+        async def sync_chat_state(update: Update, context):
+            chat = update.effective_chat
+            user = update.effective_user
+            if not chat or chat.id not in self._stale_chats:
+                return
+            self._stale_chats.discard(chat.id)
+
+            key = conv_handler.key_for(chat.id, user.id if user else None)
+            state_item = (conversation_scope(conv_handler.name), encode_key(key))
+            items = [state_item]
+            if user:
+                items.append((USER_DATA, str(user.id)))
+            # Entries still in our write buffer are newer than the store
+            items = [item for item in items if item not in self._dirty]
+            if not items:
+                return
+
+            try:
+                rows = await asyncio.to_thread(self.store.load_many, items)
+            except Exception as e:
+                logger.error(f"[PERSISTENCE] Could not reload state for chat {chat.id}: {e}")
+                return
+
+            state = rows.get(state_item)
+            if state_item in items:
+                conv_handler.set_state(key, state)
+            user_item = (USER_DATA, str(user.id)) if user else None
+            if user_item in items:
+                stored = rows.get(user_item) or {}
+                if self.user_data_type:
+                    context.user_data.load(stored)
+                else:
+                    context.user_data.clear()
+                    context.user_data.update(stored)
+            logger.info(f"[PERSISTENCE] Reloaded state for chat {chat.id} (state: {state})")
+
+        return TypeHandler(Update, sync_chat_state)
+
+
+def persistence_from_env(supabase_client, user_data_type=None):
+    """BotPersistence configured by BOT_PERSISTENCE, or None when disabled."""
+    setting = BOT_PERSISTENCE.strip()
+    if setting == "supabase":
+        store = SupabaseStore(supabase_client)
+    elif setting == "postgres":
+        store = PostgresStore(os.getenv("DATABASE_URL"))
+    elif setting.startswith("sqlite:"):
+        store = SQLiteStore(setting[len("sqlite:"):])
+    else:
+        store = None
+    if store:
+        return BotPersistence(store, user_data_type=user_data_type)
+    if setting not in ("", "off"):
+        logger.warning(f"[PERSISTENCE] Unknown BOT_PERSISTENCE={setting!r}, persistence disabled")
+    return None
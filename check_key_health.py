@@ -0,0 +1,26 @@
+import os
+from dotenv import load_dotenv
+from supabase import create_client
+
+load_dotenv()
+supabase = create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+
+def check_key_health():
+    print("🔑 API Key Health (circuit breaker):")
+    print("--------------------------------------")
+    try:
+        res = supabase.table("api_key_health").select("*").order("updated_at", desc=True).execute()
+        if not res.data:
+            print("No breaker transitions recorded yet (all keys healthy).")
+            return
+        for k in res.data:
+            icon = "✅" if k.get("state") == "closed" else ("🟡" if k.get("state") == "half_open" else "❌")
+            print(f"{icon} {k.get('key_hint')} [{k.get('key_fingerprint')}] state={k.get('state')} "
+                  f"failures={k.get('consecutive_failures')} open_until={k.get('open_until')}")
+            if k.get("last_error") and k.get("state") != "closed":
+                print(f"    last error: {k.get('last_error')}")
+    except Exception as e:
+        print(f"Error: {e}")
+
+if __name__ == "__main__":
+    check_key_health()
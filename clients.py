@@ -0,0 +1,82 @@
+"""
+Shared clients for the bot, the queue worker and the helpers.
+
+Each client is created on first use and then reused by every module, so the
+process holds one Supabase client (one HTTP connection pool), one R2/S3 client
+and one requests.Session instead of a copy per module. Importing this module
+is cheap: boto3 and requests are only imported when first needed, which keeps
+cold start (and the memory of processes that never upload) down.
+
+    from clients import supabase        # proxy, same API as the real client
+    get_r2().upload_bytes(...)
+    http_session().get(...)
+"""
+import os
+import threading
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- CONFIGURATION ---
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))  # Connections kept per host (Freepik, R2 downloads)
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _shared(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _lock:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
+
+
+def _create_supabase():
+    from supabase import create_client
+    return create_client(os.getenv("SUPABASE_URL"), os.getenv("SUPABASE_KEY"))
+
+
+def _create_r2():
+    from r2_helper import R2Helper
+    return R2Helper()
+
+
+def _create_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_SIZE)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_supabase():
+    return _shared("supabase", _create_supabase)
+
+
+def get_r2():
+    return _shared("r2", _create_r2)
+
+
+def http_session():
+    """requests.Session shared by all threads (keeps TLS connections to the APIs open)."""
+    return _shared("http", _create_http_session)
+
+
+class LazyClient:
+    """Module-level stand-in for a shared client; builds it on first attribute access."""
+
+    __slots__ = ("_factory",)
+
+    def __init__(self, factory):
+        self._factory = factory
+
+    def __getattr__(self, name):
+        return getattr(self._factory(), name)
+
+
+supabase = LazyClient(get_supabase)
@@ -0,0 +1,272 @@
+"""
+Adaptive limits for the shared Freepik lane (AIMD).
+
+The worker used to cap the shared lane with two constants: at most
+MAX_GLOBAL_CONCURRENT generations in flight and GLOBAL_DELAY_SECONDS between
+submissions. AimdController replaces them with two values it adjusts from
+what the provider tells us:
+
+  * every accepted submission raises the concurrency limit by
+    increase_step / limit and the submission rate by the same fraction of
+    rate_step (additive increase, about one step per "window" of successes),
+    but only while the limits are actually holding work back (note_blocked
+    within DEMAND_WINDOW_SECONDS), so a quiet night does not ratchet them up,
+  * a 429, a timeout, a 5xx or a submit latency EWMA above latency_target_ms
+    multiplies both by decrease_factor (multiplicative decrease), at most
+    once per decrease_cooldown_seconds so one burst of 429s counts once.
+
+Bounds and tuning come from the worker_limits row (hot reloaded every
+LIMITS_RELOAD_SECONDS). Setting adaptive = false pins the initial values,
+which is the old static behaviour.
+
+ModelLimits adds per-model caps on top (ai_models.max_concurrent and
+max_per_minute), so one slow model cannot take every shared slot.
+"""
+import os
+import time
+import logging
+import threading
+from collections import defaultdict
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+LIMITS_NAME = os.getenv("WORKER_LIMITS_NAME", "telegram")  # worker_limits row for this worker
+LIMITS_RELOAD_SECONDS = 30
+LATENCY_ALPHA = 0.2  # EWMA weight for submit latency
+DEMAND_WINDOW_SECONDS = 60  # Successes only raise limits this long after the limits blocked work
+CONGESTION_STATUS_CODES = (429, 500, 502, 503, 504)
+
+DEFAULT_LIMITS = {
+    "adaptive": True,
+    "initial_concurrent": 12,      # Old MAX_GLOBAL_CONCURRENT
+    "min_concurrent": 2,
+    "max_concurrent": 48,
+    "initial_delay_seconds": 5.0,  # Old GLOBAL_DELAY_SECONDS
+    "min_delay_seconds": 0.5,
+    "max_delay_seconds": 15.0,
+    "increase_step": 1.0,          # Concurrency added per window of successes
+    "rate_step": 0.1,              # Submissions/second added per window of successes
+    "decrease_factor": 0.7,
+    "decrease_cooldown_seconds": 5.0,
+    "latency_target_ms": 10000,
+}
+
+
+class AimdController:
+    def __init__(self, client=None, limits_name=LIMITS_NAME, limits=None):
+        self.client = client
+        self.limits_name = limits_name
+        self._lock = threading.Lock()
+        self.cfg = dict(DEFAULT_LIMITS)
+        self.cfg.update(limits or {})
+        self._limit = float(self.cfg["initial_concurrent"])
+        self._rate = 1.0 / self.cfg["initial_delay_seconds"]
+        self._latency_ewma = None
+        self._last_decrease = 0.0
+        self._last_blocked = 0.0
+        self._loaded_at = 0.0
+        self.increases = 0
+        self.decreases = 0
+
+    # --- configuration ---
+
+    def apply_config(self, row):
+        """Take new bounds / tuning (unknown or NULL columns keep their defaults)."""
+        cfg = dict(DEFAULT_LIMITS)
+        cfg.update({k: v for k, v in (row or {}).items() if k in DEFAULT_LIMITS and v is not None})
+        with self._lock:
+            changed = cfg != self.cfg
+            self.cfg = cfg
+            if not cfg["adaptive"]:
+                self._limit = float(cfg["initial_concurrent"])
+                self._rate = 1.0 / cfg["initial_delay_seconds"]
+            self._clamp()
+        if changed:
+            logger.info(f"[LIMITS] Loaded worker_limits '{self.limits_name}': {self.describe()}")
+
+    def maybe_reload(self):
+        """Re-read the worker_limits row when it is older than LIMITS_RELOAD_SECONDS."""
+        if self.client is None or time.time() - self._loaded_at < LIMITS_RELOAD_SECONDS:
+            return
+        self._loaded_at = time.time()
+        try:
+            res = self.client.table("worker_limits").select("*").eq("name", self.limits_name).limit(1).execute()
+        except Exception as e:
+            # Keep the current limits; retry on the next reload
+            logger.error(f"[LIMITS] Failed to load worker_limits: {e}")
+            return
+        if res.data:
+            self.apply_config(res.data[0])
+
+    def _clamp(self):
+        cfg = self.cfg
+        self._limit = min(max(self._limit, cfg["min_concurrent"]), cfg["max_concurrent"])
+        self._rate = min(max(self._rate, 1.0 / cfg["max_delay_seconds"]), 1.0 / cfg["min_delay_seconds"])
+
+    # --- signals ---
+
+    def on_result(self, status_code, latency=None, error=None):
+        """KeyPool.on_result hook: one call per submission attempt on the shared pool."""
+        if status_code == 200:
+            self.record_success(latency or 0.0)
+        elif status_code in CONGESTION_STATUS_CODES:
+            self.record_congestion(f"HTTP {status_code}")
+        elif status_code is None and error and "timed out" in str(error).lower():
+            self.record_congestion("timeout")
+
+    def note_blocked(self):
+        """The worker held shared work back because of concurrency() or delay()."""
+        self._last_blocked = time.time()
+
+    def record_success(self, latency):
+        with self._lock:
+            if self._latency_ewma is None:
+                self._latency_ewma = latency
+            else:
+                self._latency_ewma = LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * self._latency_ewma
+            slow = self._latency_ewma * 1000 > self.cfg["latency_target_ms"]
+        if slow:
+            self.record_congestion(f"latency {int(self._latency_ewma * 1000)} ms")
+            return
+        with self._lock:
+            if not self.cfg["adaptive"] or time.time() - self._last_blocked > DEMAND_WINDOW_SECONDS:
+                return
+            self._limit += self.cfg["increase_step"] / self._limit
+            self._rate += self.cfg["rate_step"] / self._limit
+            self._clamp()
+            self.increases += 1
+
+    def record_congestion(self, reason):
+        now = time.time()
+        with self._lock:
+            if not self.cfg["adaptive"] or now - self._last_decrease < self.cfg["decrease_cooldown_seconds"]:
+                return
+            self._last_decrease = now
+            self._limit *= self.cfg["decrease_factor"]
+            self._rate *= self.cfg["decrease_factor"]
+            self._clamp()
+            self.decreases += 1
+            limit, delay = self._limit, 1.0 / self._rate
+        logger.warning(f"[LIMITS] Backing off ({reason}): concurrency {limit:.1f}, delay {delay:.2f}s")
+
+    # --- limits ---
+
+    def concurrency(self):
+        """Shared-lane generations allowed in flight."""
+        with self._lock:
+            return int(self._limit)
+
+    def delay(self):
+        """Seconds to wait between shared-lane submissions."""
+        with self._lock:
+            return 1.0 / self._rate
+
+    def describe(self):
+        with self._lock:
+            latency = f"{int(self._latency_ewma * 1000)} ms" if self._latency_ewma is not None else "-"
+            mode = "adaptive" if self.cfg["adaptive"] else "static"
+            return (
+                f"{mode} concurrency {self._limit:.1f} [{self.cfg['min_concurrent']}-{self.cfg['max_concurrent']}], "
+                f"delay {1.0 / self._rate:.2f}s, latency {latency}, +{self.increases}/-{self.decreases}"
+            )
+
+
+class ModelStats:
+    __slots__ = ("in_flight", "last_submit", "claimed", "wait_total", "wait_max", "skipped")
+
+    def __init__(self):
+        self.in_flight = 0
+        self.last_submit = 0.0
+        self.claimed = 0
+        self.wait_total = 0.0   # Seconds between enqueue and claim, summed
+        self.wait_max = 0.0
+        self.skipped = 0        # Claim passes that excluded this model (it was saturated)
+
+
+class ModelLimits:
+    """
+    Per-model concurrency and rate caps for the worker, configured per row in
+    ai_models (read through a ModelCatalog, so edits apply within its TTL):
+
+        max_concurrent  generations of this model in flight (NULL = no cap)
+        max_per_minute  submissions of this model per minute (NULL = no cap)
+
+    In-flight counts are kept in memory (one worker process claims), like the
+    BYOK key accounting. The claim query skips saturated() models, so other
+    models keep flowing while one is at its cap.
+    """
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self._lock = threading.Lock()
+        self._stats = defaultdict(ModelStats)
+
+    def _caps(self, model_id):
+        row = self.catalog.get(model_id) or {}
+        max_concurrent = row.get("max_concurrent")
+        per_minute = row.get("max_per_minute")
+        return max_concurrent, (60.0 / per_minute if per_minute else 0.0)
+
+    def _is_saturated(self, model_id, stats, now):
+        max_concurrent, interval = self._caps(model_id)
+        if max_concurrent is not None and stats.in_flight >= max_concurrent:
+            return True
+        return interval > 0 and now - stats.last_submit < interval
+
+    def saturated(self):
+        """Model ids that must not be claimed right now."""
+        now = time.time()
+        with self._lock:
+            items = list(self._stats.items())
+        return [model_id for model_id, stats in items if self._is_saturated(model_id, stats, now)]
+
+    def note_skipped(self, model_ids):
+        with self._lock:
+            for model_id in model_ids:
+                self._stats[model_id].skipped += 1
+
+    def acquire(self, model_id, waited=None):
+        """A task of this model was claimed (counts until release)."""
+        with self._lock:
+            stats = self._stats[model_id]
+            stats.in_flight += 1
+            stats.last_submit = time.time()
+            stats.claimed += 1
+            if waited is not None:
+                stats.wait_total += waited
+                stats.wait_max = max(stats.wait_max, waited)
+
+    def release(self, model_id):
+        """The task reached a final state (completed, failed, submission refused)."""
+        with self._lock:
+            stats = self._stats[model_id]
+            stats.in_flight = max(0, stats.in_flight - 1)
+
+    def in_flight(self, model_id):
+        with self._lock:
+            stats = self._stats.get(model_id)
+            return stats.in_flight if stats else 0
+
+    def snapshot(self, pending=None):
+        """Per-model numbers; pending = {model_id: (queued count, oldest wait seconds)} from the queue."""
+        pending = pending or {}
+        with self._lock:
+            items = {model_id: stats for model_id, stats in self._stats.items()}
+        out = {}
+        for model_id in sorted(set(items) | set(pending)):
+            stats = items.get(model_id) or ModelStats()
+            max_concurrent, interval = self._caps(model_id)
+            queued, oldest = pending.get(model_id, (0, 0.0))
+            out[model_id] = {
+                "in_flight": stats.in_flight,
+                "max_concurrent": max_concurrent,
+                "max_per_minute": round(60 / interval) if interval else None,
+                "queued": queued,
+                "oldest_wait_s": int(oldest),
+                "claimed": stats.claimed,
+                "avg_wait_s": int(stats.wait_total / stats.claimed) if stats.claimed else 0,
+                "max_wait_s": int(stats.wait_max),
+                "skipped": stats.skipped,
+            }
+        return out
@@ -0,0 +1,133 @@
+"""
+State machine for rows in the generations table (the Telegram queue).
+
+    pending ──claim──> processing ──complete──> completed
+       │                   │
+       └──────fail─────────┴──────fail──────> failed
+
+Every transition is ONE conditional write (`... WHERE id = ? AND status = ?`),
+so a row can only leave a state once: a second worker, a stale-cleanup pass or
+a duplicate poll callback simply gets False back instead of overwriting a
+finished row. Completion goes through the complete_generation RPC, which also
+bumps the user's video count in the same round trip.
+
+A submission that keeps failing for temporary reasons (429, 5xx, timeouts)
+stays processing while the worker retries it; when the retry budget runs out
+it is dead-lettered: failed with dead_lettered_at set, so it can be told apart
+from ordinary failures and requeued (requeue_dead_lettered_generations).
+"""
+import logging
+from clients import supabase
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+PROCESSING = "processing"
+COMPLETED = "completed"
+FAILED = "failed"
+
+ALLOWED_TRANSITIONS = {
+    PENDING: {PROCESSING, FAILED},
+    PROCESSING: {COMPLETED, FAILED},
+    COMPLETED: set(),
+    FAILED: set(),
+}
+
+
+class InvalidTransition(Exception):
+    pass
+
+
+def transition(gen_id, from_status, to_status, **fields):
+    """
+    Move a generation from from_status to to_status, writing any extra
+    columns in the same update. Returns True if this call made the change,
+    False if the row was no longer in from_status.
+    """
+    if to_status not in ALLOWED_TRANSITIONS.get(from_status, set()):
+        raise InvalidTransition(f"{from_status} -> {to_status} is not allowed")
+
+    res = supabase.table("generations") \
+        .update({"status": to_status, **fields}) \
+        .eq("id", gen_id) \
+        .eq("status", from_status) \
+        .execute()
+    changed = bool(res.data)
+    if not changed:
+        logger.warning(f"[STATE] Generation {gen_id}: {from_status} -> {to_status} skipped (row not in {from_status})")
+    return changed
+
+
+def claim(gen_id, **fields):
+    """pending -> processing (claimed_at = now). Doubles as the worker's lock on the row."""
+    return transition(gen_id, PENDING, PROCESSING, claimed_at="now()", **fields)
+
+
+def record_submission(gen_id, task_id, api_key_used, **fields):
+    """Attach provider details to a processing row (no status change)."""
+    res = supabase.table("generations") \
+        .update({"task_id": task_id, "api_key_used": api_key_used, **fields}) \
+        .eq("id", gen_id) \
+        .eq("status", PROCESSING) \
+        .execute()
+    return bool(res.data)
+
+
+def move_to_shared_lane(gen_id):
+    """Pending byok row whose user no longer has a key -> shared lane (no status change)."""
+    res = supabase.table("generations") \
+        .update({"lane": "shared"}) \
+        .eq("id", gen_id) \
+        .eq("status", PENDING) \
+        .eq("lane", "byok") \
+        .execute()
+    return bool(res.data)
+
+
+def complete(gen_id, video_url, r2_url=None):
+    """processing -> completed + increment_video_count, in one RPC."""
+    res = supabase.rpc("complete_generation", {
+        "p_generation_id": gen_id,
+        "p_video_url": video_url,
+        "p_r2_url": r2_url or video_url
+    }).execute()
+    changed = bool(res.data)
+    if not changed:
+        logger.warning(f"[STATE] Generation {gen_id}: completion skipped (row not processing)")
+    return changed
+
+
+def fail(gen_id, error, from_status=PROCESSING):
+    """pending/processing -> failed with an error message."""
+    return transition(gen_id, from_status, FAILED, error=error)
+
+
+def record_retry(gen_id, attempts):
+    """Count a failed submission attempt on a processing row that will be retried."""
+    res = supabase.table("generations") \
+        .update({"submit_attempts": attempts}) \
+        .eq("id", gen_id) \
+        .eq("status", PROCESSING) \
+        .execute()
+    return bool(res.data)
+
+
+def dead_letter(gen_id, error, attempts):
+    """processing -> failed after the retry budget ran out (marked dead_lettered_at)."""
+    return transition(gen_id, PROCESSING, FAILED, error=error, submit_attempts=attempts, dead_lettered_at="now()")
+
+
+def fail_stale(user_id, claimed_before, error, exclude=()):
+    """
+    Fail a user's processing rows claimed before claimed_before (except the
+    ids in exclude: rows the worker still holds) and refund their reserved
+    credits, in one RPC. Returns the changed rows ({gen_id, chat_id,
+    gen_options, refunded}).
+    """
+    res = supabase.rpc("fail_stale_generations", {
+        "p_user_id": user_id,
+        "p_claimed_before": claimed_before,
+        "p_error": error,
+        "p_exclude": list(exclude)
+    }).execute()
+    return res.data or []
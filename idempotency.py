@@ -0,0 +1,108 @@
+"""
+Duplicate input from Telegram users (double-tapped buttons, re-sent photos).
+
+* drop_duplicate_callbacks: handler group -3. A callback query with the same
+  (chat, message, data) as one seen less than CALLBACK_DEDUP_SECONDS ago is
+  answered and dropped before any handler (or the persistence sync) runs.
+* EnqueueGuard: enqueue_key() hashes (user, file_unique_id, prompt, model,
+  duration, ratio). The bot claims the key before the photo download / R2
+  upload and remembers it for ENQUEUE_DEDUP_SECONDS after the insert. The
+  unique index on generations.idempotency_key (pending / processing rows)
+  catches what this process has not seen (other replica, restart).
+
+Chats are routed to one replica each (webhook_router.py) and a chat's updates
+run in order (update_processor.py), so the in-process state sees every
+duplicate of a chat except across a restart.
+"""
+import time
+import hashlib
+import logging
+
+from telegram.ext import ApplicationHandlerStop
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+CALLBACK_DEDUP_SECONDS = 2
+ENQUEUE_DEDUP_SECONDS = 600
+PRUNE_EVERY = 256  # Prune expired entries every this many calls
+
+
+class RecentKeys:
+    """Keys seen in the last `ttl` seconds (single event loop: no lock needed)."""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._seen = {}
+        self._calls = 0
+        self.duplicates = 0
+
+    def _prune(self, now):
+        self._calls += 1
+        if self._calls % PRUNE_EVERY == 0:
+            self._seen = {k: t for k, t in self._seen.items() if now - t < self.ttl}
+
+    def check_and_add(self, key):
+        """True the first time within ttl, False for a duplicate."""
+        now = time.monotonic()
+        self._prune(now)
+        seen = self._seen.get(key)
+        if seen is not None and now - seen < self.ttl:
+            self.duplicates += 1
+            return False
+        self._seen[key] = now
+        return True
+
+    def discard(self, key):
+        self._seen.pop(key, None)
+
+    def __len__(self):
+        return len(self._seen)
+
+
+recent_callbacks = RecentKeys(CALLBACK_DEDUP_SECONDS)
+
+
+async def drop_duplicate_callbacks(update, context):
+    """Handler group -3: stop a repeated callback query (double tap) here."""
+    query = update.callback_query
+    if not query or not query.message:
+        return
+    if recent_callbacks.check_and_add((query.message.chat.id, query.message.message_id, query.data)):
+        return
+    logger.info(f"[IDEMPOTENCY] Dropped duplicate callback '{query.data}' in chat {query.message.chat.id}")
+    try:
+        await query.answer()
+    except Exception:
+        pass  # Answering only stops the button spinner
+    raise ApplicationHandlerStop
+
+
+def enqueue_key(user_id, file_unique_id, prompt, model_id, duration, ratio):
+    """Idempotency key of one generation request (stored in generations.idempotency_key)."""
+    raw = "\x1f".join(str(part) for part in (user_id, file_unique_id, prompt, model_id, duration, ratio))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class EnqueueGuard:
+    """Enqueue keys in flight or inserted in the last ENQUEUE_DEDUP_SECONDS."""
+
+    def __init__(self, ttl=ENQUEUE_DEDUP_SECONDS):
+        self.keys = RecentKeys(ttl)
+
+    def claim(self, key):
+        """False if the same request is being enqueued or was just enqueued."""
+        return self.keys.check_and_add(key)
+
+    def release(self, key):
+        """The enqueue failed: the same request may be sent again."""
+        self.keys.discard(key)
+
+    @property
+    def duplicates(self):
+        return self.keys.duplicates
+
+
+def is_duplicate_key_error(error):
+    """Insert rejected by the unique idempotency_key index."""
+    return getattr(error, "code", None) == "23505" and "idempotency_key" in str(error)
@@ -0,0 +1,282 @@
+import time
+import hashlib
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+STATS_WINDOW_SECONDS = 300      # How long 429s / errors count against a key
+THROTTLE_PENALTY = 3            # Score added per recent 429
+ERROR_PENALTY = 1               # Score added per recent error (timeout, 5xx, ...)
+LATENCY_ALPHA = 0.3             # EWMA weight for submit latency
+UNHEALTHY_AFTER_429_SECONDS = 30  # A key that got 429 this recently is tried last
+
+# Circuit breaker
+BREAKER_FAILURE_THRESHOLD = 3     # Consecutive failures before a key is opened
+BREAKER_COOLDOWN_SECONDS = 120    # First cooldown; doubles on every failed probe
+BREAKER_MAX_COOLDOWN_SECONDS = 1800
+DEAD_KEY_STATUS_CODES = (401, 402, 403)  # Revoked / out of quota: open immediately
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def key_hint(key):
+    """Short, log-safe representation of an API key."""
+    return f"{key[:4]}..." if key else "-"
+
+
+def is_key_failure(status_code):
+    """
+    Failure that says something about the key / provider (429, 5xx, revoked /
+    out of quota, exception or timeout). Other 4xx are about the request.
+    """
+    return status_code is None or status_code == 429 or status_code >= 500 or status_code in DEAD_KEY_STATUS_CODES
+
+
+def key_fingerprint(key):
+    """Stable, non-reversible id for a key (used when exporting breaker state)."""
+    return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+
+class KeyStats:
+    def __init__(self):
+        self.in_flight = 0
+        self.submitted = 0
+        self.latency_ewma = None
+        self.last_429_at = 0
+        self.throttles = deque()
+        self.errors = deque()
+        # Circuit breaker
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.cooldown = BREAKER_COOLDOWN_SECONDS
+        self.open_until = 0
+        self.probing = False
+        self.last_error = None
+
+    def prune(self, now):
+        cutoff = now - STATS_WINDOW_SECONDS
+        while self.throttles and self.throttles[0] < cutoff:
+            self.throttles.popleft()
+        while self.errors and self.errors[0] < cutoff:
+            self.errors.popleft()
+
+
+class KeyPool:
+    """
+    Tracks load per Freepik API key so submissions go to the least-loaded
+    healthy key instead of always hammering the first key in the group.
+
+    in_flight counts tasks accepted by the provider that have not finished
+    polling yet; callers must release() once a task completes or fails.
+
+    Each key also has a circuit breaker: after BREAKER_FAILURE_THRESHOLD
+    consecutive failures (or a single revoked/quota response) the key is
+    skipped until its cooldown passes, then exactly one probe request is let
+    through. A successful probe closes the breaker, a failed one re-opens it
+    with a doubled cooldown.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+        # Optional callback(key, stats) fired on breaker transitions (state export).
+        # Called outside the lock since exporters usually do I/O.
+        self.on_state_change = None
+        # Optional callback(status_code, latency, error) per submission attempt
+        # (adaptive worker limits, see concurrency_control.py). Called outside the lock.
+        self.on_result = None
+        self._pending_exports = []
+
+    def _get(self, key):
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = KeyStats()
+        return stats
+
+    def _score(self, stats):
+        latency_penalty = (stats.latency_ewma or 0) / 10
+        return (
+            stats.in_flight
+            + THROTTLE_PENALTY * len(stats.throttles)
+            + ERROR_PENALTY * len(stats.errors)
+            + latency_penalty
+        )
+
+    def rank(self, keys):
+        """
+        Return usable keys ordered best-first: healthy keys by load, recently
+        throttled keys last. Keys with an open breaker are left out.
+        """
+        now = time.time()
+        with self._lock:
+            scored = []
+            for idx, key in enumerate(keys):
+                stats = self._get(key)
+                stats.prune(now)
+                if stats.state == OPEN and now < stats.open_until:
+                    continue
+                if stats.state == HALF_OPEN and stats.probing:
+                    continue
+                unhealthy = (now - stats.last_429_at) < UNHEALTHY_AFTER_429_SECONDS
+                # idx keeps list order as the tie-breaker for equally loaded keys
+                scored.append((unhealthy, self._score(stats), idx, key))
+        scored.sort()
+        return [s[3] for s in scored]
+
+    def try_acquire(self, key):
+        """
+        Ask the breaker whether a request may be sent on this key right now.
+        Claims the single probe slot when the key's cooldown has passed.
+        """
+        now = time.time()
+        with self._lock:
+            stats = self._get(key)
+            if stats.state == CLOSED:
+                return True
+            if stats.state == HALF_OPEN:
+                if stats.probing:
+                    return False
+                stats.probing = True
+                return True
+            # OPEN
+            if now < stats.open_until:
+                return False
+            stats.probing = True
+            self._transition(key, stats, HALF_OPEN)
+        self._export()
+        return True
+
+    def _transition(self, key, stats, state):
+        """Change breaker state (lock held) and queue the export."""
+        if stats.state == state:
+            return
+        logger.warning(f"[KEY POOL] Key {key_hint(key)}: breaker {stats.state} -> {state}")
+        stats.state = state
+        self._pending_exports.append((key, self._describe(stats)))
+
+    def _export(self):
+        """Hand queued breaker transitions to on_state_change (lock NOT held)."""
+        with self._lock:
+            pending, self._pending_exports = self._pending_exports, []
+        if not self.on_state_change:
+            return
+        for key, state in pending:
+            try:
+                self.on_state_change(key, state)
+            except Exception as e:
+                logger.error(f"[KEY POOL] Failed to export breaker state: {e}")
+
+    def _open(self, key, stats, cooldown):
+        stats.cooldown = min(cooldown, BREAKER_MAX_COOLDOWN_SECONDS)
+        stats.open_until = time.time() + stats.cooldown
+        stats.probing = False
+        if stats.state == OPEN:
+            return
+        self._transition(key, stats, OPEN)
+
+    def record_success(self, key, latency):
+        """Provider accepted a task on this key."""
+        with self._lock:
+            stats = self._get(key)
+            stats.consecutive_failures = 0
+            stats.probing = False
+            stats.cooldown = BREAKER_COOLDOWN_SECONDS
+            stats.last_error = None
+            self._transition(key, stats, CLOSED)
+            stats.in_flight += 1
+            stats.submitted += 1
+            if stats.latency_ewma is None:
+                stats.latency_ewma = latency
+            else:
+                stats.latency_ewma = LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * stats.latency_ewma
+        self._export()
+        self._report(200, latency)
+
+    def record_failure(self, key, status_code=None, error=None):
+        """Submission on this key failed (status_code None means exception/timeout)."""
+        now = time.time()
+        with self._lock:
+            stats = self._get(key)
+            stats.last_error = f"{status_code or 'exception'}: {error}" if error else str(status_code or 'exception')
+            if not is_key_failure(status_code):
+                # Bad prompt / image / payload (400, 404, 422, ...): the key answered, its breaker
+                # is not charged; a half-open key may be probed again
+                stats.probing = False
+            elif status_code == 429:
+                stats.throttles.append(now)
+                stats.last_429_at = now
+            else:
+                stats.errors.append(now)
+            if is_key_failure(status_code):
+                stats.consecutive_failures += 1
+                if stats.state == HALF_OPEN:
+                    # Probe failed: back off harder
+                    self._open(key, stats, stats.cooldown * 2)
+                elif status_code in DEAD_KEY_STATUS_CODES:
+                    self._open(key, stats, BREAKER_MAX_COOLDOWN_SECONDS)
+                elif stats.consecutive_failures >= BREAKER_FAILURE_THRESHOLD:
+                    self._open(key, stats, stats.cooldown)
+        self._export()
+        self._report(status_code, None, error)
+
+    def _report(self, status_code, latency, error=None):
+        if not self.on_result:
+            return
+        try:
+            self.on_result(status_code, latency, error)
+        except Exception as e:
+            logger.error(f"[KEY POOL] on_result hook failed: {e}")
+
+    def release(self, key):
+        """A task submitted on this key reached a final state."""
+        if not key:
+            return
+        with self._lock:
+            stats = self._get(key)
+            stats.in_flight = max(0, stats.in_flight - 1)
+
+    def in_flight(self, key):
+        with self._lock:
+            stats = self._stats.get(key)
+            return stats.in_flight if stats else 0
+
+    def _describe(self, stats):
+        return {
+            "state": stats.state,
+            "in_flight": stats.in_flight,
+            "submitted": stats.submitted,
+            "recent_429": len(stats.throttles),
+            "recent_errors": len(stats.errors),
+            "consecutive_failures": stats.consecutive_failures,
+            "open_until": stats.open_until if stats.state != CLOSED else None,
+            "last_error": stats.last_error,
+            "latency_ms": int((stats.latency_ewma or 0) * 1000),
+        }
+
+    def snapshot(self):
+        """Per-key stats for logging / monitoring, keyed by key fingerprint (hints of different keys can collide)."""
+        now = time.time()
+        with self._lock:
+            out = {}
+            for key, stats in self._stats.items():
+                stats.prune(now)
+                out[key_fingerprint(key)] = {"key_hint": key_hint(key), **self._describe(stats)}
+            return out
+
+
+# Shared pool used by the worker and the poll jobs (same process)
+key_pool = KeyPool()
+
+# Users' own keys (BYOK lane) are accounted separately so they never
+# influence scheduling of the shared api_groups keys.
+byok_pool = KeyPool()
+
+
+def get_pool(lane):
+    """Key pool for a generation lane ('shared' or 'byok')."""
+    return byok_pool if lane == "byok" else key_pool
@@ -1,5 +1,7 @@
 import os
+import time
 import logging
+import signal
 import asyncio
 from datetime import datetime
 from dotenv import load_dotenv
@@ -21,22 +23,40 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     CallbackQueryHandler,
+    TypeHandler,
     filters,
 )
-from supabase import create_client, Client
-from r2_helper import R2Helper
-from generation_helper import poll_status, finalize_generation
+from clients import supabase, get_r2
+from generation_helper import get_lane
+from providers import supports_model
 from queue_worker import worker_loop
-from scripts.bot_cooldown_logic import check_cooldown, update_user_cooldown
+from scripts.bot_cooldown_logic import claim_cooldown_slot, release_cooldown_slot
+from update_processor import PerChatUpdateProcessor
+from bot_persistence import persistence_from_env, SyncedConversationHandler
+from model_catalog import catalog as model_catalog
+from idempotency import drop_duplicate_callbacks, enqueue_key, EnqueueGuard, is_duplicate_key_error
+from queue_index import queue_index, queue_message, update_queue_positions, QUEUE_UPDATE_SECONDS
+from admission import (
+    AdmissionController, ADMIT, DEFER, REJECT, OFF_PEAK_CHECK_SECONDS, OFF_PEAK_MAX_WAIT_SECONDS,
+)
+from session_cache import SessionCache, refresh_sessions, SESSION_REFRESH_SECONDS, BOT_SESSION_EPOCH
+from session_state import (
+    ChatSession, touch_session, evict_idle_sessions,
+    SESSION_SWEEP_SECONDS, CONVERSATION_TIMEOUT_SECONDS,
+)
+from webhook_server import WebhookServer, WEBHOOK_URL, WEBHOOK_SECRET
 
 # --- Configuration ---
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")  # Optional: local Bot API server (or a fake one in scripts/)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # "polling" or "webhook" (several replicas)
+RUN_WORKER = os.getenv("RUN_WORKER", "1") == "1"  # Queue worker in this process
 
-# Initialize Clients
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-r2 = R2Helper()
+# Initialize Clients (shared with queue_worker / generation_helper, created on first use; see clients.py)
+r2 = get_r2()
+session_cache = SessionCache(supabase)
+admission_control = AdmissionController(supabase, queue_index)
+enqueue_guard = EnqueueGuard()
 
 # Logging
 logging.basicConfig(
@@ -54,32 +74,38 @@ logger = logging.getLogger(__name__)
     CONFIRM_CREDIT,     # Confirming pro credit usage
     AWAITING_MEDIA,     # Waiting for image upload
     SELECTING_RATIO,    # Choosing aspect ratio
-) = range(8)
+    CONFIRM_QUEUE,      # Queue long / full: queue anyway, queue when quiet, or cancel
+) = range(9)
 
 # --- Helpers ---
 
 def get_user(chat_id):
-    """Fetch user by telegram_id and verify active session."""
+    """Fetch the full user row by telegram_id and verify active session (views showing profile fields)."""
     try:
         res = supabase.table("users").select("*").eq("telegram_id", str(chat_id)).execute()
         if res.data:
             user = res.data[0]
             # Single Session Check: strict enforcement
-            if user.get("active_platform") != 'telegram':
+            if not session_cache.remember(chat_id, user):
                 return None 
             return user
+        session_cache.forget_chat(chat_id)
         return None
     except Exception as e:
         logger.error(f"Error fetching user: {e}")
         return None
 
-def get_active_models():
-    """Fetch models active for telegram."""
+def get_session(chat_id):
+    """Cheap session check (memory, see session_cache.py). Returns a SessionEntry or None."""
     try:
-        res = supabase.table("ai_models").select("*").eq("is_active_telegram", True).order("sort_order").execute()
-        return res.data if res.data else []
-    except:
-        return []
+        return session_cache.validate(chat_id)
+    except Exception as e:
+        logger.error(f"Error validating session: {e}")
+        return None
+
+def get_active_models():
+    """Fetch models active for telegram (only those a provider backend can serve)."""
+    return [m for m in model_catalog.active_for_telegram() if supports_model(m['model_id'])]
 
 def build_menu(buttons, n_cols, header_buttons=None, footer_buttons=None):
     """Helper to build menu grid."""
@@ -166,11 +192,15 @@ async def handle_login(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
             return ConversationHandler.END # End session
             
         # 3. Update Session (Force Login)
-        supabase.table("users").update({
+        login_res = supabase.table("users").update({
             "active_platform": "telegram",
             "telegram_id": str(chat_id),
+            "bot_session_epoch": BOT_SESSION_EPOCH,
             "last_login_at": "now()"
         }).eq("id", user['id']).execute()
+        if login_res.data:
+            user = login_res.data[0]  # Carries the new session_epoch
+        session_cache.remember(chat_id, user)
         
         # 4. Logic Tier 'Ultra' -> Minta Base API Key
         # If user is ultra, we check if they have custom key. If not, force input.
@@ -286,8 +316,8 @@ async def dashboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     data = query.data
     
     chat_id = query.message.chat.id
-    user = get_user(chat_id)
-    if not user:
+    session = get_session(chat_id)
+    if not session:
         await query.message.reply_text("⚠️ Session expired.")
         return await start(update, context)
 
@@ -303,7 +333,7 @@ async def dashboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             
         # Build Model Grid with Dynamic Pricing
         buttons = []
-        user_type = user.get('type', 'try').lower()
+        user_type = session.user_type
         for m in models:
             # Strict DB Pricing with Legacy Fallback
             # If cost_pro_5s is missing, try cost_pro, then credit_cost (legacy default from existing dashboard)
@@ -335,7 +365,10 @@ async def dashboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return SELECTING_MODEL
         
     elif data == "menu_check_balance":
-        # Show balance details
+        # Show balance details (needs the full profile)
+        user = get_user(chat_id)
+        if not user:
+            return await show_dashboard(update, context)
         credits = user.get('credits', 0)
         tier = user.get('type', 'Unknown').upper()
         
@@ -364,7 +397,7 @@ async def dashboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return DASHBOARD
         
     elif data == "back_to_dash":
-        return await show_dashboard(update, context, user)
+        return await show_dashboard(update, context)
 
     elif data == "menu_logout":
         # Logika Tombol Keluar
@@ -372,7 +405,8 @@ async def dashboard_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             supabase.table("users").update({
                 "active_platform": "web",
                 "telegram_id": None
-            }).eq("id", user['id']).execute()
+            }).eq("id", session.user_id).execute()
+            session_cache.forget_user(session.user_id)
             
             await query.message.delete()
             await query.message.reply_text("✅ **Anda telah keluar.**\nTerima kasih telah menggunakan layanan kami.")
@@ -394,24 +428,17 @@ async def select_model_callback(update: Update, context: ContextTypes.DEFAULT_TY
     data = query.data
     
     if data == "back_to_dash":
-        user = get_user(query.message.chat.id)
-        return await show_dashboard(update, context, user)
+        return await show_dashboard(update, context)
     
     model_id = data.replace("model_", "")
-    context.user_data['selected_model_id'] = model_id
+    context.user_data.model_id = model_id
     
     # Fetch model info for dynamic pricing
     chat_id = query.message.chat.id
-    user = get_user(chat_id)
-    user_type = user.get('type', 'try').lower() if user else 'try'
+    session = get_session(chat_id)
+    user_type = session.user_type if session else 'try'
     
-    try:
-        model_res = supabase.table("ai_models").select("*").eq("model_id", model_id).execute()
-        model_info = model_res.data[0] if model_res.data else {}
-        context.user_data['selected_model_info'] = model_info
-    except:
-        model_info = {}
-        context.user_data['selected_model_info'] = {}
+    model_info = model_catalog.get(model_id) or {}
     
     # Get pricing from DB
     cost_5s = model_info.get('cost_pro_5s', model_info.get('cost_pro', 0)) or 0
@@ -462,11 +489,11 @@ async def select_duration_callback(update: Update, context: ContextTypes.DEFAULT
         return await dashboard_callback(update, context)
 
     duration = data.replace("dur_", "")
-    context.user_data['selected_duration'] = duration
+    context.user_data.duration = duration
     
     chat_id = query.message.chat.id
     user = get_user(chat_id)
-    model_id = context.user_data.get('selected_model_id')
+    model_id = context.user_data.model_id
     
     # Strict DB Pricing - No Hardcoded Defaults
     # Fetch FRESH model info to ensure real-time sync with Admin Dashboard
@@ -491,7 +518,7 @@ async def select_duration_callback(update: Update, context: ContextTypes.DEFAULT
     else:  # 10 seconds or others
         cost = cost_10s
     
-    context.user_data['calculated_cost'] = cost
+    context.user_data.cost = cost
     
     # Skip confirmation if cost is 0 (Free) or Unlimited User
     if user_type in ['ultra', 'unlimited'] or cost == 0:
@@ -532,7 +559,7 @@ async def handle_credit_confirmation(update: Update, context: ContextTypes.DEFAU
     if data == "confirm_yes":
         # Check balance again
         user = get_user(query.message.chat.id)
-        cost = context.user_data.get('calculated_cost', 0)
+        cost = context.user_data.cost
         
         if user.get('credits', 0) < cost:
             await query.edit_message_text(
@@ -575,7 +602,7 @@ async def ask_aspect_ratio(update_or_query, context):
     if data == "confirm_yes":
         # Check balance again
         user = get_user(query.message.chat.id)
-        cost = context.user_data.get('calculated_cost', 0)
+        cost = context.user_data.cost
         
         if user.get('credits', 0) < cost:
             await query.edit_message_text(
@@ -619,7 +646,7 @@ async def handle_ratio_selection(update: Update, context: ContextTypes.DEFAULT_T
     
     data = query.data
     ratio = data.replace("ratio_", "") if data.startswith("ratio_") else "16:9"
-    context.user_data['selected_ratio'] = ratio
+    context.user_data.ratio = ratio
     
     # Next: Request Media
     return await request_media(query, context)
@@ -627,7 +654,8 @@ async def handle_ratio_selection(update: Update, context: ContextTypes.DEFAULT_T
 async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Process Media and Prompt, Create Task."""
     chat_id = update.effective_chat.id
-    user = get_user(chat_id)
+    # Blocking DB / R2 calls run in a thread so other chats keep being served
+    user = await asyncio.to_thread(get_user, chat_id)
     
     if not user:
         await update.message.reply_text("Session Expired. /start")
@@ -635,31 +663,19 @@ async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # ====== LOCK PRO CHECK (Anti-Spam) ======
     user_type = user.get('type', 'try').lower()
-    model_id = context.user_data.get('selected_model_id')
-
-    # ====== COOLDOWN CHECK ======
-    if user_type in ['pro', 'unlimited', 'ultra']:
-        is_allowed, msg = await check_cooldown(
-            supabase_client=supabase,
-            user_id=user['id'],
-            user_type=user_type,
-            model_name=model_id
-        )
-
-        if not is_allowed:
-            await update.message.reply_text(msg, parse_mode='Markdown')
-            return await show_dashboard(update, context, user)
-    # ====== END COOLDOWN CHECK ======
+    model_id = context.user_data.model_id
 
     # ====== LOCK PRO CHECK (Anti-Spam) ======
     if user_type == 'pro':
         # Check for active processing tasks
         try:
-            processing_res = supabase.table("generations") \
-                .select("id", count="exact") \
-                .eq("user_id", user['id']) \
-                .eq("status", "processing") \
-                .execute()
+            processing_res = await asyncio.to_thread(
+                supabase.table("generations")
+                .select("id", count="exact")
+                .eq("user_id", user['id'])
+                .eq("status", "processing")
+                .execute
+            )
             
             processing_count = processing_res.count if processing_res.count else 0
             
@@ -679,6 +695,11 @@ async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("⚠️ Harap kirimkan format **Foto**.")
         return AWAITING_MEDIA
         
+    if not supports_model(model_id):
+        # Reject here, not when the worker submits (stale menu button / model removed meanwhile)
+        await update.message.reply_text("❌ Model ini sudah tidak tersedia. Silakan pilih model lain.")
+        return await show_dashboard(update, context, user)
+
     photo = update.message.photo[-1]
     prompt = update.message.caption or ""
     
@@ -686,73 +707,165 @@ async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("⚠️ **Caption** (prompt) wajib diisi! Silakan kirim ulang foto + caption.")
         return AWAITING_MEDIA
 
+    # ====== ADMISSION (before download / upload) ======
+    # Real queue depth + ETA from live worker throughput; long queue -> ask, full queue -> offer a quiet slot
+    admission = await asyncio.to_thread(
+        admission_control.check, context.application.bot_data.get("queue_worker"), get_lane(user)
+    )
+    if admission.action != ADMIT:
+        session = context.user_data
+        session.pending_photo = photo.file_id
+        session.pending_photo_unique_id = photo.file_unique_id
+        session.pending_prompt = prompt
+        await update.message.reply_text(
+            admission_message(admission), parse_mode='Markdown', reply_markup=admission_buttons(admission)
+        )
+        return CONFIRM_QUEUE
+    # ====== END ADMISSION ======
+
+    request = queue_request(context.user_data, photo.file_id, photo.file_unique_id, prompt)
+    if await enqueue_generation(context.bot, chat_id, user, request, admission, reply_to=update.message):
+        return ConversationHandler.END
+    return await show_dashboard(update, context, user)
+
+def queue_request(session, photo_file_id, photo_unique_id, prompt):
+    """Snapshot of what enqueue_generation needs (the session may change before a quiet-slot job runs)."""
+    return {
+        "model_id": session.model_id,
+        "duration": session.duration,
+        "ratio": session.ratio,
+        "cost": session.cost,
+        "photo_file_id": photo_file_id,
+        "photo_unique_id": photo_unique_id,
+        "prompt": prompt,
+    }
+
+def admission_message(admission):
+    eta = admission.eta_text()
+    if admission.action == REJECT:
+        return (
+            f"🚫 **Antrean sedang penuh**\n\n"
+            f"Ada {admission.depth} tugas menunggu{f' ({eta})' if eta else ''}. Tugas baru belum bisa diterima.\n\n"
+            f"Biarkan bot memasukkan tugas Anda otomatis saat antrean lebih sepi "
+            f"(maks {OFF_PEAK_MAX_WAIT_SECONDS // 3600} jam)?"
+        )
+    return (
+        f"⚠️ **Antrean sedang panjang**\n\n"
+        f"Posisi Anda: {admission.position}\n"
+        + (f"Perkiraan mulai: {eta}\n" if eta else "")
+        + "\nTetap antre sekarang, atau biarkan bot memasukkan tugas Anda otomatis saat antrean lebih sepi?"
+    )
+
+DUPLICATE_TASK_TEXT = "⚠️ **Tugas yang sama sudah ada di antrean.**\nFoto, prompt dan pengaturannya sama, jadi tidak dibuat (dan tidak ditagih) dua kali."
+
+def admission_buttons(admission):
+    buttons = []
+    if admission.action == DEFER:
+        buttons.append([InlineKeyboardButton("✅ Tetap Antre", callback_data="queue_now")])
+    buttons.append([InlineKeyboardButton("⏰ Antre Saat Sepi", callback_data="queue_quiet")])
+    buttons.append([InlineKeyboardButton("❌ Batal", callback_data="cancel_upload")])
+    return InlineKeyboardMarkup(buttons)
+
+async def enqueue_generation(bot, chat_id, user, request, admission, reply_to=None):
+    """
+    Duplicate check, cooldown slot, photo download, R2 upload, insert into generations.
+    Returns True when the task was created or already exists (errors are reported to the chat).
+    """
+    model_id = request["model_id"]
+    duration = request["duration"]
+    user_type = user.get('type', 'try').lower()
+
+    async def say(text, **kwargs):
+        if reply_to:
+            return await reply_to.reply_text(text, **kwargs)
+        return await bot.send_message(chat_id, text, **kwargs)
+
+    if not model_id or not duration:
+        logger.error(f"[TELEGRAM] Missing session data (Model: {model_id}, Dur: {duration})")
+        await say("❌ Data sesi hilang. Silakan ulangi dari menu utama.")
+        return False
+
+    # Same photo + prompt + settings again (re-sent / double-sent): nothing to download, upload or charge
+    key = enqueue_key(user['id'], request.get("photo_unique_id"), request["prompt"], model_id, duration, request["ratio"])
+    if not enqueue_guard.claim(key):
+        logger.info(f"[IDEMPOTENCY] Duplicate enqueue for user {user['id']} (Model: {model_id}) skipped")
+        await say(DUPLICATE_TASK_TEXT, parse_mode='Markdown')
+        return True
+
+    # ====== COOLDOWN CHECK ======
+    # Atomic check + increment (one RPC); released again if the task is not created
+    cooldown_claimed = False
+    cooldown_slot = None
+    if user_type in ['pro', 'unlimited', 'ultra']:
+        is_allowed, cooldown_msg, cooldown_slot = await claim_cooldown_slot(
+            supabase_client=supabase,
+            user_id=user['id'],
+            user_type=user_type,
+            model_name=model_id
+        )
+
+        if not is_allowed:
+            enqueue_guard.release(key)
+            await say(cooldown_msg, parse_mode='Markdown')
+            return False
+        cooldown_claimed = True
+    # ====== END COOLDOWN CHECK ======
+
     # Prepare Task
-    msg = await update.message.reply_text("🚀 Menyiapkan tugas...")
+    msg = await say("🚀 Menyiapkan tugas...")
     
     try:
         # Upload Image
         await msg.edit_text("⏳ Mengunggah media...")
-        file = await context.bot.get_file(photo.file_id)
+        file = await bot.get_file(request["photo_file_id"])
         photo_bytes = await file.download_as_bytearray()
         
-        chat_id = update.effective_chat.id
         file_name = f"tele_{chat_id}_{int(datetime.now().timestamp())}.jpg"
-        image_url = r2.upload_bytes(photo_bytes, file_name, content_type='image/jpeg')
+        image_url = await asyncio.to_thread(r2.upload_bytes, photo_bytes, file_name, content_type='image/jpeg')
         
         if not image_url:
             logger.error(f"[TELEGRAM] Failed to upload image for chat_id {chat_id}")
+            if cooldown_claimed:
+                await release_cooldown_slot(supabase, user['id'], model_id, cooldown_slot)
+            enqueue_guard.release(key)
             await msg.edit_text("❌ Gagal upload media.")
-            return await show_dashboard(update, context, user)
+            return False
             
         logger.info(f"[TELEGRAM] Image uploaded to R2: {image_url}")
 
-        # Retrieve context data
-        model_id = context.user_data.get('selected_model_id')
-        duration = context.user_data.get('selected_duration')
-        ratio = context.user_data.get('selected_ratio', '16:9')
-
-        if not model_id or not duration:
-            logger.error(f"[TELEGRAM] Missing session data (Model: {model_id}, Dur: {duration})")
-            await msg.edit_text("❌ Data sesi hilang. Silakan ulangi dari menu utama.")
-            return await show_dashboard(update, context, user)
-
         # Prepare final payload for generations table (serving as queue)
+        lane = get_lane(user)
         gen_data = {
             "user_id": user["id"],
-            "prompt": prompt,
+            "prompt": request["prompt"],
             "status": "pending",
             "source": "telegram",
             "thumbnail_url": image_url, # file_url in tasks -> thumbnail_url in generations
             "telegram_chat_id": str(chat_id),
             "model_name": model_id,
-            "aspect_ratio": ratio,
+            "aspect_ratio": request["ratio"],
+            "lane": lane, # byok = user's own API key, not the shared pool
+            "idempotency_key": key, # unique while pending / processing
             "options": {
                 "duration": duration, 
                 "msg_id": msg.message_id,
-                "credits_used": context.user_data.get('calculated_cost', 0)
+                "credits_used": request["cost"]
             },
             "created_at": "now()"
         }
         
         # Attempt Insert into generations
-        supabase.table("generations").insert(gen_data).execute()
-        logger.info(f"[TELEGRAM] Task inserted into generations for user {user['id']} (Model: {model_id})")
-
-        # Update Cooldown Count
-        await update_user_cooldown(supabase, user['id'], model_id)
-        
-        # Update message to "Queued" state, this message will be picked up by worker
-        await msg.edit_text(
-            f"⏳ **Antrian...**\n"
-            f"Posisi: 1\n"
-            f"Model: {model_id}\n"
-            f"Mohon tunggu sebentar...",
-            parse_mode='Markdown'
-        )
-        return ConversationHandler.END
-        
+        res = await asyncio.to_thread(supabase.table("generations").insert(gen_data).execute)
     except Exception as e:
+        if cooldown_claimed:
+            await release_cooldown_slot(supabase, user['id'], model_id, cooldown_slot)
+        if is_duplicate_key_error(e):
+            # Enqueued by another replica / before a restart: the existing row is the task
+            logger.info(f"[IDEMPOTENCY] Duplicate enqueue for user {user['id']} rejected by the database")
+            await msg.edit_text(DUPLICATE_TASK_TEXT, parse_mode='Markdown')
+            return True
         logger.error(f"Task Creation Error: {e}")
+        enqueue_guard.release(key)
         err_msg = str(e)
         if "aspect_ratio" in err_msg and "column" in err_msg:
              await msg.edit_text(f"❌ **Error Database:** Kolom 'aspect_ratio' tidak ditemukan di tabel tasks. Mohon lapor admin.")
@@ -760,114 +873,111 @@ async def handle_media_upload(update: Update, context: ContextTypes.DEFAULT_TYPE
              await msg.edit_text(f"❌ **Error Database:** Kolom 'options' tidak ditemukan di tabel tasks. Mohon lapor admin.")
         else:
              await msg.edit_text(f"❌ Gagal membuat tugas: {e}")
-        return await show_dashboard(update, context, user)
+        return False
 
-async def poll_status_job(context: ContextTypes.DEFAULT_TYPE):
-    """Update loading visuals and handle final video."""
-    job = context.job
-    d = job.data
-    
-    elapsed = int((datetime.now() - d["start_time"]).total_seconds())
-    # Visual Progress (Fake but satisfying)
-    progress = min(98, (elapsed * 2)) 
-    bar = "▓" * (progress // 10) + "░" * (10 - (progress // 10))
-    
+    # The task exists from here on: keep the guard (a retap is a duplicate) and the cooldown slot,
+    # and never report the enqueue as failed
+    logger.info(f"[TELEGRAM] Task inserted into generations for user {user['id']} (Model: {model_id})")
+    position = admission.position
     try:
-        status, video_url = poll_status(d["task_id"], d["model_id"], d["used_key"])
-        
-        if status == "completed" and video_url:
-            await context.bot.edit_message_text(
-                f"✅ **Video Selesai!** ({elapsed}s)\nSedang memproses file akhir...",
-                chat_id=d["chat_id"], message_id=d["msg_id"], parse_mode='Markdown'
-            )
-            
-            # Finalize (Upload Video to R2 + Update DB)
-            # R2 upload might take time, careful with job timeout? 
-            # Ideally run in thread, but for now await is ok.
-            video_name = f"gen_video_{d['gen_id']}.mp4"
-            r2_video_url = r2.upload_from_url(video_url, video_name, content_type='video/mp4')
-            
-            finalize_generation(d["gen_id"], video_url, d["user_id"], r2_video_url)
-            
-            final_url = r2_video_url or video_url
-            
-            # ====== POST-GENERATE SUMMARY ======
-            # Fetch credits_used from generation record and updated user balance
-            credits_used = d.get("credits_used", 0)
-            try:
-                updated_user = supabase.table("users").select("credits, type").eq("id", d["user_id"]).execute()
-                if updated_user.data:
-                    new_credits = updated_user.data[0].get('credits', 0)
-                    user_type = updated_user.data[0].get('type', '').lower()
-                else:
-                    new_credits = 0
-                    user_type = ''
-            except:
-                new_credits = 0
-                user_type = ''
-            
-            # Build caption with cost summary
-            caption = (
-                f"🎬 **Video UniverseAI**\n"
-                f"Model: `{d['model_id']}`\n"
-                f"Prompt: \"{d['prompt'][:50]}{'...' if len(d['prompt']) > 50 else ''}\"\n\n"
-                f"─────────────────\n"
-            )
-            
-            if user_type in ['ultra', 'unlimited']:
-                caption += f"💰 **Biaya:** Gratis (Unlimited)\n"
-            else:
-                caption += f"💰 **Biaya:** {credits_used} 🪙\n"
-                caption += f"💎 **Sisa Saldo:** {new_credits} 🪙\n"
-            
-            caption += "─────────────────"
-            
-            # Build buttons for post-generate actions
-            post_buttons = InlineKeyboardMarkup([
-                [InlineKeyboardButton("🎬 Buat Video Lagi", callback_data="menu_create")],
-                [InlineKeyboardButton("📥 Download File", callback_data=f"dl_{d['gen_id']}")]
-            ])
-            # ====== END POST-GENERATE ======
-            
-            # Send Final Video with Summary
-            await context.bot.send_video(
-                chat_id=d["chat_id"], 
-                video=final_url, 
-                caption=caption,
-                parse_mode='Markdown',
-                reply_markup=post_buttons
-            )
-            job.schedule_removal()
-            return
+        if lane == "shared":
+            admission_control.note_enqueued()
+            if res.data and queue_index.is_fresh():
+                # Ordered index: real position now, updated by update_queue_positions while it waits
+                position = queue_index.add(res.data[0]) or position
+    except Exception as e:
+        logger.warning(f"[QUEUE] Could not index new task for user {user['id']}: {e}")
+
+    try:
+        # Update message to "Queued" state, this message will be picked up by worker
+        await msg.edit_text(queue_message(position, admission.eta_seconds, model_id), parse_mode='Markdown')
+    except Exception as e:
+        logger.warning(f"[TELEGRAM] Could not show queue message for user {user['id']}: {e}")
+    return True
+
+async def handle_queue_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Queue long / full (see admission.py): queue anyway, queue when quiet, or cancel."""
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat.id
+    session = context.user_data
+
+    if query.data == "cancel_upload" or not session.pending_photo:
+        session.pending_photo = session.pending_photo_unique_id = session.pending_prompt = None
+        return await cancel_handler(update, context)
+
+    user = await asyncio.to_thread(get_user, chat_id)
+    if not user:
+        await query.message.reply_text("Session Expired. /start")
+        return ConversationHandler.END
+
+    request = queue_request(session, session.pending_photo, session.pending_photo_unique_id, session.pending_prompt)
+    session.pending_photo = session.pending_photo_unique_id = session.pending_prompt = None
+    await query.edit_message_reply_markup(reply_markup=None)
 
-        elif status == "failed":
-            await context.bot.edit_message_text(f"❌ Gagal: {video_url}", chat_id=d["chat_id"], message_id=d["msg_id"])
+    if query.data == "queue_quiet":
+        # One waiting request per chat; the job is in memory only (lost on restart, the user is told to retry)
+        for job in context.job_queue.get_jobs_by_name(f"queue_quiet_{chat_id}"):
             job.schedule_removal()
-            return
-            
-        # Update progress visual
-        # Only update every few checks to avoid rate limit?
-        # PTB handles throttle automatically mostly, but good to be safe.
-        await context.bot.edit_message_text(
-            f"🎬 **Video sedang di-generate...**\n\n`[{bar}] {progress}%`\nWaktu berjalan: {elapsed} detik",
-            chat_id=d["chat_id"], message_id=d["msg_id"], parse_mode='Markdown'
+        request["deadline"] = time.time() + OFF_PEAK_MAX_WAIT_SECONDS
+        context.job_queue.run_repeating(
+            queue_when_quiet, interval=OFF_PEAK_CHECK_SECONDS, first=OFF_PEAK_CHECK_SECONDS,
+            data=request, name=f"queue_quiet_{chat_id}", chat_id=chat_id
         )
+        await query.message.reply_text(
+            "⏰ **Oke!** Tugas Anda akan otomatis masuk antrean saat antrean lebih sepi. "
+            "Kami kabari di chat ini.",
+            parse_mode='Markdown'
+        )
+        return await show_dashboard(update, context, user)
 
-    except Exception as e:
-        logger.error(f"Poll Job Error: {e}")
-        # Don't remove job, try again next tick unless critical
+    # queue_now: the queue may have filled up since the question
+    admission = await asyncio.to_thread(
+        admission_control.check, context.application.bot_data.get("queue_worker"), get_lane(user)
+    )
+    if admission.action == REJECT:
+        session.pending_photo, session.pending_prompt = request["photo_file_id"], request["prompt"]
+        session.pending_photo_unique_id = request["photo_unique_id"]
+        await query.message.reply_text(
+            admission_message(admission), parse_mode='Markdown', reply_markup=admission_buttons(admission)
+        )
+        return CONFIRM_QUEUE
+    if await enqueue_generation(context.bot, chat_id, user, request, admission):
+        return ConversationHandler.END
+    return await show_dashboard(update, context, user)
+
+async def queue_when_quiet(context: ContextTypes.DEFAULT_TYPE):
+    """Repeating job per waiting request: enqueue once admission says ADMIT, give up after OFF_PEAK_MAX_WAIT_SECONDS."""
+    job = context.job
+    request = job.data
+    if time.time() > request["deadline"]:
+        job.schedule_removal()
+        await context.bot.send_message(
+            job.chat_id, "⌛ Antrean masih penuh, tugas Anda dibatalkan. Silakan coba lagi nanti."
+        )
+        return
+
+    admission = await asyncio.to_thread(admission_control.check, context.application.bot_data.get("queue_worker"))
+    if admission.action != ADMIT:
+        return
+    job.schedule_removal()
+    user = await asyncio.to_thread(get_user, job.chat_id)
+    if not user:
+        await context.bot.send_message(job.chat_id, "Session Expired. /start")
+        return
+    await enqueue_generation(context.bot, job.chat_id, user, request, admission)
 
 async def cancel_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Generic cancel."""
-    user = get_user(update.effective_chat.id if update.effective_chat else update.callback_query.message.chat.id)
+    session = get_session(update.effective_chat.id if update.effective_chat else update.callback_query.message.chat.id)
     if update.callback_query:
         await update.callback_query.answer()
         await update.callback_query.message.reply_text("❌ Dibatalkan.")
     else:
         await update.message.reply_text("❌ Dibatalkan.")
         
-    if user:
-        return await show_dashboard(update, context, user)
+    if session:
+        return await show_dashboard(update, context)
     return ConversationHandler.END
 
 async def download_video_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -916,31 +1026,74 @@ async def download_video_file(update: Update, context: ContextTypes.DEFAULT_TYPE
 # --- Main Setup ---
 
 async def post_init(application):
-    """Force logout all telegram users on startup."""
-    logger.info("Executing Force Logout (Resetting active_platform)...")
-    try:
-        supabase.table("users").update({"active_platform": "web"}).eq("active_platform", "telegram").execute()
-        logger.info("Force logout complete.")
-    except Exception as e:
-        logger.error(f"Post-init failed: {e}")
-        
+    """Startup tasks. Sessions are kept across restarts: stale ones (older
+    BOT_SESSION_EPOCH) are ended per user on access, see session_cache.py."""
+    started = time.time()
+    logger.info(f"Session epoch {BOT_SESSION_EPOCH} (no startup logout)")
+
+    # First ai_models load off the event loop; later reloads run in the background (model_catalog.py)
+    await asyncio.to_thread(model_catalog.refresh)
+
     # Start Background Worker
-    # running on the same loop as the bot
-    asyncio.create_task(worker_loop(application))
-    logger.info("Background Worker Started via post_init.")
+    # running on the same loop as the bot (only one replica needs it, see RUN_WORKER)
+    if RUN_WORKER:
+        asyncio.create_task(worker_loop(application))
+        logger.info("Background Worker Started via post_init.")
+    logger.info(f"post_init done in {int((time.time() - started) * 1000)} ms")
+
+async def run_webhook_replica(application, persistence):
+    """Serve updates posted by Telegram or webhook_router.py instead of polling."""
+    server = WebhookServer(
+        application,
+        on_handover=persistence.mark_stale if persistence else None
+    )
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        await post_init(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES)
+            logger.info(f"Webhook registered: {WEBHOOK_URL}")
+        await application.start()
+        await server.start()
+        try:
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await application.stop()
 
 if __name__ == "__main__":
     if not TELEGRAM_BOT_TOKEN:
         print("Error: TELEGRAM_BOT_TOKEN not found.")
         exit(1)
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        # Without it anyone who finds the URL can post updates as any user
+        print("Error: WEBHOOK_SECRET is required in webhook mode.")
+        exit(1)
         
-    application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).build()
-    
-    # Attach Poll Job to Application for Worker access
-    application.bot_data["poll_status_callback"] = poll_status_job
+    # Conversation state survives restarts and is shared between replicas (BOT_PERSISTENCE, see bot_persistence.py)
+    persistence = persistence_from_env(supabase, user_data_type=ChatSession)
+
+    # Updates from different chats run concurrently, each chat stays in order
+    # (MAX_CONCURRENT_UPDATES / MAX_PENDING_UPDATES, see update_processor.py)
+    builder = ApplicationBuilder() \
+        .token(TELEGRAM_BOT_TOKEN) \
+        .concurrent_updates(PerChatUpdateProcessor()) \
+        .context_types(ContextTypes(user_data=ChatSession)) \
+        .post_init(post_init)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL.rstrip('/')}/bot")
+    if persistence:
+        builder = builder.persistence(persistence)
+    if BOT_MODE == "webhook":
+        builder = builder.updater(None)  # Updates arrive through WebhookServer
+    application = builder.build()
     
     # Conversation Handler
-    conv_handler = ConversationHandler(
+    conv_handler = SyncedConversationHandler(
         entry_points=[
             CommandHandler("start", start),
             CallbackQueryHandler(download_video_file, pattern="^dl_"),
@@ -960,12 +1113,35 @@ if __name__ == "__main__":
                 MessageHandler(filters.PHOTO, handle_media_upload),
                 CallbackQueryHandler(cancel_handler, pattern="^cancel_upload$")
             ],
-            SELECTING_RATIO: [CallbackQueryHandler(handle_ratio_selection)]
+            SELECTING_RATIO: [CallbackQueryHandler(handle_ratio_selection)],
+            CONFIRM_QUEUE: [CallbackQueryHandler(handle_queue_choice, pattern="^(queue_now|queue_quiet|cancel_upload)$")]
         },
-        fallbacks=[CommandHandler("start", start), CommandHandler("cancel", cancel_handler)]
+        fallbacks=[CommandHandler("start", start), CommandHandler("cancel", cancel_handler)],
+        name="main_conversation",
+        persistent=persistence is not None,
+        conversation_timeout=CONVERSATION_TIMEOUT_SECONDS
     )
     
     application.add_handler(conv_handler)
+    application.add_handler(TypeHandler(Update, touch_session), group=-1)
+    # Before everything else (incl. the persistence sync): a double-tapped button runs its handler once
+    application.add_handler(CallbackQueryHandler(drop_duplicate_callbacks), group=-3)
+    if persistence:
+        application.add_handler(persistence.sync_handler(conv_handler), group=-2)
+    application.job_queue.run_repeating(
+        refresh_sessions, interval=SESSION_REFRESH_SECONDS, first=SESSION_REFRESH_SECONDS, data=session_cache
+    )
+    if RUN_WORKER:
+        # Position / ETA edits for waiting tasks; claims are only seen instantly next to the worker
+        application.job_queue.run_repeating(
+            update_queue_positions, interval=QUEUE_UPDATE_SECONDS, first=QUEUE_UPDATE_SECONDS, data=queue_index
+        )
+    application.job_queue.run_repeating(
+        evict_idle_sessions, interval=SESSION_SWEEP_SECONDS, first=SESSION_SWEEP_SECONDS, data=conv_handler
+    )
     
-    print("🚀 UniverseAI Bot Started (Tier System Active)...")
-    application.run_polling()
+    print(f"🚀 UniverseAI Bot Started (Tier System Active, {BOT_MODE})...")
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook_replica(application, persistence))
+    else:
+        application.run_polling()
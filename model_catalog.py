@@ -0,0 +1,85 @@
+import time
+import logging
+import threading
+from clients import supabase
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+MODEL_CATALOG_TTL_SECONDS = 60  # ai_models changes from the admin dashboard show up within this
+MODEL_CATALOG_RETRY_SECONDS = 10  # After a failed background reload
+
+
+class ModelCatalog:
+    """
+    Process-wide cache of the ai_models table, refreshed every
+    MODEL_CATALOG_TTL_SECONDS. Sessions keep only a model_id and look the row
+    up here instead of each holding their own copy of it.
+
+    Lookups only read memory: once loaded, a stale catalog keeps being served
+    while a background thread reloads it, so callers on the event loop (bot
+    handlers, the queue worker's stages) never wait on the database. Only the
+    very first load blocks; call refresh() at startup (in a thread) to avoid it.
+    """
+
+    def __init__(self, client, ttl=MODEL_CATALOG_TTL_SECONDS):
+        self.client = client
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._reloading = threading.Lock()  # Held by the one background reload in flight
+        self._by_id = {}
+        self._ordered = []
+        self._loaded_at = 0
+        self._expires_at = 0
+
+    def refresh(self):
+        """Load ai_models now (blocking). Returns False when the query failed."""
+        with self._lock:
+            try:
+                res = self.client.table("ai_models").select("*").order("sort_order").execute()
+            except Exception as e:
+                # Keep serving the previous catalog
+                logger.error(f"[CATALOG] Failed to load ai_models: {e}")
+                if self._loaded_at:
+                    self._expires_at = time.time() + MODEL_CATALOG_RETRY_SECONDS
+                return False
+            self._ordered = res.data or []
+            # Ids are matched case-insensitively, as the old lower()-ing code did
+            self._by_id = {row["model_id"].lower(): row for row in self._ordered if row.get("model_id")}
+            self._loaded_at = time.time()
+            self._expires_at = self._loaded_at + self.ttl
+            return True
+
+    def _reload_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            self._reloading.release()
+
+    def _refresh_if_stale(self):
+        if time.time() < self._expires_at:
+            return
+        if not self._loaded_at:
+            # Nothing to serve yet
+            self.refresh()
+            return
+        if self._reloading.acquire(blocking=False):
+            threading.Thread(target=self._reload_in_background, name="catalog-reload", daemon=True).start()
+
+    def get(self, model_id):
+        """ai_models row for model_id (any case), or None."""
+        self._refresh_if_stale()
+        return self._by_id.get(model_id.lower()) if model_id else None
+
+    def active_for_telegram(self):
+        """Models enabled for the bot, in menu order."""
+        self._refresh_if_stale()
+        return [row for row in self._ordered if row.get("is_active_telegram")]
+
+    def invalidate(self):
+        """Reload on the next lookup (in the background once loaded)."""
+        self._expires_at = 0
+
+
+# One catalog per process, shared by the bot handlers and the queue worker
+catalog = ModelCatalog(supabase)
@@ -0,0 +1,545 @@
+"""
+Video generation backends and the routing between them.
+
+A backend knows how to build the request payload for a model, submit it,
+check its status and read the result. Which backend serves a model comes
+from its ai_models row (through the model catalog):
+
+    provider           primary backend (NULL = DEFAULT_PROVIDER, "freepik")
+    fallback_provider  backend used while the primary is saturated (optional)
+
+A backend is saturated when it refused a submission for capacity (429 on
+every key, or no usable key left); it is then tried after the fallback for
+SATURATION_HOLD_SECONDS. Other errors (bad payload, missing image) never fail
+over. BYOK tasks stay on the primary, since they run on the user's own key.
+
+    provider, task_id, used_key = submit_generation(user, model_id, prompt, image_url, duration, options, lane)
+    status, video_url = poll_generation(provider, task_id, model_id, used_key)
+
+Freepik requests are compiled per model at import (compile_routes: submit URL,
+status URL, payload builder), so submitting and polling are table lookups and
+a model without a route is rejected when the task is enqueued (supports_model).
+
+FakeBackend is a local stand-in (no network, limited capacity, fixed render
+time) for tests, simulations and throughput comparisons. Set
+PROVIDER_OVERRIDE=fake to run the whole bot against it.
+"""
+import os
+import time
+import logging
+import itertools
+import threading
+from clients import supabase, http_session
+from key_pool import key_pool, byok_pool, key_hint, is_key_failure
+from model_catalog import catalog
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+DEFAULT_PROVIDER = "freepik"
+PROVIDER_OVERRIDE = os.getenv("PROVIDER_OVERRIDE")  # Route every model to this backend (e.g. "fake" locally)
+SATURATION_HOLD_SECONDS = 15  # A saturated backend is tried after its fallback for this long
+
+FAKE_RENDER_SECONDS = float(os.getenv("FAKE_RENDER_SECONDS", "20"))
+FAKE_CAPACITY = int(os.getenv("FAKE_CAPACITY", "8"))  # Renders the fake backend accepts at once
+FAKE_SUBMIT_LATENCY = float(os.getenv("FAKE_SUBMIT_LATENCY", "0.2"))
+FAKE_VIDEO_URL = os.getenv("FAKE_VIDEO_URL")  # Returned for every fake render (default: a per-task placeholder)
+
+FREEPIK_API_BASE = "https://api.freepik.com/v1/ai"
+
+MODEL_ENDPOINTS = {
+    'kling-v2-1-std': {'endpoint': '/image-to-video/kling-v2-1-std', 'param': 'duration'},
+    'kling-v2-1-pro': {'endpoint': '/image-to-video/kling-v2-1-pro', 'param': 'duration'},
+    'kling-v2-5-pro': {'endpoint': '/image-to-video/kling-v2-5-pro', 'param': 'duration'},
+    'kling-v2-6-pro': {'endpoint': '/image-to-video/kling-v2-6-pro', 'param': 'duration'},
+    'kling-o1-std': {'endpoint': '/image-to-video/kling-o1-std', 'param': 'duration'},
+    'kling-o1-std-video-ref': {'endpoint': '/image-to-video/kling-elements-std', 'param': 'duration'},
+    'wan-v2-2-720p': {'endpoint': '/image-to-video/wan-v2-2-720p', 'param': 'duration', 'requiresHttps': True},
+    'wan-v2-6-720p': {'endpoint': '/image-to-video/wan-v2-6-720p', 'param': 'duration', 'requiresHttps': True},
+    'wan-v2-6-1080p': {'endpoint': '/image-to-video/wan-v2-6-1080p', 'param': 'duration', 'requiresHttps': True},
+    'minimax-hailuo-02-768p': {'endpoint': '/image-to-video/minimax-hailuo-02-768p', 'param': 'duration'},
+    'minimax-hailuo-02-1080p': {'endpoint': '/image-to-video/minimax-hailuo-02-1080p', 'param': 'duration'},
+    'minimax-hailuo-2-3-1080p': {'endpoint': '/image-to-video/minimax-hailuo-2-3-1080p', 'param': 'duration'},
+    'runway-gen4-turbo': {'endpoint': '/image-to-video/runway-gen4-turbo', 'param': 'duration', 'requiresHttps': True},
+    'pixverse-v5-720p': {'endpoint': '/image-to-video/pixverse-v5', 'param': 'duration', 'requiresHttps': True},
+    'seedance-1-5-pro-720p': {'endpoint': '/video/seedance-1-5-pro-720p', 'param': 'duration'},
+    'seedance-pro-1080p': {'endpoint': '/video/seedance-1-5-pro-1080p', 'param': 'duration'},
+    'seedance-lite-720p': {'endpoint': '/video/seedance-1-5-lite-720p', 'param': 'duration'},
+    'seedance-lite-1080p': {'endpoint': '/video/seedance-1-5-lite-1080p', 'param': 'duration'},
+    'kling-v1-6-pro': {'endpoint': '/image-to-video/kling-pro', 'param': 'duration'},
+    'kling-v1-6-std': {'endpoint': '/image-to-video/kling-std', 'param': 'duration'},
+    'kling-v2-6-motion-control-pro': {'endpoint': '/video/kling-v2-6-motion-control-pro', 'param': 'options'},
+    'kling-v2-6-motion-control-std': {'endpoint': '/video/kling-v2-6-motion-control-std', 'param': 'options'},
+}
+
+MODEL_STATUS_ENDPOINTS = {
+    'kling-v2-1-std': '/image-to-video/kling-v2-1',
+    'kling-v2-1-pro': '/image-to-video/kling-v2-1',
+    'kling-v2-5-pro': '/image-to-video/kling-v2-5-pro',
+    'kling-v2-6-pro': '/image-to-video/kling-v2-6',
+    'kling-o1-std': '/image-to-video/kling-o1',
+    'kling-o1-std-video-ref': '/image-to-video/kling-elements',
+    'wan-v2-2-720p': '/image-to-video/wan-v2-2-720p',
+    'wan-v2-6-720p': '/image-to-video/wan-v2-6-720p',
+    'wan-v2-6-1080p': '/image-to-video/wan-v2-6-1080p',
+    'minimax-hailuo-02-768p': '/image-to-video/minimax-hailuo-02-768p',
+    'minimax-hailuo-02-1080p': '/image-to-video/minimax-hailuo-02-1080p',
+    'minimax-hailuo-2-3-1080p': '/image-to-video/minimax-hailuo-2-3-1080p',
+    'runway-gen4-turbo': '/image-to-video/runway-gen4-turbo',
+    'pixverse-v5-720p': '/image-to-video/pixverse-v5',
+    'seedance-1-5-pro-720p': '/video/seedance-1-5-pro-720p',
+    'seedance-pro-720p': '/video/seedance-1-5-pro-720p',
+    'seedance-pro-1080p': '/video/seedance-1-5-pro-1080p',
+    'seedance-lite-720p': '/video/seedance-1-5-lite-720p',
+    'seedance-lite-1080p': '/video/seedance-1-5-lite-1080p',
+    'kling-v1-6-pro': '/image-to-video/kling',
+    'kling-v1-6-std': '/image-to-video/kling',
+}
+
+SEEDANCE_RATIO_MAP = {
+    '16:9': 'widescreen_16_9',
+    '9:16': 'social_story_9_16',
+    '1:1': 'square_1_1',
+    '4:3': 'classic_4_3',
+    '3:4': 'traditional_3_4',
+    '21:9': 'film_horizontal_21_9',
+    '9:21': 'film_vertical_9_21'
+}
+
+
+class ProviderUnavailable(Exception):
+    """Temporary submit failure (429, 5xx, timeout, connection error): worth retrying later."""
+
+
+class ProviderSaturated(ProviderUnavailable):
+    """The backend refused the task for capacity; another backend may take it."""
+
+
+def get_byok_key(user):
+    """Return the user's own Freepik key (ADVANCE user_api_key / ULTRA custom_api_key), if any."""
+    user_type = (user.get('type') or '').upper()
+    if user_type == 'ADVANCE' and user.get('user_api_key'):
+        return user['user_api_key'].strip()
+    if user_type == 'ULTRA' and user.get('custom_api_key'):
+        return user['custom_api_key'].strip()
+    return None
+
+
+def get_api_keys_for_user(user):
+    byok_key = get_byok_key(user)
+    if byok_key:
+        return [byok_key]
+
+    api_keys = []
+    group_id = user.get('group_id')
+    if group_id:
+
+        res = supabase.table("api_groups").select("api_keys").eq("id", group_id).limit(1).execute()
+        if res.data:
+            api_keys = res.data[0].get("api_keys", [])
+
+    if not api_keys:
+        res = supabase.table("api_groups").select("api_keys").eq("name", "default").limit(1).execute()
+        if res.data:
+            api_keys = res.data[0].get("api_keys", [])
+
+    return [k.split('|')[0].strip() for k in api_keys]
+
+
+class ProviderBackend:
+    """
+    Interface of a generation backend. Subclasses implement supports,
+    build_payload, submit, poll and parse_result; saturation bookkeeping is
+    shared.
+    """
+
+    name = None
+
+    def __init__(self):
+        self._saturated_until = 0.0
+        self.submitted = 0
+        self.refused = 0  # Submissions refused for capacity
+
+    def supports(self, model_id):
+        raise NotImplementedError
+
+    def build_payload(self, model_id, prompt, image_url, duration="5", options=None):
+        raise NotImplementedError
+
+    def submit(self, user, model_id, payload):
+        """Returns (task_id, used_key); raises ProviderSaturated on capacity refusals."""
+        raise NotImplementedError
+
+    def poll(self, task_id, model_id, api_key):
+        """Returns (status, video_url or error): 'completed' / 'failed' / 'processing' / 'error'."""
+        raise NotImplementedError
+
+    def parse_result(self, data):
+        """(status, video_url or error) from a status response body."""
+        raise NotImplementedError
+
+    def mark_saturated(self):
+        self.refused += 1
+        self._saturated_until = time.time() + SATURATION_HOLD_SECONDS
+
+    def is_saturated(self):
+        return time.time() < self._saturated_until
+
+    def describe(self):
+        state = "saturated" if self.is_saturated() else "ok"
+        return f"{self.name}: {state}, submitted {self.submitted}, refused {self.refused}"
+
+
+# --- Freepik payload builders ---
+# One builder per payload family, picked once per model by compile_payload_builder.
+# A builder takes (prompt, image_url, duration, options) and returns the request body.
+
+def _add_generic_options(payload, options):
+    if options.get('negative_prompt'): payload['negative_prompt'] = options['negative_prompt']
+    if options.get('cfg_scale'): payload['cfg_scale'] = float(options['cfg_scale'])
+    if options.get('aspect_ratio'): payload['aspect_ratio'] = options['aspect_ratio']
+    return payload
+
+
+def _motion_control_payload(prompt, image_url, duration, options):
+    return {
+        "image_url": image_url,
+        "video_url": options.get('driving_url') or options.get('video_url'),
+        "prompt": prompt,
+        "character_orientation": options.get('character_orientation', 'video'),
+        "cfg_scale": float(options.get('cfg_scale', 0.5))
+    }
+
+
+def _seedance_payload(prompt, image_url, duration, options):
+    return {
+        "image": image_url,
+        "prompt": prompt,
+        "duration": int(duration), # Spec says integer
+        "aspect_ratio": SEEDANCE_RATIO_MAP.get(options.get('aspect_ratio', '16:9'), 'widescreen_16_9'),
+        "generate_audio": True
+    }
+
+
+def _pixverse_payload(prompt, image_url, duration, options):
+    payload = {"image_url": image_url, "prompt": prompt, "resolution": "720p", "duration": int(duration)}
+    return _add_generic_options(payload, options)
+
+
+def _standard_builder(size=None, with_duration=True):
+    def build(prompt, image_url, duration, options):
+        payload = {"image": image_url, "prompt": prompt}
+        if size: payload["size"] = size
+        if with_duration: payload["duration"] = str(duration)
+        return _add_generic_options(payload, options)
+    return build
+
+
+def compile_payload_builder(model_id, config):
+    """Pick the payload builder for a model once (the old per-request string checks)."""
+    if 'motion-control' in model_id:
+        return _motion_control_payload
+    if 'seedance' in model_id:
+        return _seedance_payload
+    if 'pixverse' in model_id:
+        return _pixverse_payload
+    return _standard_builder(
+        size="1280*720" if "wan" in model_id else None,
+        with_duration=config.get('param') == 'duration',
+    )
+
+
+class FreepikRoute:
+    """Everything a request for one model needs, resolved at startup."""
+
+    __slots__ = ("model_id", "submit_url", "status_url", "build")
+
+    def __init__(self, model_id, submit_url, status_url, build):
+        self.model_id = model_id
+        self.submit_url = submit_url
+        self.status_url = status_url
+        self.build = build
+
+
+def compile_routes(endpoints=MODEL_ENDPOINTS, status_endpoints=MODEL_STATUS_ENDPOINTS):
+    """
+    {model_id: FreepikRoute}. Models without a MODEL_STATUS_ENDPOINTS entry
+    poll their submit endpoint (Freepik's GET {endpoint}/{task_id}); they used
+    to fall back to the kling-v2-1 status endpoint, which never knows them.
+    """
+    routes = {}
+    for model_id, config in endpoints.items():
+        model_id = model_id.lower()  # Looked up lower-cased (see FreepikBackend.route)
+        status_endpoint = status_endpoints.get(model_id, config['endpoint'])
+        routes[model_id] = FreepikRoute(
+            model_id,
+            f"{FREEPIK_API_BASE}{config['endpoint']}",
+            f"{FREEPIK_API_BASE}{status_endpoint}/",
+            compile_payload_builder(model_id, config),
+        )
+    return routes
+
+
+class FreepikBackend(ProviderBackend):
+    name = "freepik"
+
+    def __init__(self, endpoints=MODEL_ENDPOINTS, status_endpoints=MODEL_STATUS_ENDPOINTS):
+        super().__init__()
+        self.routes = compile_routes(endpoints, status_endpoints)
+
+    def route(self, model_id):
+        """FreepikRoute for a model id in any case (ai_models ids are matched case-insensitively), or None."""
+        return self.routes.get(model_id.lower()) if model_id else None
+
+    def supports(self, model_id):
+        return self.route(model_id) is not None
+
+    def build_payload(self, model_id, prompt, image_url, duration="5", options=None):
+        return self.route(model_id).build(prompt, image_url, duration, options or {})
+
+    def submit(self, user, model_id, payload):
+        keys = get_api_keys_for_user(user)
+        if not keys: raise Exception("Bot sedang sibuk (No API Keys)")
+
+        task_id = None
+        used_key = None
+        last_error = "Unknown error"
+        throttled_only = True  # Every attempt ended in 429 -> capacity, not a bad request
+        transient_only = True  # Every attempt ended in 429 / 5xx / exception -> retry later
+
+        # BYOK users are accounted in their own pool, separate from the shared keys
+        pool = byok_pool if get_byok_key(user) else key_pool
+
+        # Least-loaded healthy key first; keys with an open breaker are skipped (see key_pool.py)
+        ranked_keys = pool.rank(keys)
+        if not ranked_keys:
+            raise ProviderSaturated("Semua API Key sedang dinonaktifkan sementara (circuit breaker)")
+
+        full_url = self.route(model_id).submit_url
+        for key in ranked_keys:
+            if not pool.try_acquire(key):
+                continue
+            try:
+                # Request logging
+                print(f"DEBUG: 🚀 [Worker] Sending Request to: {full_url} (key {key_hint(key)})")
+
+                started = time.time()
+                res = http_session().post(full_url, json=payload, headers={
+                    "x-freepik-api-key": key,
+                    "Content-Type": "application/json"
+                }, timeout=30)
+
+                data = res.json()
+                task_id = data.get("data", {}).get("task_id") or data.get("task_id")
+
+                if res.status_code == 200 and task_id:
+                    pool.record_success(key, time.time() - started)
+                    used_key = key
+                    break
+                else:
+                    task_id = None
+                    last_error = data.get("message") or data.get("error") or str(data)
+                    pool.record_failure(key, res.status_code, last_error)
+                    print(f"❌ [Worker] API result with key {key[:4]}... (Status: {res.status_code}): {last_error}")
+                    if res.status_code == 429: # Rate limit
+                        continue # Try next key
+                    throttled_only = False
+                    if res.status_code < 500:
+                        transient_only = False
+                    if not is_key_failure(res.status_code):
+                        # Bad request (400 / 404 / 422 ...): every other key would reject it too
+                        break
+
+            except Exception as e:
+                last_error = str(e)
+                throttled_only = False
+                pool.record_failure(key, error=last_error)
+                print(f"❌ [Worker] Exception with key {key[:4]}: {e}")
+                continue
+
+        if not task_id:
+            if throttled_only:
+                raise ProviderSaturated(f"Gagal submit API (rate limit): {last_error}")
+            if transient_only:
+                raise ProviderUnavailable(f"Gagal submit API (sementara): {last_error}")
+            raise Exception(f"Gagal submi API: {last_error}")
+
+        self.submitted += 1
+        return task_id, used_key
+
+    def poll(self, task_id, model_id, api_key):
+        route = self.route(model_id)
+        if route is None:
+            # Unknown model: no status endpoint to ask, polling a guessed one only wastes requests
+            return "failed", f"Model {model_id} tidak dikenal"
+        try:
+            res = http_session().get(f"{route.status_url}{task_id}", headers={"x-freepik-api-key": api_key}, timeout=20)
+            return self.parse_result(res.json(), task_id)
+        except Exception as e:
+            print(f"Polling Error: {e}")
+            return "error", str(e)
+
+    def parse_result(self, body, task_id=""):
+        data = body.get("data") or body
+        status = data.get("status", "").upper()
+
+        print(f"DEBUG: 🔄 [Poll] Task: {task_id[:6]}... | Parse Status: {status}")
+        if status in ["COMPLETED", "SUCCESS"]:
+            print(f"DEBUG: ✅ Completed Data: {data}")
+            video_url = None
+            if data.get("generated"): video_url = data["generated"][0]
+            elif data.get("video") and data["video"].get("url"): video_url = data["video"]["url"]
+            elif data.get("result") and data["result"].get("url"): video_url = data["result"]["url"]
+            return "completed", video_url
+        elif status in ["FAILED", "ERROR"]:
+            return "failed", data.get("error", "Unknown error")
+        return "processing", None
+
+
+class FakeBackend(ProviderBackend):
+    """
+    In-process backend: accepts every model, at most `capacity` renders at
+    once (more are refused like a 429), each finishing `render_seconds` after
+    submission. Payloads and results use the Freepik shapes.
+    """
+
+    name = "fake"
+
+    def __init__(self, name="fake", capacity=FAKE_CAPACITY, render_seconds=FAKE_RENDER_SECONDS,
+                 submit_latency=FAKE_SUBMIT_LATENCY, clock=time):
+        super().__init__()
+        self.name = name
+        self.capacity = capacity
+        self.render_seconds = render_seconds
+        self.submit_latency = submit_latency
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._ready_at = {}  # task_id -> time the render finishes
+
+    def supports(self, model_id):
+        return True
+
+    def build_payload(self, model_id, prompt, image_url, duration="5", options=None):
+        return {"image": image_url, "prompt": prompt, "duration": str(duration)}
+
+    def rendering(self):
+        now = self.clock.time()
+        with self._lock:
+            return sum(1 for ready_at in self._ready_at.values() if ready_at > now)
+
+    def submit(self, user, model_id, payload):
+        if self.submit_latency:
+            time.sleep(self.submit_latency)
+        now = self.clock.time()
+        with self._lock:
+            rendering = sum(1 for ready_at in self._ready_at.values() if ready_at > now)
+            if rendering >= self.capacity:
+                raise ProviderSaturated(f"{self.name}: at capacity ({rendering}/{self.capacity})")
+            task_id = f"{self.name}-{next(self._ids)}"
+            self._ready_at[task_id] = now + self.render_seconds
+        self.submitted += 1
+        return task_id, None
+
+    def poll(self, task_id, model_id, api_key):
+        with self._lock:
+            ready_at = self._ready_at.get(task_id)
+        if ready_at is None:
+            return self.parse_result({"status": "FAILED", "error": f"Unknown task {task_id}"})
+        if self.clock.time() < ready_at:
+            return self.parse_result({"status": "IN_PROGRESS"})
+        with self._lock:
+            self._ready_at.pop(task_id, None)
+        return self.parse_result({"status": "COMPLETED", "generated": [FAKE_VIDEO_URL or f"https://fake.invalid/{task_id}.mp4"]})
+
+    def parse_result(self, data):
+        status = data.get("status", "").upper()
+        if status == "COMPLETED":
+            return "completed", data["generated"][0]
+        if status == "FAILED":
+            return "failed", data.get("error", "Unknown error")
+        return "processing", None
+
+
+# --- Registry ---
+
+_backends = {}
+
+
+def register(backend):
+    _backends[backend.name] = backend
+    return backend
+
+
+def get_backend(name):
+    backend = _backends.get(name or DEFAULT_PROVIDER)
+    if backend is None:
+        raise Exception(f"Provider {name} not registered")
+    return backend
+
+
+def backends_for(model_id, lane="shared"):
+    """Backends for a model in failover order (primary first)."""
+    if PROVIDER_OVERRIDE:
+        names = [PROVIDER_OVERRIDE]
+    else:
+        row = catalog.get(model_id) or {}
+        names = [row.get("provider") or DEFAULT_PROVIDER]
+        fallback = row.get("fallback_provider")
+        # BYOK tasks run on the user's own key: no failover
+        if lane != "byok" and fallback and fallback != names[0]:
+            names.append(fallback)
+    chain = []
+    for name in names:
+        backend = _backends.get(name)
+        if backend is None:
+            logger.error(f"[PROVIDERS] Model {model_id} routed to unknown provider '{name}'")
+        elif backend.supports(model_id):
+            chain.append(backend)
+    return chain
+
+
+def submit_generation(user, model_id, prompt, image_url, duration="5", options=None, lane="shared"):
+    """
+    Submit to the model's primary backend, or to its fallback while the primary
+    is saturated. Returns (provider, task_id, used_key) or raises.
+    Does NOT handle DB logging or credit consumption.
+    """
+    chain = backends_for(model_id, lane)
+    if not chain: raise Exception(f"Model {model_id} not found")
+
+    primary = chain[0]
+    # A backend that refused work recently goes after the others (stable sort keeps the order otherwise)
+    chain.sort(key=lambda backend: backend.is_saturated())
+    last_error = None
+    for backend in chain:
+        payload = backend.build_payload(model_id, prompt, image_url, duration, options)
+        try:
+            task_id, used_key = backend.submit(user, model_id, payload)
+        except ProviderSaturated as e:
+            backend.mark_saturated()
+            last_error = e
+            logger.warning(f"[PROVIDERS] {backend.name} saturated for {model_id}: {e}")
+            continue
+        if backend is not primary:
+            logger.info(f"[PROVIDERS] {model_id} served by fallback provider {backend.name}")
+        return backend.name, task_id, used_key
+    raise last_error
+
+
+def supports_model(model_id):
+    """True when a registered backend can serve the model (checked when a task is enqueued)."""
+    return bool(model_id) and bool(backends_for(model_id))
+
+
+def poll_generation(provider, task_id, model_id, api_key):
+    """One status check on the backend that accepted the task."""
+    return get_backend(provider).poll(task_id, model_id, api_key)
+
+
+def describe():
+    return " | ".join(backend.describe() for backend in _backends.values())
+
+
+freepik = register(FreepikBackend())
+register(FakeBackend())
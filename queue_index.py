@@ -0,0 +1,233 @@
+import re
+import time
+import json
+import asyncio
+import logging
+import threading
+from bisect import bisect_left, insort
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+from clients import supabase
+from admission import format_eta, THROUGHPUT_WINDOW_SECONDS, THROUGHPUT_MIN_CLAIMS, THROUGHPUT_MIN_BUSY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+QUEUE_UPDATE_SECONDS = 10      # Position update job interval
+QUEUE_RESYNC_SECONDS = 30      # Full re-read of the pending rows (catches other replicas / clients)
+QUEUE_EDIT_MIN_SECONDS = 30    # Per queue message: at most one edit per this many seconds
+QUEUE_EDITS_PER_TICK = 20      # Per job run, well under Telegram's ~30 messages/s
+
+
+_FRACTION = re.compile(r"\.(\d+)")
+
+
+def parse_ts(value):
+    """
+    PostgREST timestamp -> aware datetime (UTC when it has no offset).
+    PostgREST trims trailing zeros of the fraction ("...34.5+00:00"), which
+    datetime.fromisoformat only accepts from Python 3.11 (the image runs 3.10).
+    """
+    text = str(value).strip().replace("Z", "+00:00").replace(" ", "T", 1)
+    text = _FRACTION.sub(lambda m: "." + m.group(1).ljust(6, "0")[:6], text, count=1)
+    parsed = datetime.fromisoformat(text)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def queue_message(position, eta_seconds, model_id):
+    """Text of a user's "⏳ Antrian..." message."""
+    eta = format_eta(eta_seconds)
+    return (
+        f"⏳ **Antrian...**\n"
+        f"Posisi: {position}\n"
+        + (f"Perkiraan mulai: {eta}\n" if eta else "")
+        + f"Model: {model_id}\n"
+        f"Mohon tunggu sebentar..."
+    )
+
+
+@dataclass(slots=True)
+class QueueEntry:
+    gen_id: str
+    key: tuple              # (created_at, gen_id): the worker's claim order
+    chat_id: int | None
+    msg_id: int | None
+    model_id: str | None
+    shown_position: int | None = None
+    shown_at: float = 0.0
+
+
+class QueueIndex:
+    """
+    Pending shared-lane Telegram tasks in claim order, kept in a sorted list of
+    (created_at, id) keys: bisect gives a task's position in O(log n) with no
+    count query. The bot adds rows it inserts, the worker discards rows before
+    claiming them, and resync() re-reads all pending rows every
+    QUEUE_RESYNC_SECONDS for everything else (other replicas, web, cleanup).
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self._lock = threading.Lock()
+        self._keys = []
+        self._entries = {}
+        self._changes = None  # gen_id -> entry (added) / None (discarded) while a resync query runs
+        self.synced_at = 0.0
+
+    @staticmethod
+    def _entry(row):
+        options = row.get("options") or {}
+        if isinstance(options, str):
+            options = json.loads(options)
+        chat_id = row.get("telegram_chat_id")
+        return QueueEntry(
+            gen_id=row["id"],
+            key=(parse_ts(row["created_at"]), row["id"]),
+            chat_id=int(chat_id) if chat_id else None,
+            msg_id=options.get("msg_id"),
+            model_id=row.get("model_name"),
+        )
+
+    def _insert(self, entry):
+        if entry.gen_id in self._entries:
+            return
+        insort(self._keys, entry.key)
+        self._entries[entry.gen_id] = entry
+
+    def add(self, row):
+        """Index a row just inserted as pending; returns its position (shown in its first message), or None."""
+        try:
+            entry = self._entry(row)
+        except (KeyError, TypeError, ValueError) as e:
+            # Left to the next resync; the task is queued either way
+            logger.warning(f"[QUEUE] Could not index generation {row.get('id')}: {e}")
+            return None
+        with self._lock:
+            self._insert(entry)
+            entry = self._entries[entry.gen_id]
+            if self._changes is not None:
+                self._changes[entry.gen_id] = entry
+            entry.shown_position = bisect_left(self._keys, entry.key) + 1
+            entry.shown_at = time.monotonic()
+            return entry.shown_position
+
+    def discard(self, gen_id):
+        """The row leaves pending (claimed / failed)."""
+        with self._lock:
+            entry = self._entries.pop(gen_id, None)
+            if entry:
+                i = bisect_left(self._keys, entry.key)
+                if i < len(self._keys) and self._keys[i] == entry.key:
+                    del self._keys[i]
+            if self._changes is not None:
+                self._changes[gen_id] = None
+
+    def position(self, gen_id):
+        """1-based position in the shared lane, or None when not pending."""
+        with self._lock:
+            entry = self._entries.get(gen_id)
+            return bisect_left(self._keys, entry.key) + 1 if entry else None
+
+    def __len__(self):
+        return len(self._keys)
+
+    def is_fresh(self):
+        """Resynced recently (the position job runs in this process)."""
+        return time.monotonic() - self.synced_at < 2 * QUEUE_RESYNC_SECONDS
+
+    def resync(self):
+        """Replace the index with the pending rows in the database (one query), keeping adds / discards made meanwhile."""
+        with self._lock:
+            self._changes = {}
+        try:
+            res = self.client.table("generations") \
+                .select("id, created_at, telegram_chat_id, model_name, options") \
+                .eq("status", "pending").eq("source", "telegram").eq("lane", "shared") \
+                .execute()
+        except Exception:
+            with self._lock:
+                self._changes = None
+            raise
+        with self._lock:
+            fresh = {}
+            for row in res.data or []:
+                entry = self._entries.get(row["id"])
+                if entry is None:
+                    try:
+                        entry = self._entry(row)
+                    except (KeyError, TypeError, ValueError) as e:
+                        # One unreadable row must not keep the whole index stale
+                        logger.warning(f"[QUEUE] Skipping generation {row.get('id')} in the index: {e}")
+                        continue
+                fresh[entry.gen_id] = entry
+            for gen_id, entry in self._changes.items():
+                if entry is None:
+                    fresh.pop(gen_id, None)
+                else:
+                    fresh[gen_id] = entry
+            self._entries = fresh
+            self._keys = sorted(entry.key for entry in fresh.values())
+            self._changes = None
+            self.synced_at = time.monotonic()
+
+    def due_updates(self, limit):
+        """
+        Up to `limit` (entry, position) pairs whose message shows a stale
+        position and was not edited in the last QUEUE_EDIT_MIN_SECONDS,
+        least recently edited first. Marks them as shown.
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = []
+            for position, key in enumerate(self._keys, 1):
+                entry = self._entries[key[1]]
+                if entry.msg_id and entry.chat_id and entry.shown_position != position \
+                        and now - entry.shown_at >= QUEUE_EDIT_MIN_SECONDS:
+                    due.append((entry, position))
+            due.sort(key=lambda item: item[0].shown_at)
+            due = due[:limit]
+            for entry, position in due:
+                entry.shown_position, entry.shown_at = position, now
+            return due
+
+
+async def update_queue_positions(context):
+    """
+    Repeating job (process running the queue worker): resync when due, then
+    edit the queue messages whose position changed, in one batch, with the
+    ETA from the worker's claim rate.
+    """
+    index = context.job.data
+    if time.monotonic() - index.synced_at >= QUEUE_RESYNC_SECONDS:
+        try:
+            await asyncio.to_thread(index.resync)
+        except Exception as e:
+            logger.error(f"[QUEUE] Failed to resync pending tasks: {e}")
+            return
+
+    due = index.due_updates(QUEUE_EDITS_PER_TICK)
+    if not due:
+        return
+    worker = context.application.bot_data.get("queue_worker")
+    throughput = worker.throughput(THROUGHPUT_WINDOW_SECONDS, THROUGHPUT_MIN_CLAIMS, THROUGHPUT_MIN_BUSY_SECONDS) if worker else 0.0
+
+    async def edit(entry, position):
+        if index.position(entry.gen_id) is None:
+            return  # Claimed meanwhile: the worker owns the message now
+        try:
+            await context.bot.edit_message_text(
+                chat_id=entry.chat_id,
+                message_id=entry.msg_id,
+                text=queue_message(position, position / throughput if throughput else None, entry.model_id),
+                parse_mode='Markdown'
+            )
+        except Exception as e:
+            logger.debug(f"[QUEUE] Could not update position message for {entry.gen_id}: {e}")
+
+    await asyncio.gather(*(edit(entry, position) for entry, position in due))
+    logger.info(f"[QUEUE] Updated {len(due)} position messages ({len(index)} pending)")
+
+
+# One index per process, shared by the bot handlers and the queue worker
+queue_index = QueueIndex(supabase)
@@ -1,23 +1,25 @@
+import time
+import random
 import asyncio
 import logging
-from datetime import datetime, timedelta
-from supabase import create_client, Client
-import os
+from collections import deque
+from datetime import datetime, timedelta, timezone
 import json
-from dotenv import load_dotenv
-from generation_helper import submit_freepik_task, consume_credits
-
-# Load env variables (re-load to ensure worker has them)
-load_dotenv()
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from clients import supabase, get_r2
+from generation_helper import reserve_credits, commit_credits, refund_credits, get_byok_key
+from providers import submit_generation, poll_generation, supports_model, ProviderUnavailable
+import providers
+from key_pool import key_pool, byok_pool, key_hint, get_pool
+from worker_pipeline import Stage, SERVICE_TIME_WINDOW
+from concurrency_control import AimdController, ModelLimits
+from model_catalog import catalog
+from queue_index import queue_index, parse_ts
+import generation_state
 
 logger = logging.getLogger(__name__)
 
 # --- CONFIGURATION ---
-GLOBAL_DELAY_SECONDS = 5
-MAX_GLOBAL_CONCURRENT = 12
 MAX_USER_CONCURRENT_LIMIT = {
     'UNLIMITED': 3, 
     'ULTRA': 3, 
@@ -26,39 +28,57 @@ MAX_USER_CONCURRENT_LIMIT = {
     'DEFAULT': 1
 }
 
+# BYOK lane: users' own keys get their own limits and never count against
+# the shared lane's adaptive limits (those protect the shared pool).
+BYOK_MAX_CONCURRENT_PER_KEY = 3
+BYOK_DELAY_SECONDS = 5
+
+# Pipeline stages (workers / queue size each; see QueueWorker)
+SUBMIT_CONCURRENCY = 4       # Provider submissions in flight
+SUBMIT_QUEUE_SIZE = 4        # Claimed rows waiting to be submitted
+POLL_CONCURRENCY = 8         # Status checks in flight
+POLL_QUEUE_SIZE = 64
+POLL_FIRST_DELAY_SECONDS = 1
+POLL_INTERVAL_SECONDS = 5
+POLL_DEADLINE_SECONDS = 600  # Per task from submission; ai_models.poll_deadline_seconds overrides
+POLL_MAX_ERRORS = 6          # Consecutive checks without an answer (error / completed without a URL)
+DELIVER_CONCURRENCY = 4      # R2 copies / final sends in flight
+DELIVER_QUEUE_SIZE = 16
+HEARTBEAT_SECONDS = 30
+STALE_PROCESSING_SECONDS = 600  # Processing rows this long after their claim that this worker does not hold
+THROUGHPUT_HISTORY = 1000    # Shared-lane claim times kept for the enqueue ETA (see admission.py)
+
+# Temporary submit failures (every key 429 / 5xx / timeout) are retried with
+# exponential backoff + jitter on their own stage, then dead-lettered.
+# Worst case ~75 s in total; the row stays owned by the worker, so stale cleanup leaves it alone.
+SUBMIT_MAX_ATTEMPTS = 5
+RETRY_BASE_SECONDS = 5
+RETRY_MAX_SECONDS = 60
+RETRY_CONCURRENCY = 2        # Retried submissions in flight (fresh tasks keep the submit stage)
+RETRY_QUEUE_SIZE = 16
+
+# Shared lane: concurrency and delay between submissions adapt to provider
+# 429s / timeouts / latency, bounded by the worker_limits row (see concurrency_control.py)
+limits = AimdController(supabase)
+key_pool.on_result = limits.on_result
+
+# Per-model caps from ai_models.max_concurrent / max_per_minute (both lanes)
+model_limits = ModelLimits(catalog)
+
 # Cache for rate limiting
 last_global_request_time = 0
+last_byok_request_time = {}  # user key -> timestamp of last submission
+byok_throttled = {}  # user_id -> BYOK key over its limits; the claim query skips the user's rows until it is free
 
 async def check_user_concurrency(user_id, user_type):
     """Check if user has exceeded their concurrent limit."""
     limit = MAX_USER_CONCURRENT_LIMIT.get(user_type, MAX_USER_CONCURRENT_LIMIT['DEFAULT'])
-    
-    # --- STALE TASK CLEANUP ---
-    # Automatically fail processing tasks older than 10 minutes
-    ten_mins_ago = (datetime.now() - timedelta(minutes=10)).isoformat()
-    try:
-        # 1. Identify stale tasks
-        stale_res = supabase.table("generations") \
-            .select("id") \
-            .eq("user_id", user_id) \
-            .eq("status", "processing") \
-            .lt("created_at", ten_mins_ago) \
-            .execute()
-        
-        if stale_res.data:
-            stale_ids = [d['id'] for d in stale_res.data]
-            logger.warning(f"[WORKER] Cleaning up {len(stale_ids)} stale tasks for User {user_id}")
-            # 2. Mark as failed
-            supabase.table("generations") \
-                .update({"status": "failed", "error": "Task timed out (stale)"}) \
-                .in_("id", stale_ids) \
-                .execute()
-    except Exception as e:
-        logger.error(f"[WORKER] Error cleaning up stale tasks for {user_id}: {e}")
 
     # Count active jobs for this user
     try:
-        res = supabase.table("generations").select("id", count="exact").eq("user_id", user_id).eq("status", "processing").execute()
+        res = await asyncio.to_thread(
+            supabase.table("generations").select("id", count="exact").eq("user_id", user_id).eq("status", "processing").execute
+        )
         count = res.count if res.count is not None else 0
         logger.info(f"👤 User [{user_id}] memiliki [{count}] tugas aktif (Limit: {limit})")
     except Exception as e:
@@ -68,310 +88,728 @@ async def check_user_concurrency(user_id, user_type):
     return count < limit
 
 async def check_global_concurrency():
-    """Check if server is under high load (only counting RECENT tasks)."""
-    # Only count tasks in 'processing' status that were created in the last 15 minutes.
+    """Check if the shared key pool is under high load (only counting RECENT tasks)."""
+    # Only count tasks in 'processing' status that were claimed in the last 15 minutes
+    # (claimed, not created: a task that waited long in the queue is still running).
     # This prevents old hung tasks from blocking the queue forever.
-    fifteen_mins_ago = (datetime.now() - timedelta(minutes=15)).isoformat()
+    # BYOK tasks run on the users' own keys and are not counted here.
+    fifteen_mins_ago = (datetime.now(timezone.utc) - timedelta(minutes=15)).isoformat()
     
     try:
-        res = supabase.table("generations").select("id", count="exact") \
-            .eq("status", "processing") \
-            .gte("created_at", fifteen_mins_ago) \
-            .execute()
+        res = await asyncio.to_thread(
+            supabase.table("generations").select("id", count="exact")
+            .eq("status", "processing")
+            .eq("lane", "shared")
+            .gte("claimed_at", fifteen_mins_ago)
+            .execute
+        )
         count = res.count if res.count is not None else 0
     except Exception as e:
         logger.error(f"[WORKER] Error checking global concurrency: {e}")
         count = 0
     
     
-    if count >= MAX_GLOBAL_CONCURRENT:
-        logger.warning(f"[WORKER] Global concurrency limit reached ({count}/{MAX_GLOBAL_CONCURRENT}). Waiting for recent tasks to finish.")
+    limit = limits.concurrency()
+    if count >= limit:
+        logger.warning(f"[WORKER] Global concurrency limit reached ({count}/{limit}). Waiting for recent tasks to finish.")
+        limits.note_blocked()
         return False
         
     return True
 
-async def worker_loop(application):
+def check_byok_limits(api_key):
+    """Per-key concurrency and rate limit for the BYOK lane (in-process accounting)."""
+    now = datetime.now().timestamp()
+    if now - last_byok_request_time.get(api_key, 0) < BYOK_DELAY_SECONDS:
+        return False
+    if byok_pool.in_flight(api_key) >= BYOK_MAX_CONCURRENT_PER_KEY:
+        return False
+    return True
+
+def throttled_byok_users():
+    """User ids whose BYOK key is still over its limits (their rows are skipped, not waited on)."""
+    for user_id, api_key in list(byok_throttled.items()):
+        if check_byok_limits(api_key):
+            del byok_throttled[user_id]
+    return list(byok_throttled)
+
+def retry_delay(attempt):
+    """Backoff before retry number `attempt` (1-based): doubling, capped, half of it jittered."""
+    delay = min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def release_reservation(reservation):
+    """Refund reserved credits after a failed submission (safe to call twice)."""
+    if not reservation:
+        return
+    try:
+        balance = refund_credits(reservation['reservation_id'])
+        if balance is not None:
+            logger.info(f"[WORKER] Refunded reservation {reservation['reservation_id']} (balance: {balance})")
+    except Exception as e:
+        logger.error(f"[WORKER] Failed to refund reservation {reservation['reservation_id']}: {e}")
+
+def parse_options(task):
+    """Task options as a dict (the column may hold a JSON string on older rows)."""
+    options = task.get('options') or task.get('metadata') or task.get('task_metadata') or {}
+    if isinstance(options, str):
+        try:
+            options = json.loads(options)
+        except ValueError:
+            options = {}
+    return options
+
+def price_task(model_id, options):
+    """Credit cost for a task from its model row (model catalog) and duration."""
+    m_data = catalog.get(model_id)
+    if not m_data:
+        logger.error(f"[WORKER] Model ID '{model_id}' not found in ai_models table! Using default cost=0.")
+        return 0
+
+    # Determine cost based on duration in task options
+    # Default duration is 5 if not specified
+    duration = str(options.get('duration', '5'))
+
+    is_free_5s = m_data.get('is_free_pro_5s', False)
+    base_cost = m_data.get('credit_cost') or 0
+
+    # Pricing logic with fallback: Try specific -> Try Pro -> Try Base/Legacy
+    cost_5s = int(m_data.get('cost_pro_5s') or m_data.get('cost_pro') or base_cost or 0)
+    cost_10s = int(m_data.get('cost_pro_10s') or m_data.get('cost_pro') or (base_cost * 2) or 0)
+
+    if duration == '5':
+        return 0 if is_free_5s else cost_5s
+    return cost_10s
+
+def pending_by_model():
+    """{model_id: (pending count, oldest wait in seconds)} for Telegram tasks (heartbeat metrics)."""
+    res = supabase.table("generations").select("model_name, created_at") \
+        .eq("status", "pending").eq("source", "telegram").execute()
+    now = datetime.now(timezone.utc)
+    pending = {}
+    for row in res.data or []:
+        count, oldest = pending.get(row["model_name"], (0, 0.0))
+        pending[row["model_name"]] = (count + 1, max(oldest, task_wait_seconds(row, now) or 0.0))
+    return pending
+
+def task_wait_seconds(task, now=None):
+    """Seconds since the task was enqueued (None if created_at is missing or unreadable)."""
+    try:
+        created = parse_ts(task["created_at"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return ((now or datetime.now(timezone.utc)) - created).total_seconds()
+
+async def notify(application, chat_id, text, **kwargs):
+    """Best-effort Telegram message (a failed send never fails the task)."""
+    if not chat_id:
+        return None
+    try:
+        return await application.bot.send_message(chat_id=chat_id, text=text, **kwargs)
+    except Exception as e:
+        logger.error(f"[WORKER] Failed to send message to {chat_id}: {e}")
+        return None
+
+async def edit(application, job, text, **kwargs):
+    """Best-effort edit of the task's status message."""
+    if not job.get("chat_id") or not job.get("msg_id"):
+        return
+    try:
+        await application.bot.edit_message_text(text, chat_id=job["chat_id"], message_id=job["msg_id"], **kwargs)
+    except Exception as e:
+        logger.warning(f"[WORKER] Failed to edit message: {e}")
+
+
+class QueueWorker:
     """
-    Main background loop.
-    application: The python-telegram-bot Application instance (for scheduling callbacks).
+    The generation lifecycle as four stages (see worker_pipeline.py):
+
+        claim ──> submit ──> poll ──┐──> deliver
+                              ^      │
+                              └──────┘ (not finished: poll again later)
+
+    claim   one loop: admission (global delay / load, per-model caps, BYOK and
+            per-user limits), pricing, pending -> processing, credit reservation. It only claims
+            a row when the submit queue has room, so rows are never claimed
+            just to wait in memory.
+    submit  provider request (model's backend, or its fallback while the primary
+            is saturated; see providers.py), provider details on the row,
+            "processing" message. Temporary failures are parked on the retry
+            stage (same handler, own workers) with backoff, then dead-lettered.
+    poll    one provider status check per visit; unfinished tasks are parked and
+            come back after POLL_INTERVAL_SECONDS, until the model's deadline or
+            POLL_MAX_ERRORS unanswered checks (then: last check, fail, refund).
+    deliver R2 copy, completion RPC, credit commit, final video.
+
+    Blocking provider / DB / R2 calls run in threads, so no stage holds the
+    event loop, and a slow stage only backs up the stage feeding it.
     """
-    global last_global_request_time
-    logger.info("👷 Queue Worker Started!")
-    heartbeat_time = 0
 
-    while True:
+    def __init__(self, application):
+        self.application = application
+        self.submit = Stage("submit", self.submit_task, SUBMIT_CONCURRENCY, SUBMIT_QUEUE_SIZE)
+        self.poll = Stage("poll", self.poll_task, POLL_CONCURRENCY, POLL_QUEUE_SIZE)
+        self.deliver = Stage("deliver", self.deliver_task, DELIVER_CONCURRENCY, DELIVER_QUEUE_SIZE)
+        self.retry = Stage("retry", self.submit_task, RETRY_CONCURRENCY, RETRY_QUEUE_SIZE)
+        self.stages = (self.submit, self.retry, self.poll, self.deliver)
+        self.claimed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+        self.active_polls = {}  # gen_id -> monotonic time polling started (gauge; leaks show up here)
+        self.owned = set()  # gen_ids claimed by this worker and not finished yet (never failed as stale)
+        self.poll_timeouts = 0
+        self._claim_times = deque(maxlen=SERVICE_TIME_WINDOW)
+        self._shared_claimed_at = deque(maxlen=THROUGHPUT_HISTORY)  # monotonic claim times (admission ETA)
+        self._idle_spans = deque(maxlen=THROUGHPUT_HISTORY)  # (start, end): nothing pending, so no capacity used
+        self.started_at = time.monotonic()
+
+    # --- claim ---
+
+    async def claim_next(self):
+        """Claim one pending task and hand it to the submit stage. Returns False when idle."""
+        global last_global_request_time
+
+        # 1. Enforce Global Delay + 2. Check Global Load (shared lane only).
+        # When the shared lane is closed, BYOK tasks can still be served.
+        now = datetime.now().timestamp()
+        time_since_last = now - last_global_request_time
+        await asyncio.to_thread(limits.maybe_reload)
+        delay_left = limits.delay() - time_since_last
+        if delay_left > 0:
+            limits.note_blocked()
+        shared_open = delay_left <= 0 and await check_global_concurrency()
+
+        # 3. Fetch ONE oldest Pending Task from Telegram source in generations table,
+        # skipping models at their own cap and BYOK users over their key's limits
+        # so the rows behind them keep moving
+        saturated = model_limits.saturated()
+        throttled = throttled_byok_users()
         try:
-            now = datetime.now().timestamp()
-            
-            # Initialize loop variables to avoid NameError if exceptions occur early
-            api_task_id = None
-            used_key = None
-            last_global_error = None
-            
-            # Heartbeat every 30s
-            if now - heartbeat_time > 30:
-                logger.info("[WORKER HEARTBEAT] Worker is alive and checking for tasks...")
-                heartbeat_time = now
+            query = supabase.table("generations").select("*, users(*)").eq("status", "pending").eq("source", "telegram")
+            if not shared_open:
+                query = query.eq("lane", "byok")
+            if saturated:
+                query = query.not_.in_("model_name", saturated)
+                model_limits.note_skipped(saturated)
+            if throttled:
+                query = query.not_.in_("user_id", throttled)
+            res = await asyncio.to_thread(query.order("created_at").limit(1).execute)
+        except Exception as e:
+            logger.error(f"[WORKER] Error fetching pending tasks from generations: {e}")
+            await asyncio.sleep(5)
+            return False
+
+        if not res.data:
+            if shared_open and not saturated and not throttled:
+                # Queue empty: time the ETA's capacity estimate must not count
+                idle_from = time.monotonic()
+                await asyncio.sleep(2)
+                self._idle_spans.append((idle_from, time.monotonic()))
+            else:
+                # Closed by the delay, a model cap or a BYOK key limit: come back as soon as it may have passed
+                await asyncio.sleep(min(0.5, delay_left) if delay_left > 0 else 0.5)
+            return False
 
-            # 1. Enforce Global Delay
-            time_since_last = now - last_global_request_time
-            if time_since_last < GLOBAL_DELAY_SECONDS:
+        task = res.data[0]
+        logger.info(f"[WORKER] Found pending task ID: {task['id']} | User ID: {task['user_id']}")
+        user = task['users']
+
+        # flatten user data if list (supabase-py sometimes returns list for joined)
+        if isinstance(user, list): user = user[0]
+
+        # BYOK lane: the user's own key has its own concurrency / rate limits
+        byok_key = get_byok_key(user)
+        if byok_key and not check_byok_limits(byok_key):
+            # Skipped by the next queries until the key is free again (no sleep: the rest of the queue goes on)
+            logger.info(f"[WORKER] BYOK key {key_hint(byok_key)} over its limits; skipping user {task['user_id']} for now.")
+            byok_throttled[task['user_id']] = byok_key
+            return False
+        if not byok_key and task.get('lane') == 'byok':
+            # Enqueued as byok but the user no longer has a key: it waits in the shared lane from now on,
+            # so the byok-only query (shared lane closed) does not return it ahead of every BYOK task again
+            try:
+                await asyncio.to_thread(generation_state.move_to_shared_lane, task['id'])
+                logger.info(f"[WORKER] Task {task['id']} moved to the shared lane (user {task['user_id']} has no BYOK key).")
+            except Exception as e:
+                logger.error(f"[WORKER] Failed to move task {task['id']} to the shared lane: {e}")
                 await asyncio.sleep(0.5)
-                continue
+                return False
+            if not shared_open:
+                return True
 
-            # 2. Check Global Load
-            if not await check_global_concurrency():
-                logger.info("[WORKER] Global concurrency limit reached. Waiting...")
-                await asyncio.sleep(2) 
-                continue
+        # 4. Check User Concurrency (after failing the user's orphaned rows, which would count)
+        await self.clean_stale(task['user_id'])
+        if not await check_user_concurrency(task['user_id'], user.get('type')):
+            # User is busy; retry after a short wait (the row stays pending)
+            logger.info(f"⏳ User {user.get('code')} hit limit. Waiting...")
+            await asyncio.sleep(2)
+            return False
+
+        model_id = task.get('model_name', 'kling-v1-6-std')
+        chat_id = int(task['telegram_chat_id']) if task.get('telegram_chat_id') else None
+        if not supports_model(model_id):
+            # Enqueued before the model was removed (or by another client): fail it before any credits move
+            logger.error(f"[WORKER] Task {task['id']} uses unknown model '{model_id}'. Marking as failed.")
+            queue_index.discard(task['id'])
+            await asyncio.to_thread(generation_state.fail, task['id'], f"Unknown model: {model_id}", generation_state.PENDING)
+            await notify(self.application, chat_id, f"❌ Gagal: Model `{model_id}` tidak tersedia.", parse_mode='Markdown')
+            return True
+        options = parse_options(task)
+        credit_cost = await asyncio.to_thread(price_task, model_id, options)
+
+        # Out of the position index first, so no queue update edits the message from here on
+        queue_index.discard(task['id'])
 
-            # 3. Fetch ONE oldest Pending Task from Telegram source in generations table
+        # Claim the row: pending -> processing in one conditional write (our lock).
+        # credits_used / aspect_ratio / lane ride along so no second write is needed.
+        try:
+            claimed = await asyncio.to_thread(
+                generation_state.claim,
+                task['id'],
+                lane="byok" if byok_key else "shared",
+                credits_used=credit_cost,
+                aspect_ratio=task.get('aspect_ratio', '16:9')
+            )
+        except Exception as e:
+            logger.error(f"[WORKER] Failed to lock generation record {task['id']} as processing: {e}")
+            return True
+        if not claimed:
+            # Someone else (another worker / cleanup) already moved this row
+            return True
+        # Counts against the model's cap until the task completes or fails
+        model_limits.acquire(model_id, task_wait_seconds(task))
+
+        reservation = None
+        try:
+            if user.get('type') not in ['UNLIMITED', 'ADVANCE']:
+                # Atomic reservation (RPC); refunded if submission fails
+                reservation = await asyncio.to_thread(reserve_credits, user['id'], credit_cost, task['id'])
+                if not reservation:
+                    logger.error(f"❌ User {user.get('code')} ran out of credits in queue.")
+                    model_limits.release(model_id)
+                    await asyncio.to_thread(generation_state.fail, task['id'], "Insufficient credits")
+                    await notify(self.application, chat_id, "❌ Gagal: Kredit tidak mencukupi saat giliran Anda tiba.")
+                    return True
+        except Exception as e:
+            logger.error(f"[WORKER] Failed to execute task {task['id']}: {e}", exc_info=True)
+            model_limits.release(model_id)
+            await asyncio.to_thread(release_reservation, reservation)
             try:
-                res = supabase.table("generations").select("*, users(*)").eq("status", "pending").eq("source", "telegram") \
-                    .order("created_at").limit(1).execute()
+                await asyncio.to_thread(generation_state.fail, task['id'], str(e))
+            except Exception as db_e:
+                logger.error(f"[WORKER] Double failure: Could not update generation status: {db_e}")
+            await notify(self.application, chat_id, f"❌ Gagal memproses: {str(e)}")
+            return True
+
+        if byok_key:
+            last_byok_request_time[byok_key] = datetime.now().timestamp()
+        else:
+            last_global_request_time = datetime.now().timestamp() # Reset timer
+
+        logger.info(f"🚀 Starting Task {task['id']} for {user.get('code')} (Model: {model_id})")
+        self.owned.add(task['id'])
+        await self.submit.put({
+            "task": task,
+            "user": user,
+            "options": options,
+            "gen_id": task['id'],
+            "model_id": model_id,
+            "chat_id": chat_id,
+            "msg_id": options.get('msg_id'),
+            "prompt": task.get('prompt') or "",
+            "user_id": user['id'],
+            "lane": "byok" if byok_key else "shared",
+            "user_type": user.get('type'),
+            "credits_used": options.get('credits_used', credit_cost),
+            "reservation_id": reservation['reservation_id'] if reservation else None,
+            "balance": reservation['balance'] if reservation else None,
+        })
+        self.claimed += 1
+        if not byok_key:
+            self._shared_claimed_at.append(time.monotonic())
+        return True
+
+    async def claim_loop(self):
+        while True:
+            if self.submit.full():
+                # Backpressure: do not claim rows the submit stage cannot take yet
+                await asyncio.sleep(0.2)
+                continue
+            started = time.perf_counter()
+            try:
+                if await self.claim_next():
+                    self._claim_times.append(time.perf_counter() - started)
             except Exception as e:
-                logger.error(f"[WORKER] Error fetching pending tasks from generations: {e}")
+                logger.error(f"[WORKER] Claim Error: {e}", exc_info=True)
                 await asyncio.sleep(5)
-                continue
-            
-            if not res.data:
-                await asyncio.sleep(2) 
-                continue
 
-            task = res.data[0]
-            logger.info(f"[WORKER] Found pending task ID: {task['id']} | User ID: {task['user_id']}")
-            user = task['users'] 
-            
-            # flatten user data if list (supabase-py sometimes returns list for joined)
-            if isinstance(user, list): user = user[0] 
-
-            # 4. Check User Concurrency
-            if not await check_user_concurrency(task['user_id'], user.get('type')):
-                # User is busy. We should skip this task for now and maybe try another?
-                # For simplicity in V1: we just wait. In real queue, we'd pick next task from diff user.
-                # To prevent blocking queue, we could check next tasks, but let's just wait a bit.
-                logger.info(f"⏳ User {user.get('code')} hit limit. Waiting...")
-                await asyncio.sleep(2)
-                continue
+    async def clean_stale(self, user_id):
+        """
+        Fail the user's processing rows claimed over STALE_PROCESSING_SECONDS
+        ago that this worker does not hold (left behind by a restart), with
+        their credits refunded in the same RPC, and tell the users.
+        """
+        claimed_before = (datetime.now(timezone.utc) - timedelta(seconds=STALE_PROCESSING_SECONDS)).isoformat()
+        try:
+            stale = await asyncio.to_thread(
+                generation_state.fail_stale, user_id, claimed_before, "Task timed out (stale)", self.owned
+            )
+        except Exception as e:
+            logger.error(f"[WORKER] Error cleaning up stale tasks for {user_id}: {e}")
+            return
+        if not stale:
+            return
+        refunded = sum(row.get("refunded") or 0 for row in stale)
+        logger.warning(f"[WORKER] Cleaned up {len(stale)} stale tasks for User {user_id} (refunded {refunded} credits)")
+        for row in stale:
+            options = row.get("gen_options") or {}
+            if isinstance(options, str):
+                options = json.loads(options)
+            job = {"chat_id": int(row["chat_id"]) if row.get("chat_id") else None, "msg_id": options.get("msg_id")}
+            await edit(self.application, job, "❌ Gagal: waktu pembuatan video habis. Kredit Anda sudah dikembalikan.")
+
+    # --- submit ---
 
-            # 5. EXECUTE TASK
-            model_id = task.get('model_name', 'kling-v1-6-std')
-            logger.info(f"🚀 Starting Task {task['id']} for {user.get('code')} (Model: {model_id})")
-            
+    async def submit_task(self, job):
+        """Submit a claimed task. Runs on the submit stage, and on the retry stage for retries."""
+        stage = self.retry if job.get("attempts") else self.submit
+        task, user = job["task"], job["user"]
+        reservation = {"reservation_id": job["reservation_id"]} if job["reservation_id"] else None
+        provider, api_task_id, used_key, error = None, None, None, None
+        transient = False
+        try:
+            img_url = task.get('thumbnail_url')
+            if not img_url:
+                logger.warning(f"[WORKER] thumbnail_url is empty for task {job['gen_id']}.")
+                raise Exception("Source image URL (thumbnail_url) is missing.")
+
+            duration = str(job["options"].get('duration', '5')) # Default '5' (the bot stores it in options)
+            task_options = dict(job["options"])
+            # Ensure aspect_ratio is passed
+            if task.get('aspect_ratio'):
+                task_options['aspect_ratio'] = task.get('aspect_ratio')
+
+            provider, api_task_id, used_key = await stage.run(
+                submit_generation,
+                user=user,
+                model_id=job["model_id"],
+                prompt=task.get('prompt'),
+                image_url=img_url,
+                duration=duration,
+                options=task_options,
+                lane=job["lane"]
+            )
+        except Exception as api_e:
+            logger.error(f"[WORKER] API Submission Failed for {job['gen_id']}: {api_e}")
+            error = str(api_e)
+            transient = isinstance(api_e, ProviderUnavailable)
+            api_task_id = None
+
+        if not api_task_id:
+            err_msg = error or "Unknown API Error"
+            attempts = job["attempts"] = job.get("attempts", 0) + 1
+            if transient and attempts < SUBMIT_MAX_ATTEMPTS:
+                await self.schedule_retry(stage, job, attempts, err_msg)
+                return
+
+            # FAILURE HANDLING (credits go back either way)
+            self.owned.discard(job["gen_id"])
+            model_limits.release(job["model_id"])
+            await stage.run(release_reservation, reservation)
             try:
-                # Get Price from DB to check Credits
-                try:
-                    price_res = supabase.table("ai_models").select("*").eq("model_id", model_id).execute()
-                except Exception as e:
-                    logger.error(f"[WORKER] Database error fetching model cost: {e}")
-                    price_res = None
-                
-                if not price_res.data:
-                    logger.error(f"[WORKER] Model ID '{model_id}' not found in ai_models table! Using default cost=0.")
-                    credit_cost = 0
+                if transient:
+                    logger.error(f"[WORKER] Task {job['gen_id']} dead-lettered after {attempts} attempts: {err_msg}")
+                    await stage.run(generation_state.dead_letter, job['gen_id'], f"API Error: {err_msg}", attempts)
+                    self.dead_lettered += 1
                 else:
-                    m_data = price_res.data[0]
-                    # Determine cost based on duration in task options
-                    # Default duration is 5 if not specified
-                    task_options_temp = task.get('options') or task.get('metadata') or task.get('task_metadata') or {}
-                    if isinstance(task_options_temp, str):
-                        try:
-                            task_options_temp = json.loads(task_options_temp)
-                        except:
-                            task_options_temp = {}
-                    
-                    duration = str(task_options_temp.get('duration', '5'))
-                    
-                    is_free_5s = m_data.get('is_free_pro_5s', False)
-                    base_cost = m_data.get('credit_cost') or 0
-                    
-                    # Pricing logic with fallback: Try specific -> Try Pro -> Try Base/Legacy
-                    cost_5s = int(m_data.get('cost_pro_5s') or m_data.get('cost_pro') or base_cost or 0)
-                    cost_10s = int(m_data.get('cost_pro_10s') or m_data.get('cost_pro') or (base_cost * 2) or 0)
-                    
-                    if duration == '5':
-                         credit_cost = 0 if is_free_5s else cost_5s
-                    else:
-                         credit_cost = cost_10s
-
-                if user.get('type') not in ['UNLIMITED', 'ADVANCE']:
-                    if not consume_credits(user['id'], credit_cost):
-                         # Failed credits
-                         logger.error(f"❌ User {user.get('code')} ran out of credits in queue.")
-                         try:
-                             supabase.table("generations").update({"status": "failed", "error": "Insufficient credits"}).eq("id", task['id']).execute()
-                         except Exception as db_e:
-                             logger.error(f"[WORKER] Failed to update generation status to failed: {db_e}")
-                         
-                         if task.get("telegram_chat_id"):
-                             await application.bot.send_message(chat_id=task["telegram_chat_id"], text="❌ Gagal: Kredit tidak mencukupi saat giliran Anda tiba.")
-                         continue
-
-                # Update status to PROCESSING immediately to lock it
-                try:
-                    supabase.table("generations").update({"status": "processing"}).eq("id", task['id']).execute()
-                except Exception as e:
-                    logger.error(f"[WORKER] Failed to lock generation record {task['id']} as processing: {e}")
-                    # If we can't lock it, we might want to skip to avoid double processing
-                    continue
-                
-                last_global_request_time = datetime.now().timestamp() # Reset timer
-
-                # Notify Telegram: Processing
-                if task.get("telegram_chat_id"):
-                   pass 
-
-                # --- NEW: SUBMIT TASK TO API ---
-                # api_task_id already initialized at top of loop
-                
-                try:
-                    # generation_helper usually expects image_url.
-                    # In 'generations' table it might be in 'thumbnail_url' or we use 'file_url' from 'tasks' if we had it.
-                    # The worker fetched from 'generations'. Let's check available fields.
-                    # Based on generation_helper.py:180, 'thumbnail_url' is used for image_url.
-                    img_url = task.get('thumbnail_url') 
-                    
-                    # If not in thumbnail_url, try to find it elsewhere or fail.
-                    if not img_url:
-                        # Fallback: maybe it's in the 'image' field if schema differs? 
-                        # Or 'video_url' if it's vid2vid? 
-                        # For now assume thumbnail_url is the source image.
-                        logger.warning(f"[WORKER] thumbnail_url is empty for task {task['id']}. Checking other fields.")
-                        # Minimal fallback if users table has something? Unlikely.
-                        pass
-
-                    if not img_url:
-                         raise Exception("Source image URL (thumbnail_url) is missing.")
-
-                    prompt = task.get('prompt')
-                    duration = str(task.get('duration', '5')) # Default '5'
-                    
-                    task_options = task.get('options') or task.get('metadata') or task.get('task_metadata') or {}
-                    if isinstance(task_options, str):
-                        try:
-                            task_options = json.loads(task_options)
-                        except:
-                            task_options = {}
-
-                    # Ensure aspect_ratio is passed
-                    if task.get('aspect_ratio'):
-                        task_options['aspect_ratio'] = task.get('aspect_ratio')
-
-
-                    # Submit
-                    api_task_id, used_key = submit_freepik_task(
-                        user=user,
-                        model_id=model_id,
-                        prompt=prompt,
-                        image_url=img_url,
-                        duration=duration,
-                        options=task_options
-                    )
-                except Exception as api_e:
-                    logger.error(f"[WORKER] API Submission Failed for {task['id']}: {api_e}")
-                    last_global_error = str(api_e)
-                    api_task_id = None
-
-                # CHECK IF WE GOT A TASK ID
-                if api_task_id:
-                    # Update generation record with API info
-                    try:
-                        supabase.table("generations").update({
-                            "task_id": api_task_id,
-                            "api_key_used": used_key,
-                            "credits_used": credit_cost,
-                            "aspect_ratio": task.get('aspect_ratio', '16:9')
-                        }).eq("id", task['id']).execute()
-                        logger.info(f"[WORKER] Generation {task['id']} updated with API details.")
-                    except Exception as e:
-                        logger.error(f"[WORKER] Database update error for generation {task['id']}: {e}")
-                    
-                    
-                    # SCHEDULE POLLING
-                    poll_callback = application.bot_data.get("poll_status_callback")
-                    if poll_callback:
-                        chat_id = int(task['telegram_chat_id']) if task.get('telegram_chat_id') else None
-                        
-                        if chat_id:
-                            # Msg ID handling
-                            msg_id = task.get('options', {}).get('msg_id')
-                            if msg_id:
-                                try:
-                                    await application.bot.edit_message_text(
-                                        chat_id=chat_id,
-                                        message_id=msg_id,
-                                        text="🚀 **Permintaan Diproses!**\nSedang menghubungkan ke server...",
-                                        parse_mode='Markdown'
-                                    )
-                                except Exception as e:
-                                    logger.warning(f"[WORKER] Failed to edit message: {e}")
-                            else:
-                                logger.info("[WORKER] No msg_id found, sending new message")
-                                try:
-                                    sent_msg = await application.bot.send_message(
-                                        chat_id=chat_id, 
-                                        text="🚀 **Permintaan Diproses!**\nSedang menghubungkan ke server...",
-                                        parse_mode='Markdown'
-                                    )
-                                    msg_id = sent_msg.message_id
-                                except Exception as e:
-                                    logger.error(f"[WORKER] Failed to send new message: {e}")
-
-                            application.job_queue.run_repeating(
-                                poll_callback, 
-                                interval=5, 
-                                first=1, 
-                                data={
-                                    "task_id": api_task_id, 
-                                    "gen_id": task['id'], 
-                                    "used_key": used_key,
-                                    "model_id": model_id,
-                                    "chat_id": chat_id, 
-                                    "msg_id": msg_id, 
-                                    "prompt": task['prompt'],
-                                    "user_id": user['id'],
-                                    "start_time": datetime.now(),
-                                    "credits_used": task.get('options', {}).get('credits_used', credit_cost)
-                                },
-                                name=f"poll_{api_task_id}"
-                            )
-                            logger.info(f"✅ Executed & Polling started for {api_task_id}")
-                        else:
-                             # No chat_id, but task started. Logic?
-                             logger.info(f"✅ Executed for {api_task_id} (No Telegram Chat ID)")
-                             
-                else:
-                    # FAILURE HANDLING
-                    err_msg = last_global_error if last_global_error else "Unknown API Error"
-                    logger.error(f"[WORKER] Failed to get API ID for task {task['id']}. Marking as failed.")
-                    
-                    try:
-                        supabase.table("generations").update({
-                            "status": "failed", 
-                            "error": f"API Error: {err_msg}"
-                        }).eq("id", task['id']).execute()
-                    except Exception as db_e:
-                        logger.error(f"[WORKER] Failed to update status to failed: {db_e}")
-                    
-                    if task.get("telegram_chat_id"):
-                         try:
-                             await application.bot.send_message(
-                                 chat_id=task["telegram_chat_id"], 
-                                 text=f"❌ Gagal memproses permintaan: {err_msg}"
-                             )
-                         except Exception as send_e:
-                             logger.error(f"[WORKER] Failed to send failure notification: {send_e}")
-                    continue
+                    logger.error(f"[WORKER] Failed to get API ID for task {job['gen_id']}. Marking as failed.")
+                    await stage.run(generation_state.fail, job['gen_id'], f"API Error: {err_msg}")
+            except Exception as db_e:
+                logger.error(f"[WORKER] Failed to update status to failed: {db_e}")
+            if transient:
+                await notify(
+                    self.application, job["chat_id"],
+                    f"❌ Server AI sedang sibuk, gagal setelah {attempts} percobaan. Kredit Anda sudah dikembalikan."
+                )
+            else:
+                await notify(self.application, job["chat_id"], f"❌ Gagal memproses permintaan: {err_msg}")
+            return
 
-            except Exception as e:
-                logger.error(f"[WORKER] Failed to execute task {task['id']}: {e}", exc_info=True)
-                try:
-                    supabase.table("generations").update({"status": "failed", "error": str(e)}).eq("id", task['id']).execute()
-                except Exception as db_e:
-                    logger.error(f"[WORKER] Double failure: Could not update generation status: {db_e}")
-                if task.get("telegram_chat_id"):
-                    await application.bot.send_message(chat_id=task["telegram_chat_id"], text=f"❌ Gagal memproses: {str(e)}")
+        # Update generation record with API info
+        try:
+            await stage.run(generation_state.record_submission, job['gen_id'], api_task_id, used_key, provider=provider)
+            logger.info(f"[WORKER] Generation {job['gen_id']} updated with API details ({provider}, key {key_hint(used_key)}).")
+        except Exception as e:
+            logger.error(f"[WORKER] Database update error for generation {job['gen_id']}: {e}")
+
+        model = catalog.get(job["model_id"]) or {}
+        job.update(
+            provider=provider, task_id=api_task_id, used_key=used_key, start_time=datetime.now(),
+            deadline=time.monotonic() + (model.get("poll_deadline_seconds") or POLL_DEADLINE_SECONDS),
+            poll_errors=0,
+        )
+        del job["task"], job["user"], job["options"]  # Not needed past submission
+
+        if not job["chat_id"]:
+            # Nobody to report to; the row is still polled and completed
+            logger.info(f"✅ Executed for {api_task_id} (No Telegram Chat ID)")
+        elif job["msg_id"]:
+            await edit(
+                self.application, job,
+                "🚀 **Permintaan Diproses!**\nSedang menghubungkan ke server...",
+                parse_mode='Markdown'
+            )
+        else:
+            logger.info("[WORKER] No msg_id found, sending new message")
+            sent_msg = await notify(
+                self.application, job["chat_id"],
+                "🚀 **Permintaan Diproses!**\nSedang menghubungkan ke server...",
+                parse_mode='Markdown'
+            )
+            job["msg_id"] = sent_msg.message_id if sent_msg else None
 
+        self.active_polls[job["gen_id"]] = time.monotonic()
+        self.poll.put_later(job, POLL_FIRST_DELAY_SECONDS)
+        logger.info(f"✅ Executed & Polling started for {api_task_id}")
+
+    async def schedule_retry(self, stage, job, attempts, err_msg):
+        """Park a temporarily failed submission on the retry stage (row stays processing, credits reserved)."""
+        delay = retry_delay(attempts)
+        self.retried += 1
+        logger.warning(
+            f"[WORKER] Submit attempt {attempts}/{SUBMIT_MAX_ATTEMPTS} for {job['gen_id']} failed ({err_msg}); "
+            f"retrying in {delay:.1f}s"
+        )
+        try:
+            await stage.run(generation_state.record_retry, job['gen_id'], attempts)
         except Exception as e:
-            logger.error(f"[WORKER] Worker Loop Error: {e}", exc_info=True)
-            await asyncio.sleep(5)
+            logger.error(f"[WORKER] Failed to record retry for {job['gen_id']}: {e}")
+        await edit(
+            self.application, job,
+            f"⏳ **Server AI sedang sibuk.**\nMencoba lagi otomatis ({attempts}/{SUBMIT_MAX_ATTEMPTS - 1})...",
+            parse_mode='Markdown'
+        )
+        self.retry.put_later(job, delay)
+
+    # --- poll ---
+
+    async def check_status(self, job):
+        try:
+            return await self.poll.run(poll_generation, job["provider"], job["task_id"], job["model_id"], job["used_key"])
+        except Exception as e:
+            logger.error(f"Poll Job Error: {e}")
+            return "error", str(e)
+
+    async def poll_task(self, job):
+        """
+        One status check. Unfinished tasks are parked and polled again later,
+        until their deadline or POLL_MAX_ERRORS unanswered checks in a row.
+        """
+        elapsed = int((datetime.now() - job["start_time"]).total_seconds())
+        status, video_url = await self.check_status(job)
+
+        if status == "completed" and video_url:
+            await self.hand_to_deliver(job, video_url, elapsed)
+            return
+
+        if status == "failed":
+            await self.fail_polled(job, f"Provider Error: {video_url}", f"❌ Gagal: {video_url}")
+            return
+
+        if status == "processing":
+            job["poll_errors"] = 0
+        else:
+            # "error", or "completed" without a video URL: no answer this time
+            job["poll_errors"] += 1
+            logger.warning(f"[WORKER] Poll {job['poll_errors']}/{POLL_MAX_ERRORS} for {job['gen_id']} got no answer: {status} {video_url}")
+
+        if job["poll_errors"] >= POLL_MAX_ERRORS or time.monotonic() >= job["deadline"]:
+            await self.give_up(job, elapsed)
+            return
+
+        if status == "processing":
+            # Visual Progress (Fake but satisfying)
+            progress = min(98, (elapsed * 2))
+            bar = "▓" * (progress // 10) + "░" * (10 - (progress // 10))
+            await edit(
+                self.application, job,
+                f"🎬 **Video sedang di-generate...**\n\n`[{bar}] {progress}%`\nWaktu berjalan: {elapsed} detik",
+                parse_mode='Markdown'
+            )
+        self.poll.put_later(job, POLL_INTERVAL_SECONDS)
+
+    async def hand_to_deliver(self, job, video_url, elapsed):
+        self.active_polls.pop(job["gen_id"], None)
+        job["video_url"] = video_url
+        await edit(
+            self.application, job,
+            f"✅ **Video Selesai!** ({elapsed}s)\nSedang memproses file akhir...",
+            parse_mode='Markdown'
+        )
+        await self.deliver.put(job)
+
+    async def fail_polled(self, job, error, message):
+        """Final failure of a submitted task: key / model slots, failed row, refund, message."""
+        self.active_polls.pop(job["gen_id"], None)
+        self.owned.discard(job["gen_id"])
+        get_pool(job.get("lane")).release(job["used_key"])
+        model_limits.release(job["model_id"])
+        try:
+            await self.poll.run(generation_state.fail, job["gen_id"], error)
+            await self.poll.run(refund_credits, job.get("reservation_id"))
+        except Exception as e:
+            logger.error(f"Failed to record failure for generation {job['gen_id']}: {e}")
+        await edit(self.application, job, message)
+
+    async def give_up(self, job, elapsed):
+        """Deadline or error budget used up: verify one last time, then fail and refund."""
+        status, video_url = await self.check_status(job)
+        if status == "completed" and video_url:
+            await self.hand_to_deliver(job, video_url, elapsed)
+            return
+        self.poll_timeouts += 1
+        reason = "no answer from provider" if job["poll_errors"] >= POLL_MAX_ERRORS else "deadline passed"
+        logger.error(f"[WORKER] Giving up on {job['gen_id']} after {elapsed}s ({reason}, last status {status})")
+        await self.fail_polled(
+            job, f"Poll timeout after {elapsed}s ({reason})",
+            "❌ Gagal: waktu pembuatan video habis. Kredit Anda sudah dikembalikan."
+        )
+
+    # --- deliver ---
+
+    async def deliver_task(self, job):
+        """Copy the video to R2, complete the row, commit credits, send the video."""
+        video_url = job["video_url"]
+        video_name = f"gen_video_{job['gen_id']}.mp4"
+        r2_video_url = await self.deliver.run(get_r2().upload_from_url, video_url, video_name, content_type='video/mp4')
+
+        # processing -> completed + video count, one RPC
+        completed = True
+        try:
+            completed = await self.deliver.run(generation_state.complete, job["gen_id"], video_url, r2_video_url)
+        except Exception as e:
+            # Row most likely still processing: deliver, the credits stay charged as before
+            logger.error(f"[WORKER] Failed to complete generation {job['gen_id']}: {e}")
+        self.owned.discard(job["gen_id"])
+        get_pool(job.get("lane")).release(job["used_key"])
+        model_limits.release(job["model_id"])
+        if not completed:
+            # Already failed (and refunded) elsewhere: no charge, no video for a failed row
+            logger.warning(f"[WORKER] Generation {job['gen_id']} is no longer processing; skipping credit commit and delivery.")
+            return
+
+        try:
+            await self.deliver.run(commit_credits, job.get("reservation_id"))
+        except Exception as e:
+            logger.error(f"Failed to commit credit reservation {job.get('reservation_id')}: {e}")
+
+        if not job["chat_id"]:
+            return
+
+        # ====== POST-GENERATE SUMMARY ======
+        # Balance comes from the reserve_credits RPC result (no extra users lookup)
+        credits_used = job.get("credits_used", 0)
+        new_credits = job.get("balance")
+        user_type = (job.get("user_type") or '').lower()
+        prompt = job["prompt"]
+
+        caption = (
+            f"🎬 **Video UniverseAI**\n"
+            f"Model: `{job['model_id']}`\n"
+            f"Prompt: \"{prompt[:50]}{'...' if len(prompt) > 50 else ''}\"\n\n"
+            f"─────────────────\n"
+        )
+        if user_type in ['ultra', 'unlimited']:
+            caption += f"💰 **Biaya:** Gratis (Unlimited)\n"
+        else:
+            caption += f"💰 **Biaya:** {credits_used} 🪙\n"
+            if new_credits is not None:
+                caption += f"💎 **Sisa Saldo:** {new_credits} 🪙\n"
+        caption += "─────────────────"
+
+        post_buttons = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🎬 Buat Video Lagi", callback_data="menu_create")],
+            [InlineKeyboardButton("📥 Download File", callback_data=f"dl_{job['gen_id']}")]
+        ])
+        # ====== END POST-GENERATE ======
+
+        await self.application.bot.send_video(
+            chat_id=job["chat_id"],
+            video=r2_video_url or video_url,
+            caption=caption,
+            parse_mode='Markdown',
+            reply_markup=post_buttons
+        )
+
+    # --- metrics ---
+
+    def throughput(self, window, min_claims=1, min_busy_seconds=0):
+        """
+        Shared-lane claim capacity: tasks claimed per second of backlogged time
+        (the last `window` seconds minus the time the queue was empty), so a
+        quiet period does not read as a slow worker. 0.0 below min_claims
+        claims or min_busy_seconds of backlogged time.
+        """
+        now = time.monotonic()
+        since = max(now - window, self.started_at)
+        recent = sum(1 for t in self._shared_claimed_at if t >= since)
+        idle = sum(max(0.0, end - max(start, since)) for start, end in self._idle_spans if end > since)
+        busy = now - since - idle
+        if recent < min_claims or busy <= 0 or busy < min_busy_seconds:
+            return 0.0
+        return recent / busy
+
+    def describe(self):
+        times = sorted(self._claim_times)
+        avg_ms = int(sum(times) / len(times) * 1000) if times else 0
+        lines = [
+            f"claim: claimed {self.claimed}, avg {avg_ms} ms, "
+            f"retried {self.retried}, dead-lettered {self.dead_lettered}"
+        ]
+        oldest = int(time.monotonic() - min(self.active_polls.values())) if self.active_polls else 0
+        lines.append(
+            f"polling: active {len(self.active_polls)}, oldest {oldest}s, timed out {self.poll_timeouts}, "
+            f"held {len(self.owned)}"
+        )
+        lines += [stage.describe() for stage in self.stages]
+        return " | ".join(lines)
+
+
+async def worker_loop(application):
+    """
+    Main background task: runs the claim loop and the stage workers.
+    application: The python-telegram-bot Application instance (bot for notifications).
+    """
+    logger.info("👷 Queue Worker Started!")
+    worker = QueueWorker(application)
+    application.bot_data["queue_worker"] = worker
+    for stage in worker.stages:
+        stage.start()
+    claim = asyncio.create_task(worker.claim_loop(), name="stage-claim")
+
+    try:
+        while True:
+            # Heartbeat every 30s
+            logger.info("[WORKER HEARTBEAT] Worker is alive and checking for tasks...")
+            logger.info(f"[WORKER HEARTBEAT] Stages: {worker.describe()}")
+            logger.info(f"[WORKER HEARTBEAT] Shared lane limits: {limits.describe()}")
+            logger.info(f"[WORKER HEARTBEAT] Providers: {providers.describe()}")
+            try:
+                pending = await asyncio.to_thread(pending_by_model)
+            except Exception as e:
+                logger.error(f"[WORKER] Error reading pending tasks per model: {e}")
+                pending = None
+            model_stats = model_limits.snapshot(pending)
+            if model_stats:
+                logger.info(f"[WORKER HEARTBEAT] Models: {model_stats}")
+            key_stats = key_pool.snapshot()
+            if key_stats:
+                logger.info(f"[WORKER HEARTBEAT] Key pool: {key_stats}")
+            byok_stats = byok_pool.snapshot()
+            if byok_stats:
+                logger.info(f"[WORKER HEARTBEAT] BYOK keys: {byok_stats}")
+            await asyncio.sleep(HEARTBEAT_SECONDS)
+    finally:
+        claim.cancel()
+        for stage in worker.stages:
+            await stage.stop()
@@ -1,9 +1,6 @@
 import os
-import boto3
-from botocore.config import Config
-from dotenv import load_dotenv
-
-load_dotenv()
+import threading
+from clients import http_session  # Also loads .env
 
 class R2Helper:
     def __init__(self):
@@ -12,15 +9,26 @@ class R2Helper:
         self.secret_access_key = os.getenv("R2_SECRET_ACCESS_KEY")
         self.bucket_name = os.getenv("R2_BUCKET_NAME")
         self.public_url = os.getenv("R2_PUBLIC_URL").rstrip('/')
+        self._s3_client = None
+        self._lock = threading.Lock()
 
-        self.s3_client = boto3.client(
-            service_name='s3',
-            endpoint_url=f'https://{self.account_id}.r2.cloudflarestorage.com',
-            aws_access_key_id=self.access_key_id,
-            aws_secret_access_key=self.secret_access_key,
-            region_name='auto',
-            config=Config(signature_version='s3v4')
-        )
+    @property
+    def s3_client(self):
+        """boto3 client, built on first upload (boto3 import + client setup is slow)."""
+        if self._s3_client is None:
+            with self._lock:
+                if self._s3_client is None:
+                    import boto3
+                    from botocore.config import Config
+                    self._s3_client = boto3.client(
+                        service_name='s3',
+                        endpoint_url=f'https://{self.account_id}.r2.cloudflarestorage.com',
+                        aws_access_key_id=self.access_key_id,
+                        aws_secret_access_key=self.secret_access_key,
+                        region_name='auto',
+                        config=Config(signature_version='s3v4')
+                    )
+        return self._s3_client
 
     def upload_file(self, file_path, object_name, content_type='image/jpeg'):
         """Upload a file to R2 bucket"""
@@ -47,8 +55,7 @@ class R2Helper:
     def upload_from_url(self, url, object_name, content_type='video/mp4'):
         """Download from URL and upload to R2"""
         try:
-            import requests
-            response = requests.get(url, timeout=60, stream=True)
+            response = http_session().get(url, timeout=60)
             if response.status_code == 200:
                 self.s3_client.put_object(
                     Bucket=self.bucket_name,
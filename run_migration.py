@@ -1,81 +1,312 @@
 """
-Execute migration via Supabase's postgrest-py raw execution.
-Uses the REST API to call a stored procedure or direct SQL.
+Versioned migration runner for supabase/migrations.
+
+Applies every `<version>_<name>.sql` file in version order, records what was
+applied in public.bot_schema_migrations (version, checksum, duration) and skips
+it next time. Files containing the marker `-- migrate:no-transaction` are run
+statement by statement in autocommit mode so `CREATE INDEX CONCURRENTLY` works;
+everything else runs in a single transaction.
+
+Connects straight to Postgres (DATABASE_URL, e.g. the Supabase "connection
+string" for the service role). Works the same against a local Postgres:
+
+    DATABASE_URL=postgresql://postgres@localhost:5432/universe_test \
+        python run_migration.py --bootstrap --explain
+
+Options:
+    --status        list applied / pending migrations and exit
+    --dry-run       show what would run, change nothing
+    --explain       print EXPLAIN plans of the worker's hot queries before and after
+    --bootstrap     apply supabase/local_base_schema.sql first (LOCAL DATABASES ONLY)
+    --baseline V    mark every migration up to version V as applied without running it
+                    (for databases where the old .sql files were applied by hand)
 """
 import os
-import requests
+import re
+import sys
+import time
+import hashlib
+import argparse
 from dotenv import load_dotenv
 
 load_dotenv()
 
-SUPABASE_URL = os.getenv("SUPABASE_URL")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-
-def run_sql_migration():
-    """Execute ALTER TABLE via Supabase SQL API."""
-    
-    # Supabase provides a SQL execution endpoint for service_role key
-    sql_endpoint = f"{SUPABASE_URL}/rest/v1/rpc/exec_sql"
-    
-    headers = {
-        "apikey": SUPABASE_KEY,
-        "Authorization": f"Bearer {SUPABASE_KEY}",
-        "Content-Type": "application/json",
-        "Prefer": "return=minimal"
-    }
-    
-    migrations = [
-        "ALTER TABLE public.ai_models ADD COLUMN IF NOT EXISTS is_free_pro_5s BOOLEAN DEFAULT FALSE",
-        "ALTER TABLE public.ai_models ADD COLUMN IF NOT EXISTS cost_pro_5s INTEGER DEFAULT 0",
-        "ALTER TABLE public.ai_models ADD COLUMN IF NOT EXISTS cost_pro_10s INTEGER DEFAULT 0",
-        "COMMENT ON COLUMN public.ai_models.is_free_pro_5s IS 'If true, 5-second videos are free for Pro users'",
-        "COMMENT ON COLUMN public.ai_models.cost_pro_5s IS 'Credit cost for 5-second videos (Pro tier)'",
-        "COMMENT ON COLUMN public.ai_models.cost_pro_10s IS 'Credit cost for 10-second videos (Pro tier)'"
-    ]
-    
-    print("🔧 Running migrations via direct SQL...")
-    print(f"📡 Target: {SUPABASE_URL}")
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MIGRATIONS_DIR = os.path.join(ROOT, "supabase", "migrations")
+LOCAL_BASE_SCHEMA = os.path.join(ROOT, "supabase", "local_base_schema.sql")
+
+NO_TRANSACTION_MARKER = "-- migrate:no-transaction"
+MIGRATION_FILE_RE = re.compile(r"^(\d{14})_(.+)\.sql$")
+ADVISORY_LOCK_ID = 726_115_001  # Only one runner at a time
+
+# The queries the Telegram worker runs on every loop iteration (see queue_worker.py)
+HOT_QUERIES = {
+    "worker fetch (oldest pending)": (
+        "SELECT * FROM public.generations WHERE status = 'pending' AND source = 'telegram' "
+        "ORDER BY created_at LIMIT 1"
+    ),
+    "global concurrency (shared lane)": (
+        "SELECT count(*) FROM public.generations WHERE status = 'processing' AND lane = 'shared' "
+        "AND claimed_at >= now() - interval '15 minutes'"
+    ),
+    "per-user concurrency": (
+        "SELECT count(*) FROM public.generations "
+        "WHERE user_id = '00000000-0000-0000-0000-000000000000' AND status = 'processing'"
+    ),
+    "queue depth": (
+        "SELECT count(*) FROM public.generations WHERE status = 'pending' AND source = 'telegram'"
+    ),
+}
+
+
+def split_sql(sql):
+    """
+    Split a SQL script into statements on top-level semicolons, respecting
+    quotes, dollar-quoted bodies ($$ ... $$, $tag$ ... $tag$) and comments.
+    """
+    statements = []
+    buf = []
+    i = 0
+    n = len(sql)
+    while i < n:
+        c = sql[i]
+        if c == "-" and sql.startswith("--", i):
+            end = sql.find("\n", i)
+            end = n if end == -1 else end + 1
+            buf.append(sql[i:end])
+            i = end
+        elif c == "/" and sql.startswith("/*", i):
+            end = sql.find("*/", i + 2)
+            end = n if end == -1 else end + 2
+            buf.append(sql[i:end])
+            i = end
+        elif c in ("'", '"'):
+            j = i + 1
+            while j < n:
+                if sql[j] == c:
+                    if j + 1 < n and sql[j + 1] == c:  # escaped '' / ""
+                        j += 2
+                        continue
+                    break
+                j += 1
+            buf.append(sql[i:j + 1])
+            i = j + 1
+        elif c == "$":
+            m = re.match(r"\$[A-Za-z_]*\$", sql[i:])
+            if m:
+                tag = m.group(0)
+                end = sql.find(tag, i + len(tag))
+                end = n if end == -1 else end + len(tag)
+                buf.append(sql[i:end])
+                i = end
+            else:
+                buf.append(c)
+                i += 1
+        elif c == ";":
+            statements.append("".join(buf))
+            buf = []
+            i += 1
+        else:
+            buf.append(c)
+            i += 1
+    statements.append("".join(buf))
+
+    def has_code(stmt):
+        stripped = re.sub(r"--[^\n]*", "", stmt)
+        stripped = re.sub(r"/\*.*?\*/", "", stripped, flags=re.S)
+        return stripped.strip() != ""
+
+    return [s.strip() for s in statements if has_code(s)]
+
+
+def discover_migrations():
+    """[(version, name, path, sql, checksum)] sorted by version."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        m = MIGRATION_FILE_RE.match(filename)
+        if not m:
+            if filename.endswith(".sql"):
+                print(f"⚠️ Skipping {filename}: name must look like <YYYYMMDDHHMMSS>_<name>.sql")
+            continue
+        path = os.path.join(MIGRATIONS_DIR, filename)
+        with open(path, encoding="utf-8") as f:
+            sql = f.read()
+        checksum = hashlib.sha256(sql.encode()).hexdigest()
+        migrations.append((m.group(1), m.group(2), path, sql, checksum))
+    return migrations
+
+
+def connect():
+    try:
+        import psycopg2
+    except ImportError:
+        print("❌ psycopg2 is not installed (pip install -r requirements.txt)")
+        sys.exit(1)
+    if not DATABASE_URL:
+        print("❌ DATABASE_URL is not set (Supabase: Project Settings -> Database -> Connection string)")
+        sys.exit(1)
+    conn = psycopg2.connect(DATABASE_URL)
+    conn.autocommit = True
+    return conn
+
+
+def ensure_migrations_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS public.bot_schema_migrations (
+            version TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            checksum TEXT NOT NULL,
+            duration_ms INTEGER,
+            applied_at TIMESTAMPTZ DEFAULT now()
+        )
+    """)
+
+
+def applied_migrations(cur):
+    cur.execute("SELECT version, checksum FROM public.bot_schema_migrations")
+    return dict(cur.fetchall())
+
+
+def record_migration(cur, version, name, checksum, duration_ms):
+    cur.execute(
+        "INSERT INTO public.bot_schema_migrations (version, name, checksum, duration_ms) VALUES (%s, %s, %s, %s)",
+        (version, name, checksum, duration_ms),
+    )
+
+
+def apply_migration(conn, version, name, sql, checksum):
+    """Run one migration file and record it. Returns duration in ms."""
+    started = time.time()
+    with conn.cursor() as cur:
+        if NO_TRANSACTION_MARKER in sql:
+            # Autocommit, one statement at a time (CREATE INDEX CONCURRENTLY)
+            for stmt in split_sql(sql):
+                stmt_started = time.time()
+                cur.execute(stmt)
+                code_lines = [l for l in stmt.splitlines() if l.strip() and not l.strip().startswith("--")]
+                first_line = code_lines[0].strip()[:70] if code_lines else stmt[:70]
+                print(f"     {first_line} ({(time.time() - stmt_started) * 1000:.0f} ms)")
+            duration_ms = int((time.time() - started) * 1000)
+            record_migration(cur, version, name, checksum, duration_ms)
+        else:
+            cur.execute("BEGIN")
+            try:
+                cur.execute(sql)
+                duration_ms = int((time.time() - started) * 1000)
+                record_migration(cur, version, name, checksum, duration_ms)
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+    return duration_ms
+
+
+def print_explain(conn, title):
+    print(f"\n📊 EXPLAIN ({title})")
+    print("-" * 60)
+    with conn.cursor() as cur:
+        for label, query in HOT_QUERIES.items():
+            print(f"\n▶ {label}")
+            try:
+                cur.execute("EXPLAIN " + query)
+                for (line,) in cur.fetchall():
+                    print(f"   {line}")
+            except Exception as e:
+                print(f"   (skipped: {str(e).strip()})")
+
+
+def run_migrations(args):
+    migrations = discover_migrations()
+    conn = connect()
+    print("🔧 Migration runner")
+    print(f"📂 {MIGRATIONS_DIR}")
     print("-" * 50)
-    
-    # Try using Supabase's internal query endpoint (newer API)
-    query_endpoint = f"{SUPABASE_URL}/pg/query"
-    
-    for idx, sql in enumerate(migrations, 1):
-        print(f"\n[{idx}/3] Executing: {sql[:50]}...")
-        
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (ADVISORY_LOCK_ID,))
+        if not cur.fetchone()[0]:
+            print("❌ Another migration runner holds the lock. Aborting.")
+            return False
+
+        if args.bootstrap:
+            print("🧪 Applying local base schema (local databases only)...")
+            with open(LOCAL_BASE_SCHEMA, encoding="utf-8") as f:
+                cur.execute(f.read())
+
+        ensure_migrations_table(cur)
+        applied = applied_migrations(cur)
+
+    for version, name, _path, _sql, checksum in migrations:
+        if version in applied and applied[version] != checksum:
+            print(f"⚠️ {version}_{name} changed after it was applied (checksum mismatch)")
+
+    pending = [m for m in migrations if m[0] not in applied]
+
+    if args.status:
+        for version, name, *_ in migrations:
+            mark = "✅" if version in applied else "⏳"
+            print(f"  {mark} {version}_{name}")
+        print(f"\n{len(migrations) - len(pending)} applied, {len(pending)} pending")
+        return True
+
+    if args.baseline:
+        with conn.cursor() as cur:
+            for version, name, _path, _sql, checksum in pending:
+                if version <= args.baseline:
+                    record_migration(cur, version, name, checksum, 0)
+                    print(f"  📌 Marked {version}_{name} as applied (baseline)")
+        return True
+
+    if not pending:
+        print("✅ Database is up to date.")
+        if args.explain:
+            print_explain(conn, "current")
+        return True
+
+    if args.explain:
+        print_explain(conn, "before")
+
+    total_started = time.time()
+    for idx, (version, name, _path, sql, checksum) in enumerate(pending, 1):
+        mode = "no-transaction" if NO_TRANSACTION_MARKER in sql else "transaction"
+        print(f"\n[{idx}/{len(pending)}] {version}_{name} ({mode})")
+        if args.dry_run:
+            continue
         try:
-            # Method 1: Try pg/query endpoint
-            resp = requests.post(
-                query_endpoint,
-                headers=headers,
-                json={"query": sql}
-            )
-            
-            if resp.status_code in [200, 201, 204]:
-                print(f"  ✅ Success!")
-            elif resp.status_code == 404:
-                # Endpoint not available, show manual instructions
-                print(f"  ⚠️ pg/query endpoint not available")
-                raise Exception("Need manual execution")
-            else:
-                print(f"  ❌ Failed: {resp.status_code} - {resp.text[:100]}")
-                
+            duration_ms = apply_migration(conn, version, name, sql, checksum)
+            print(f"  ✅ Applied in {duration_ms} ms")
         except Exception as e:
-            print(f"  ❌ Error: {e}")
-            print("\n" + "=" * 60)
-            print("📋 MANUAL MIGRATION REQUIRED")
-            print("=" * 60)
-            print("\nPlease run this SQL in Supabase SQL Editor:")
-            print("\n```sql")
-            for s in migrations:
-                print(f"{s};")
-            print("```")
-            print(f"\n🌐 Open: https://supabase.com/dashboard/project/xbaewxnzlfxltvsjefvr/sql")
+            print(f"  ❌ Failed: {e}")
+            if mode == "no-transaction":
+                print("  ⚠️ Statements before the failure are already committed; the file must be re-runnable.")
             return False
-    
+
+    if args.dry_run:
+        print("\n(dry run, nothing applied)")
+        return True
+
+    print(f"\n⏱️ {len(pending)} migration(s) in {(time.time() - total_started) * 1000:.0f} ms")
+
+    if args.explain:
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE public.generations")
+        print_explain(conn, "after")
     return True
 
+
 if __name__ == "__main__":
-    success = run_sql_migration()
+    parser = argparse.ArgumentParser(description="Apply supabase/migrations in version order.")
+    parser.add_argument("--status", action="store_true", help="List applied / pending migrations")
+    parser.add_argument("--dry-run", action="store_true", help="Show pending migrations without applying")
+    parser.add_argument("--explain", action="store_true", help="EXPLAIN the worker's hot queries before/after")
+    parser.add_argument("--bootstrap", action="store_true", help="Apply supabase/local_base_schema.sql first (local only)")
+    parser.add_argument("--baseline", metavar="VERSION", help="Mark migrations up to VERSION as applied")
+    args = parser.parse_args()
+
+    success = run_migrations(args)
     if success:
-        print("\n✅ All migrations completed successfully!")
+        print("\n✅ Done.")
+    else:
+        sys.exit(1)
@@ -0,0 +1,166 @@
+"""
+Per-update overhead of BotPersistence.
+
+Pushes a 4-step conversation for many chats through Application.process_update
+(the handler path) with persistence off and on, and reports handler latency
+per update plus what the background flushes cost. A fake Bot API on localhost
+answers getMe; the handlers do not call Telegram.
+
+Then writes the same final rows once per row (what an unbuffered backend does
+every update_interval) and once as a single batch, to show what batching saves.
+
+    python scripts/bench_persistence.py --chats 500
+    DATABASE_URL=postgresql://... python scripts/bench_persistence.py   # adds Postgres
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from telegram import Update, Message, Chat, User  # noqa: E402
+from telegram.ext import ApplicationBuilder, CommandHandler, ConversationHandler, MessageHandler, filters  # noqa: E402
+from bot_persistence import BotPersistence, SQLiteStore, PostgresStore, conversation_scope, encode_key, USER_DATA  # noqa: E402
+from scripts.webhook_replica_harness import FakeBotApi, TOKEN  # noqa: E402
+
+MODEL, DURATION, MEDIA = range(3)
+STEPS = ["/start", "kling-v2", "10", "photo"]
+
+
+async def start(update, context):
+    return MODEL
+
+
+async def pick_model(update, context):
+    context.user_data["selected_model_id"] = update.message.text
+    return DURATION
+
+
+async def pick_duration(update, context):
+    context.user_data["selected_duration"] = update.message.text
+    context.user_data["calculated_cost"] = 25
+    return MEDIA
+
+
+async def media(update, context):
+    context.user_data["selected_ratio"] = "16:9"
+    return ConversationHandler.END
+
+
+def make_update(bot, update_id, chat_id, text):
+    entities = None
+    if text.startswith("/"):
+        from telegram import MessageEntity
+        entities = [MessageEntity(MessageEntity.BOT_COMMAND, 0, len(text))]
+    message = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type=Chat.PRIVATE),
+        from_user=User(id=chat_id, is_bot=False, first_name="u"),
+        text=text,
+        entities=entities,
+    )
+    message.set_bot(bot)
+    return Update(update_id=update_id, message=message)
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))] if values else 0
+
+
+async def run(label, api_url, chats, persistence):
+    builder = ApplicationBuilder().token(TOKEN).base_url(f"{api_url}/bot").updater(None)
+    if persistence:
+        builder = builder.persistence(persistence)
+    application = builder.build()
+    text = filters.TEXT & ~filters.COMMAND
+    application.add_handler(ConversationHandler(
+        entry_points=[CommandHandler("start", start)],
+        states={
+            MODEL: [MessageHandler(text, pick_model)],
+            DURATION: [MessageHandler(text, pick_duration)],
+            MEDIA: [MessageHandler(text, media)],
+        },
+        fallbacks=[],
+        name="bench",
+        persistent=persistence is not None,
+    ))
+
+    latencies = []
+    async with application:
+        await application.start()
+        started = time.perf_counter()
+        update_id = 0
+        for step in STEPS:
+            for chat_id in chats:
+                update_id += 1
+                update = make_update(application.bot, update_id, chat_id, step)
+                t0 = time.perf_counter()
+                await application.process_update(update)
+                latencies.append(time.perf_counter() - t0)
+                await asyncio.sleep(0)  # Let the persistence loop run like it would between updates
+        elapsed = time.perf_counter() - started
+        await application.stop()
+
+    print(f"\n▶ {label}")
+    print(f"   {len(latencies)} updates in {elapsed:.2f}s")
+    print(f"   handler path   p50 {percentile(latencies, 50) * 1e6:6.0f} µs   p95 {percentile(latencies, 95) * 1e6:6.0f} µs")
+    if persistence:
+        per_update = persistence.flush_seconds / len(latencies) * 1e6
+        print(
+            f"   background     {persistence.flushes} flushes, {persistence.rows_written} rows, "
+            f"{persistence.flush_seconds * 1000:.0f} ms total ({per_update:.0f} µs per update, off the handler path)"
+        )
+    return percentile(latencies, 50)
+
+
+def batching_gain(label, store, chats):
+    rows = []
+    for chat_id in chats:
+        rows.append((USER_DATA, str(chat_id), {"selected_model_id": "kling-v2", "selected_duration": "10",
+                                               "calculated_cost": 25, "selected_ratio": "16:9"}))
+        rows.append((conversation_scope("gain"), encode_key((chat_id, chat_id)), MEDIA))
+    t0 = time.perf_counter()
+    for row in rows:
+        store.save_many([row])
+    one_by_one = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    store.save_many(rows)
+    batched = time.perf_counter() - t0
+    store.save_many([(scope, key, None) for scope, key, _ in rows])
+    print(f"   {label}: {len(rows)} rows one by one {one_by_one * 1000:.0f} ms, one batch {batched * 1000:.0f} ms "
+          f"({one_by_one / batched:.0f}x)")
+
+
+async def main(args):
+    api = FakeBotApi()
+    api.serve(args.port)
+    api_url = f"http://127.0.0.1:{args.port}"
+    chats = [20_000 + i for i in range(args.chats)]
+    stores = [("SQLite", SQLiteStore(os.path.join(tempfile.mkdtemp(prefix="bot_bench_"), "state.sqlite3")))]
+    if os.getenv("DATABASE_URL"):
+        stores.append(("Postgres", PostgresStore(os.getenv("DATABASE_URL"))))
+
+    print(f"🧪 {args.chats} chats x {len(STEPS)} steps, update_interval {args.interval}s")
+    base = await run("no persistence", api_url, chats, None)
+    for label, store in stores:
+        p50 = await run(f"BotPersistence ({label})", api_url, chats, BotPersistence(store, update_interval=args.interval))
+        print(f"   overhead vs no persistence: {(p50 - base) * 1e6:+.0f} µs per update (p50)")
+
+    print("\n📦 Write batching")
+    for label, store in stores:
+        batching_gain(label, store, chats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure BotPersistence overhead per update")
+    parser.add_argument("--chats", type=int, default=500)
+    parser.add_argument("--interval", type=float, default=0.2, help="PTB persistence update_interval")
+    parser.add_argument("--port", type=int, default=18500)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,146 @@
+"""
+Queue position index (queue_index.QueueIndex): correctness and cost.
+
+Builds an index of N pending rows, then mixes enqueues (add), claims of the
+oldest rows (discard) and resyncs with changes racing the resync query. After
+every step each task's position must equal its rank by (created_at, id), the
+order the worker claims in. Then times position lookups and one
+due_updates() pass, against counting "created_at < mine" per task (what a
+per-user count query does in the database).
+
+    python scripts/bench_queue_index.py --pending 5000
+"""
+import os
+import sys
+import uuid
+import time
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+
+from queue_index import QueueIndex, parse_ts  # noqa: E402
+
+START = datetime(2026, 10, 19, tzinfo=timezone.utc)
+
+
+def make_row(i):
+    # PostgREST trims trailing zeros of the fraction ("...34.5+00:00"): string order would break,
+    # and fromisoformat before Python 3.11 rejects it (queue_index.parse_ts pads it)
+    stamp = (START + timedelta(milliseconds=i * 37)).isoformat(timespec="microseconds")
+    head, offset = stamp[:-6], stamp[-6:]
+    created = (head.rstrip("0").rstrip(".") if "." in head else head) + offset
+    return {
+        "id": str(uuid.uuid4()),
+        "created_at": created,
+        "telegram_chat_id": str(1000 + i),
+        "model_name": "kling-v2-1-std",
+        "options": {"duration": "5", "msg_id": i + 1},
+    }
+
+
+class FakeDb:
+    """Stands in for the resync query; `during` runs while the query is "in flight"."""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.during = None
+
+    def table(self, name):
+        return self
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        data = [dict(row) for row in self.rows.values()]
+        if self.during:
+            self.during()
+            self.during = None
+        return type("Res", (), {"data": data})()
+
+
+def check(index, rows):
+    expected = sorted(rows.values(), key=lambda r: (parse_ts(r["created_at"]), r["id"]))
+    for rank, row in enumerate(expected, 1):
+        if index.position(row["id"]) != rank:
+            return False
+    return len(index) == len(rows)
+
+
+def main(args):
+    random.seed(7)
+    rows = {}
+    counter = 0
+    for _ in range(args.pending):
+        row = make_row(counter)
+        counter += 1
+        rows[row["id"]] = row
+    db = FakeDb(rows)
+    index = QueueIndex(db)
+    index.resync()
+    ok = check(index, rows)
+
+    for step in range(args.steps):
+        action = random.random()
+        if action < 0.45:
+            row = make_row(counter)
+            counter += 1
+            rows[row["id"]] = row
+            index.add(row)
+        elif action < 0.9 and rows:
+            oldest = min(rows.values(), key=lambda r: (parse_ts(r["created_at"]), r["id"]))
+            index.discard(oldest["id"])
+            del rows[oldest["id"]]
+        else:
+            # Resync with a claim and an enqueue landing while the query runs
+            def race():
+                nonlocal counter
+                victim = next(iter(rows))
+                index.discard(victim)
+                del rows[victim]
+                row = make_row(counter)
+                counter += 1
+                rows[row["id"]] = row
+                index.add(row)
+            db.during = race if rows else None
+            index.resync()
+        if step % 50 == 0 or step == args.steps - 1:
+            ok = check(index, rows) and ok
+    print(f"{'✅' if ok else '❌'} Positions match claim order after {args.steps} adds / claims / racing resyncs "
+          f"({len(index)} pending)")
+
+    ids = list(rows)
+    sample = random.sample(ids, min(1000, len(ids)))
+    t = time.perf_counter()
+    for gen_id in sample:
+        index.position(gen_id)
+    lookup = (time.perf_counter() - t) / len(sample)
+
+    keyed = [(parse_ts(r["created_at"]), r["id"]) for r in rows.values()]
+    by_id = {r["id"]: (parse_ts(r["created_at"]), r["id"]) for r in rows.values()}
+    t = time.perf_counter()
+    for gen_id in sample[:200]:
+        mine = by_id[gen_id]
+        sum(1 for key in keyed if key < mine)
+    scan = (time.perf_counter() - t) / min(200, len(sample))
+
+    for entry in index._entries.values():
+        entry.shown_at = 0.0
+    t = time.perf_counter()
+    due = index.due_updates(20)
+    tick = time.perf_counter() - t
+    print(f"⏱️ Position: index {lookup * 1e6:.1f} µs vs counting per task {scan * 1e6:.0f} µs "
+          f"({scan / lookup:.0f}x); one update tick over {len(index)} tasks {tick * 1000:.1f} ms, {len(due)} edits")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check and time the queue position index")
+    parser.add_argument("--pending", type=int, default=5000)
+    parser.add_argument("--steps", type=int, default=2000)
+    sys.exit(0 if main(parser.parse_args()) else 1)
@@ -0,0 +1,101 @@
+"""
+Memory of 100k conversation sessions: old dict user_data (with a copy of the
+ai_models row) vs ChatSession, plus the cost of one idle-eviction sweep.
+
+    python scripts/bench_session_memory.py --sessions 100000
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tracemalloc
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import ApplicationBuilder, ContextTypes  # noqa: E402
+from session_state import ChatSession, evict_idle_sessions, SESSION_IDLE_SECONDS  # noqa: E402
+
+# Shape of an ai_models row as returned by Supabase (every fetch is a new dict)
+MODEL_ROW = {
+    "id": "6f1c2a8e-0b7d-4a55-9b8e-3f0d9d2c1e11",
+    "model_id": "kling-v2-1-pro",
+    "display_name": "Kling 2.1 Pro",
+    "provider": "freepik",
+    "credit_cost": 4,
+    "cost_pro": 4,
+    "cost_pro_5s": 4,
+    "cost_pro_10s": 8,
+    "is_free_pro_5s": False,
+    "is_active": True,
+    "is_active_telegram": True,
+    "sort_order": 3,
+    "description": "Image to video, 5 or 10 seconds, 720p/1080p",
+    "created_at": "2025-11-02T10:15:00+00:00",
+    "updated_at": "2026-01-27T08:00:00+00:00",
+}
+
+
+MODEL_ROW_JSON = json.dumps(MODEL_ROW)
+
+
+def callback_model_id():
+    # query.data.replace("model_", "") builds a new string per callback
+    return "".join(["kling-", "v2-1-pro"])
+
+
+def old_session(i):
+    return {
+        "selected_model_id": callback_model_id(),
+        "selected_model_info": json.loads(MODEL_ROW_JSON),
+        "selected_duration": "10",
+        "calculated_cost": 8,
+        "selected_ratio": "16:9",
+    }
+
+
+def new_session(i):
+    return ChatSession(model_id=callback_model_id(), duration="10", ratio="16:9", cost=8)
+
+
+def measure(label, factory, n):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sessions = {i: factory(i) for i in range(n)}
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"   {label:28} {used / 1024 / 1024:8.1f} MiB  ({used / n:6.0f} B/session)")
+    return sessions, used
+
+
+async def sweep(n):
+    application = ApplicationBuilder().token("1:BENCH").context_types(ContextTypes(user_data=ChatSession)).build()
+    now = time.time()
+    for user_id in range(n):
+        # user_data is a defaultdict behind a read-only proxy: reading a key creates the session
+        session = application.user_data[user_id]
+        session.last_seen = now - (SESSION_IDLE_SECONDS + 1 if user_id % 2 else 0)
+    context = SimpleNamespace(application=application, job=SimpleNamespace(data=None))
+    started = time.perf_counter()
+    await evict_idle_sessions(context)
+    elapsed = time.perf_counter() - started
+    print(f"   sweep over {n} sessions (half idle): {elapsed * 1000:.0f} ms, {len(application.user_data)} left")
+
+
+def main(args):
+    n = args.sessions
+    print(f"🧪 {n} sessions")
+    old, old_bytes = measure("dict + ai_models row copy", old_session, n)
+    del old
+    new, new_bytes = measure("ChatSession (slots)", new_session, n)
+    del new
+    print(f"   ➜ {old_bytes / new_bytes:.1f}x smaller")
+    asyncio.run(sweep(n))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Session memory at scale")
+    parser.add_argument("--sessions", type=int, default=100_000)
+    main(parser.parse_args())
@@ -0,0 +1,167 @@
+"""
+Cold start benchmark for main.py.
+
+Two measurements, each over several fresh processes:
+  * import: `import main` time and RSS right after the import,
+  * first update: spawn `python main.py` in polling mode against a fake Bot
+    API (TELEGRAM_API_URL) that hands out one /start update; time until the
+    bot's reply arrives, and the process RSS at that moment.
+
+Supabase is pointed at a closed local port, so the /start handler's lookup
+fails fast and the bot answers with the login prompt; the queue worker and
+persistence are off. Nothing external is contacted.
+
+    python scripts/bench_startup.py --runs 5
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import statistics
+import threading
+import subprocess
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_PROBE = (
+    "import time, resource; t = time.perf_counter(); import main; "
+    "print(time.perf_counter() - t, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_mib(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+class FakeBotApi:
+    """Answers getMe/getUpdates/sendMessage; the first getUpdates returns one /start."""
+
+    def __init__(self):
+        self.replied = threading.Event()
+        self.pending = []
+        self._lock = threading.Lock()
+
+    def reset(self):
+        self.replied.clear()
+        with self._lock:
+            self.pending = [{
+                "update_id": 1,
+                "message": {
+                    "message_id": 1, "date": int(time.time()),
+                    "chat": {"id": 777, "type": "private"},
+                    "from": {"id": 777, "is_bot": False, "first_name": "bench"},
+                    "text": "/start",
+                    "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+                },
+            }]
+
+    def call(self, method):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        if method == "getUpdates":
+            with self._lock:
+                updates, self.pending = self.pending, []
+            if not updates:
+                time.sleep(0.2)
+            return updates
+        if method == "sendMessage":
+            self.replied.set()
+            return {"message_id": 2, "date": int(time.time()), "chat": {"id": 777, "type": "private"}, "text": "ok"}
+        return True
+
+    def serve(self, port):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                out = json.dumps({"ok": True, "result": api.call(self.path.rsplit("/", 1)[-1])}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                try:
+                    self.wfile.write(out)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # Bot process was stopped during a long poll
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def bench_env(api_url):
+    env = dict(os.environ)
+    env.update({
+        "TELEGRAM_BOT_TOKEN": env.get("TELEGRAM_BOT_TOKEN") or "1:BENCH",
+        "TELEGRAM_API_URL": api_url,
+        "SUPABASE_URL": f"http://127.0.0.1:{free_port()}",  # Closed port: lookups fail fast
+        "SUPABASE_KEY": env.get("SUPABASE_KEY") or "eyJhbGciOiJIUzI1NiJ9.e30.bench",
+        "R2_PUBLIC_URL": env.get("R2_PUBLIC_URL") or "http://r2.invalid",
+        "RUN_WORKER": "0",
+        "BOT_PERSISTENCE": "off",
+        "BOT_MODE": "polling",
+    })
+    return env
+
+
+def measure_import(env):
+    out = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout.split()
+    return float(out[-2]), int(out[-1]) / 1024
+
+
+def measure_first_update(api, env, timeout=30):
+    api.reset()
+    started = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, "main.py"], cwd=ROOT, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not api.replied.wait(timeout):
+            raise RuntimeError("bot did not answer the first update")
+        return time.perf_counter() - started, rss_mib(proc.pid)
+    finally:
+        proc.terminate()
+        try:
+            proc.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+def main(args):
+    api = FakeBotApi()
+    port = free_port()
+    api.serve(port)
+    env = bench_env(f"http://127.0.0.1:{port}")
+
+    imports = [measure_import(env) for _ in range(args.runs)]
+    firsts = [measure_first_update(api, env) for _ in range(args.runs)]
+
+    print(f"🧪 {args.runs} cold starts each (median)")
+    print(f"   import main:         {statistics.median(t for t, _ in imports) * 1000:7.0f} ms, "
+          f"RSS {statistics.median(m for _, m in imports):6.1f} MiB")
+    print(f"   first update answer: {statistics.median(t for t, _ in firsts) * 1000:7.0f} ms, "
+          f"RSS {statistics.median(m for _, m in firsts):6.1f} MiB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure main.py import time and time to first handled update")
+    parser.add_argument("--runs", type=int, default=5)
+    main(parser.parse_args())
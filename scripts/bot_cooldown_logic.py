@@ -1,130 +1,69 @@
 import asyncio
-from datetime import datetime, timedelta, timezone
 
-async def check_cooldown(supabase_client, user_id: str, user_type: str, model_name: str) -> tuple[bool, str]:
+# Cooldown only applies to Kling Motion Control
+COOLDOWN_MODEL_MARKER = 'motion-control'
+
+def format_cooldown_message(cycle: int, remaining_seconds: int) -> str:
+    """User-facing message for a denied generation."""
+    rem_min = int(remaining_seconds // 60)
+    rem_sec = int(remaining_seconds % 60)
+    return (
+        f"⏳ **Cooldown Mode**\n\n"
+        f"Anda telah mencapai batas {cycle} generate berturut-turut.\n"
+        f"Istirahat dulu ya! Silakan kembali dalam:\n"
+        f"⏳ **{rem_min} menit {rem_sec} detik**"
+    )
+
+async def claim_cooldown_slot(supabase_client, user_id: str, user_type: str, model_name: str) -> tuple[bool, str, dict | None]:
     """
-    Check if user is in cooldown period dynamically.
+    Atomically check the cooldown and, if allowed, count this generation.
+    One call to the claim_generation_cooldown RPC, which locks the user row and
+    does the WIB day rollover, the multiples-of-3 trigger and the increment in
+    the database (see supabase/migrations/*_generation_cooldown.sql).
     Args:
         supabase_client: Initialized Supabase client
         user_id: User's UUID
-        user_type: 'PRO', 'UNLIMITED', 'ADVANCE'
+        user_type: 'PRO', 'UNLIMITED', 'ULTRA', 'ADVANCE' (matched exactly, as before)
         model_name: Name of the model
-    Returns (is_allowed, message).
+    Returns (is_allowed, message, slot); pass slot to release_cooldown_slot.
     """
-    # Only applies to Kling Motion Control
-    if 'motion-control' not in model_name:
-        return True, ""
+    if COOLDOWN_MODEL_MARKER not in (model_name or ''):
+        return True, "", None
 
     try:
-        # 1. Fetch latest stats
-        # Real DB call using provided client
-        response = supabase_client.table('users').select('total_gen_cycle,last_generation_time').eq('id', user_id).execute()
-        
-        # Check if response has data (supabase-py format usually response.data)
-        data = response.data if hasattr(response, 'data') else response
-        
-        if not data or len(data) == 0:
-            return True, ""
-            
-        user_data = data[0]
+        response = await asyncio.to_thread(supabase_client.rpc('claim_generation_cooldown', {
+            'p_user_id': user_id,
+            'p_user_type': user_type
+        }).execute)
 
-        last_gen_iso = user_data.get('last_generation_time')
-        current_cycle = user_data.get('total_gen_cycle', 0) or 0
-        
-        # 2. Lazy Reset Logic (Check Day Change)
-        utc_now = datetime.now(timezone.utc)
-        wib_now = utc_now + timedelta(hours=7)
-        
-        if last_gen_iso:
-            last_gen_dt = datetime.fromisoformat(str(last_gen_iso).replace('Z', '+00:00'))
-            last_gen_wib = last_gen_dt.astimezone(timezone(timedelta(hours=7)))
-            
-            # If day changed, reset cycle logically
-            if last_gen_wib.date() != wib_now.date():
-                current_cycle = 0
-                last_gen_wib = None
-        
-        # 3. Check Cooldown Trigger (Multiples of 3)
-        if current_cycle > 0 and current_cycle % 3 == 0:
-            
-            # Determine Wait Time
-            wait_minutes = 0
-            
-            if user_type == 'UNLIMITED' or user_type == 'ULTRA':
-                # Exponential: 30 * 2^((cycle/3) - 1)
-                exponent = (current_cycle // 3) - 1
-                wait_minutes = 30 * (2 ** exponent)
-                wait_minutes = min(wait_minutes, 1440) # Safety cap 24h
-            elif user_type in ['PRO', 'ADVANCE']:
-                # Fixed 15 minutes
-                wait_minutes = 15
-            else:
-                return True, "" 
-
-            # Calculate Remaining Time
-            if last_gen_iso:
-                last_gen_dt = datetime.fromisoformat(str(last_gen_iso).replace('Z', '+00:00'))
-                elapsed = utc_now - last_gen_dt
-                elapsed_minutes = elapsed.total_seconds() / 60
-                
-                remaining_minutes = wait_minutes - elapsed_minutes
-                
-                if remaining_minutes > 0:
-                    # Format readable time
-                    rem_min = int(remaining_minutes)
-                    rem_sec = int((remaining_minutes - rem_min) * 60)
-                    
-                    msg = (
-                        f"⏳ **Cooldown Mode**\n\n"
-                        f"Anda telah mencapai batas {current_cycle} generate berturut-turut.\n"
-                        f"Istirahat dulu ya! Silakan kembali dalam:\n"
-                        f"⏳ **{rem_min} menit {rem_sec} detik**"
-                    )
-                    return False, msg
+        data = response.data if hasattr(response, 'data') else response
+        if not data:
+            return True, "", None
 
-        return True, ""
+        row = data[0]
+        if row.get('allowed', True):
+            return True, "", {'claimed_at': row.get('claimed_at'), 'previous_time': row.get('previous_time')}
+        return False, format_cooldown_message(row.get('cycle', 0), row.get('remaining_seconds', 0)), None
 
     except Exception as e:
         print(f"Error checking cooldown: {e}")
-        return True, ""
+        return True, "", None
 
-async def update_user_cooldown(supabase_client, user_id: str, model_name: str):
+async def release_cooldown_slot(supabase_client, user_id: str, model_name: str, slot: dict | None = None):
     """
-    Update data cooldown user(total_gen_cycle) after successful submit.
-    Also handles "Lazy Reset" by checking day change before incrementing.
+    Give back a slot taken by claim_cooldown_slot when the task could not be
+    created after all (upload failed, insert failed, ...). With the claim's
+    slot, last_generation_time is restored too.
     """
-    # Only applies to Kling Motion Control
-    if 'motion-control' not in model_name:
+    if COOLDOWN_MODEL_MARKER not in (model_name or ''):
         return
 
+    slot = slot or {}
     try:
-        res = supabase_client.table("users").select("total_gen_cycle, last_generation_time").eq("id", user_id).execute()
-        if not res.data:
-            return
-            
-        user = res.data[0]
-        current_cycle = user.get("total_gen_cycle", 0) or 0
-        last_gen_iso = user.get("last_generation_time")
-        
-        utc_now = datetime.now(timezone.utc)
-        wib_now = utc_now + timedelta(hours=7)
-        
-        # Check Day Change for Reset
-        if last_gen_iso:
-            last_gen_dt = datetime.fromisoformat(str(last_gen_iso).replace('Z', '+00:00'))
-            last_gen_wib = last_gen_dt.astimezone(timezone(timedelta(hours=7)))
-            
-            if last_gen_wib.date() != wib_now.date():
-                current_cycle = 0
-        
-        # Increment
-        new_cycle = current_cycle + 1
-        
-        # Update
-        supabase_client.table("users").update({
-            "total_gen_cycle": new_cycle,
-            "last_generation_time": "now()"
-        }).eq("id", user_id).execute()
-        
+        await asyncio.to_thread(supabase_client.rpc('release_generation_cooldown', {
+            'p_user_id': user_id,
+            'p_claimed_at': slot.get('claimed_at'),
+            'p_previous_time': slot.get('previous_time')
+        }).execute)
     except Exception as e:
-        print(f"Update Cooldown Error: {e}")
+        print(f"Release Cooldown Error: {e}")
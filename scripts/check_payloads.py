@@ -0,0 +1,159 @@
+"""
+Payload / endpoint matrix for the compiled Freepik routes (providers.compile_routes).
+
+For every model in MODEL_ENDPOINTS x duration x aspect ratio x option set, the
+compiled payload builder must produce exactly what the old per-request branch
+code in submit_freepik_task produced (kept below as legacy_payload). It also
+lists each model's submit / status URL and flags the models whose status URL
+is derived (no MODEL_STATUS_ENDPOINTS entry), and times both builders.
+
+    python scripts/check_payloads.py
+    python scripts/check_payloads.py --catalog   # also check ai_models rows have a route
+
+Exit code 1 on any mismatch.
+"""
+import os
+import sys
+import timeit
+import argparse
+import itertools
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from providers import (  # noqa: E402
+    FreepikBackend, MODEL_ENDPOINTS, MODEL_STATUS_ENDPOINTS, FREEPIK_API_BASE,
+)
+
+DURATIONS = ["5", "10"]
+ASPECT_RATIOS = [None, "16:9", "9:16", "1:1", "4:3", "21:9", "2:3"]
+OPTION_SETS = [
+    {},
+    {"negative_prompt": "blur", "cfg_scale": "0.7"},
+    {"driving_url": "https://cdn.example/drive.mp4", "character_orientation": "image"},
+    {"video_url": "https://cdn.example/ref.mp4", "cfg_scale": 0.3},
+]
+PROMPT = "a cat surfing"
+IMAGE_URL = "https://cdn.example/cat.jpg"
+
+
+def legacy_payload(model_id, prompt, image_url, duration="5", options=None):
+    """The payload branches of the old generation_helper.submit_freepik_task, verbatim."""
+    options = options or {}
+    model_id = model_id.lower()
+    model_config = MODEL_ENDPOINTS.get(model_id)
+    if 'motion-control' in model_id:
+        payload = {
+            "image_url": image_url,
+            "video_url": options.get('driving_url') or options.get('video_url'),
+            "prompt": prompt,
+            "character_orientation": options.get('character_orientation', 'video'),
+            "cfg_scale": float(options.get('cfg_scale', 0.5))
+        }
+    elif 'seedance' in model_id:
+        ratio_map = {
+            '16:9': 'widescreen_16_9',
+            '9:16': 'social_story_9_16',
+            '1:1': 'square_1_1',
+            '4:3': 'classic_4_3',
+            '3:4': 'traditional_3_4',
+            '21:9': 'film_horizontal_21_9',
+            '9:21': 'film_vertical_9_21'
+        }
+        ar = options.get('aspect_ratio', '16:9')
+        mapped_ar = ratio_map.get(ar, 'widescreen_16_9')
+        payload = {
+            "image": image_url,
+            "prompt": prompt,
+            "duration": int(duration),
+            "aspect_ratio": mapped_ar,
+            "generate_audio": True
+        }
+    else:
+        payload = {"image": image_url, "prompt": prompt}
+        if "wan" in model_id: payload["size"] = "1280*720"
+        if model_config.get('param') == 'duration': payload["duration"] = str(duration)
+        if "pixverse" in model_id:
+            payload = {"image_url": image_url, "prompt": prompt, "resolution": "720p", "duration": int(duration)}
+        if options.get('negative_prompt'): payload['negative_prompt'] = options['negative_prompt']
+        if options.get('cfg_scale'): payload['cfg_scale'] = float(options['cfg_scale'])
+        if options.get('aspect_ratio'): payload['aspect_ratio'] = options['aspect_ratio']
+    return payload
+
+
+def matrix():
+    for model_id, duration, ratio, options in itertools.product(MODEL_ENDPOINTS, DURATIONS, ASPECT_RATIOS, OPTION_SETS):
+        options = dict(options)
+        if ratio:
+            options["aspect_ratio"] = ratio
+        yield model_id, duration, options
+
+
+def check_matrix(backend):
+    cases = mismatches = 0
+    for model_id, duration, options in matrix():
+        cases += 1
+        expected = legacy_payload(model_id, PROMPT, IMAGE_URL, duration, dict(options))
+        got = backend.build_payload(model_id, PROMPT, IMAGE_URL, duration, dict(options))
+        if got != expected or list(got) != list(expected):
+            mismatches += 1
+            print(f"❌ {model_id} duration={duration} options={options}\n   legacy:   {expected}\n   compiled: {got}")
+    print(f"{'✅' if not mismatches else '❌'} Payload matrix: {cases} cases, {mismatches} mismatches")
+    return mismatches == 0
+
+
+def check_endpoints(backend):
+    print("\nModel                              submit -> status")
+    for model_id, route in backend.routes.items():
+        derived = "" if model_id in MODEL_STATUS_ENDPOINTS else "   (derived: no MODEL_STATUS_ENDPOINTS entry)"
+        submit = route.submit_url.replace(FREEPIK_API_BASE, "")
+        status = route.status_url.replace(FREEPIK_API_BASE, "")
+        print(f"  {model_id:32} {submit} -> {status}{{task_id}}{derived}")
+    missing = [m for m in MODEL_ENDPOINTS if m not in backend.routes]
+    unknown_status, _ = backend.poll("x", "no-such-model", "key")
+    ok = not missing and unknown_status == "failed"
+    print(f"{'✅' if ok else '❌'} Every model has a route; unknown models fail instead of polling a guessed URL")
+    return ok
+
+
+def bench(backend, number):
+    cases = list(matrix())
+
+    def run_legacy():
+        for model_id, duration, options in cases:
+            legacy_payload(model_id, PROMPT, IMAGE_URL, duration, options)
+
+    def run_compiled():
+        for model_id, duration, options in cases:
+            backend.build_payload(model_id, PROMPT, IMAGE_URL, duration, options)
+
+    legacy = min(timeit.repeat(run_legacy, number=number, repeat=3)) / (number * len(cases))
+    compiled = min(timeit.repeat(run_compiled, number=number, repeat=3)) / (number * len(cases))
+    print(f"\n⏱️ Per payload: legacy {legacy * 1e6:.2f} µs, compiled {compiled * 1e6:.2f} µs ({legacy / compiled:.1f}x)")
+
+
+def check_catalog(backend):
+    from model_catalog import catalog
+    rows = catalog.active_for_telegram()
+    missing = [row["model_id"] for row in rows if not backend.supports(row["model_id"]) and not row.get("provider")]
+    if missing:
+        print(f"⚠️ Active ai_models rows without a Freepik route (hidden from the menu, rejected at enqueue): {missing}")
+    else:
+        print(f"✅ All {len(rows)} active ai_models rows have a route")
+    return not missing
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check compiled Freepik payload builders against the legacy code")
+    parser.add_argument("--catalog", action="store_true", help="Also check the active ai_models rows (needs the database)")
+    parser.add_argument("--bench", type=int, default=20, help="Benchmark rounds over the matrix (0 = skip)")
+    args = parser.parse_args()
+
+    backend = FreepikBackend()
+    ok = check_matrix(backend)
+    ok = check_endpoints(backend) and ok
+    if args.bench:
+        bench(backend, args.bench)
+    if args.catalog:
+        ok = check_catalog(backend) and ok
+    sys.exit(0 if ok else 1)
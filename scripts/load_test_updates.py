@@ -0,0 +1,158 @@
+"""
+Load test for update handling: how long do button presses wait while N users
+upload photos at the same time?
+
+Feeds synthetic updates through the same path PTB uses (sequential awaiting
+for the default application, PerChatUpdateProcessor.process_update for the
+concurrent one). Handlers only sleep, nothing talks to Telegram/Supabase/R2:
+
+    photo  : Telegram download (async) + R2 upload and insert (blocking, in a thread)
+    button : one user lookup (blocking, in a thread)
+
+"button latency" is measured on chats that are NOT uploading; a button pressed
+in an uploading chat has to wait for that chat's upload (per-chat order).
+
+Usage:
+    python scripts/load_test_updates.py --uploaders 20 --clickers 30
+    python scripts/load_test_updates.py --uploaders 50 --max-concurrent 16
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update, Message, Chat  # noqa: E402
+from update_processor import PerChatUpdateProcessor  # noqa: E402
+
+DOWNLOAD_SECONDS = 0.8   # get_file + download_as_bytearray
+UPLOAD_SECONDS = 0.6     # r2.upload_bytes + generations insert (blocking)
+BUTTON_SECONDS = 0.03    # get_user (blocking)
+
+
+def make_update(update_id, chat_id, kind):
+    msg = Message(
+        message_id=update_id,
+        date=datetime.now(),
+        chat=Chat(id=chat_id, type=Chat.PRIVATE),
+        text=kind,
+    )
+    return Update(update_id=update_id, message=msg)
+
+
+async def handle(update, kind, arrived_at, results, order):
+    if kind == "photo":
+        await asyncio.sleep(DOWNLOAD_SECONDS)
+        await asyncio.to_thread(time.sleep, UPLOAD_SECONDS)
+    else:  # button / own-button
+        await asyncio.to_thread(time.sleep, BUTTON_SECONDS)
+    results.append((kind, time.perf_counter() - arrived_at))
+    order.setdefault(update.effective_chat.id, []).append(update.update_id)
+
+
+def build_schedule(uploaders, clickers, clicks, window, seed):
+    """[(at_seconds, chat_id, kind)] sorted by arrival time."""
+    rnd = random.Random(seed)
+    events = []
+    for i in range(uploaders):
+        chat_id = 1000 + i
+        at = rnd.uniform(0, window / 4)
+        events.append((at, chat_id, "photo"))
+        # Uploaders also tap a button right after sending (same chat: must wait for the photo)
+        events.append((at + 0.01, chat_id, "own-button"))
+    for i in range(clickers):
+        chat_id = 5000 + i
+        for _ in range(clicks):
+            events.append((rnd.uniform(0, window), chat_id, "button"))
+    events.sort()
+    return events
+
+
+async def run(mode, events, max_concurrent):
+    results = []
+    order = {}
+    processor = PerChatUpdateProcessor(max_concurrent=max_concurrent) if mode == "per-chat" else None
+    tasks = []
+    started = time.perf_counter()
+
+    # The fetcher: like Application.__update_fetcher, one update at a time off the queue
+    queue = asyncio.Queue()
+
+    async def producer():
+        for update_id, (at, chat_id, kind) in enumerate(events, 1):
+            delay = started + at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await queue.put((make_update(update_id, chat_id, kind), kind, time.perf_counter()))
+        await queue.put(None)
+
+    producer_task = asyncio.create_task(producer())
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        update, kind, arrived_at = item
+        coroutine = handle(update, kind, arrived_at, results, order)
+        if processor is None:
+            await coroutine
+        else:
+            tasks.append(asyncio.create_task(processor.process_update(update, coroutine)))
+    await producer_task
+    await asyncio.gather(*tasks)
+
+    in_order = all(ids == sorted(ids) for ids in order.values())
+    peak = processor.peak_active if processor else 1
+    return results, time.perf_counter() - started, in_order, peak
+
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    idx = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return values[idx]
+
+
+def report(mode, results, elapsed, in_order, peak):
+    buttons = [lat for kind, lat in results if kind == "button"]
+    own = [lat for kind, lat in results if kind == "own-button"]
+    photos = [lat for kind, lat in results if kind == "photo"]
+    print(f"\n▶ {mode}")
+    print(f"   updates: {len(results)} in {elapsed:.1f}s (peak running: {peak})")
+    print(
+        f"   button latency  p50 {percentile(buttons, 50) * 1000:7.0f} ms"
+        f"   p95 {percentile(buttons, 95) * 1000:7.0f} ms"
+        f"   max {max(buttons) * 1000:7.0f} ms"
+    )
+    print(
+        f"   own-chat button p50 {percentile(own, 50) * 1000:7.0f} ms"
+        f"   (queued behind that chat's upload, by design)"
+    )
+    print(
+        f"   photo latency   p50 {percentile(photos, 50) * 1000:7.0f} ms"
+        f"   p95 {percentile(photos, 95) * 1000:7.0f} ms"
+    )
+    print(f"   per-chat order kept: {'✅' if in_order else '❌'}")
+
+
+async def main(args):
+    events = build_schedule(args.uploaders, args.clickers, args.clicks, args.window, args.seed)
+    print(f"🧪 {args.uploaders} uploaders, {args.clickers} clickers x {args.clicks} clicks over {args.window:.0f}s")
+    print(f"   photo = {DOWNLOAD_SECONDS}s download + {UPLOAD_SECONDS}s blocking upload, button = {BUTTON_SECONDS}s lookup")
+    for mode in ("sequential", "per-chat"):
+        report(mode, *await run(mode, events, args.max_concurrent))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="p95 button latency under simultaneous uploads")
+    parser.add_argument("--uploaders", type=int, default=20)
+    parser.add_argument("--clickers", type=int, default=30)
+    parser.add_argument("--clicks", type=int, default=3)
+    parser.add_argument("--window", type=float, default=8.0, help="seconds over which clicks arrive")
+    parser.add_argument("--max-concurrent", type=int, default=32)
+    parser.add_argument("--seed", type=int, default=7)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,142 @@
+"""
+Simulation: static shared-lane limits vs the AIMD controller.
+
+A fake provider with a capacity curve (how many renders it accepts at once,
+changing over the run) is fed by a model of the worker's claim loop: submit
+one task when the delay since the last submission has passed and the tasks
+in flight are under the concurrency limit. The backlog never runs dry.
+
+  * static:   concurrency 12, 5 s between submissions (the old constants),
+  * adaptive: concurrency_control.AimdController with the default limits.
+
+The provider answers 429 when it is at capacity (the worker then fails that
+generation) and its submit latency climbs as it nears capacity. Renders take
+about a minute. Runs on a virtual clock, so two hours take a second.
+
+    python scripts/sim_adaptive_limits.py --hours 2 --seed 1
+"""
+import os
+import sys
+import random
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import concurrency_control  # noqa: E402
+from concurrency_control import AimdController  # noqa: E402
+
+STEP = 0.1           # Virtual seconds per tick
+CLAIM_PERIOD = 0.5   # The claim loop re-checks about this often
+RENDER_SECONDS = (45, 75)
+
+# (start minute, accepted concurrent renders): quiet, struggling, quiet, busy
+CAPACITY_CURVE = [(0, 30), (30, 8), (60, 45), (90, 20)]
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+def capacity_at(t):
+    minute = (t / 60) % (CAPACITY_CURVE[-1][0] + 30)
+    cap = CAPACITY_CURVE[0][1]
+    for start, value in CAPACITY_CURVE:
+        if minute >= start:
+            cap = value
+    return cap
+
+
+def submit_latency(in_flight, cap, rng):
+    """Provider slows down as it fills up: ~1 s idle, ~13 s at capacity."""
+    util = in_flight / cap
+    return 1.0 + 12.0 * max(0.0, util - 0.75) / 0.25 + rng.uniform(0, 0.3)
+
+
+def simulate(mode, hours, seed):
+    rng = random.Random(seed)
+    clock = Clock()
+    concurrency_control.time = clock  # Controller windows / cooldowns run on virtual time
+    limits = AimdController(limits={"adaptive": mode == "adaptive"})
+
+    running = []  # finish times of renders in flight
+    last_submit = -1e9
+    next_claim = 0.0
+    next_sample = 0.0
+    completed = failed = 0
+    phase_done = {}
+    samples = []  # (t, limit, delay, in flight, capacity)
+    end = hours * 3600
+
+    while clock.now < end:
+        clock.now += STEP
+        t = clock.now
+        finished = [f for f in running if f <= t]
+        if finished:
+            running = [f for f in running if f > t]
+            completed += len(finished)
+            phase = int(t // 1800)
+            phase_done[phase] = phase_done.get(phase, 0) + len(finished)
+
+        if t < next_claim:
+            continue
+        next_claim = t + CLAIM_PERIOD
+        if t >= next_sample:
+            next_sample += 60
+            samples.append((t, limits.concurrency(), limits.delay(), len(running), capacity_at(t)))
+
+        # Same gates as QueueWorker.claim_next / check_global_concurrency
+        if t - last_submit < limits.delay():
+            limits.note_blocked()
+            continue
+        if len(running) >= limits.concurrency():
+            limits.note_blocked()
+            continue
+
+        last_submit = t
+        cap = capacity_at(t)
+        if len(running) >= cap:
+            failed += 1
+            limits.on_result(429, None, "Too Many Requests")
+            continue
+        latency = submit_latency(len(running), cap, rng)
+        limits.on_result(200, latency)
+        running.append(t + latency + rng.uniform(*RENDER_SECONDS))
+
+    return {
+        "completed": completed,
+        "failed": failed,
+        "per_minute": completed / (end / 60),
+        "phases": [phase_done.get(i, 0) for i in range(int(end // 1800))],
+        "samples": samples,
+        "describe": limits.describe(),
+    }
+
+
+def main(args):
+    results = {mode: simulate(mode, args.hours, args.seed) for mode in ("static", "adaptive")}
+    phases = [f"{start}-{start + 30}m cap {cap}" for start, cap in CAPACITY_CURVE]
+    print(f"🧪 {args.hours} h, capacity curve {CAPACITY_CURVE} (min, renders), render {RENDER_SECONDS[0]}-{RENDER_SECONDS[1]} s")
+    for mode, r in results.items():
+        print(f"\n  {mode:8}  completed {r['completed']:5}  ({r['per_minute']:.1f}/min)   failed by 429: {r['failed']}")
+        for label, done in zip(phases * args.hours, r["phases"]):
+            print(f"            {label:18} {done / 30:5.1f}/min")
+        if args.trace:
+            for t, limit, delay, in_flight, cap in r["samples"][::5]:
+                print(f"            t={t / 60:5.0f}m limit {limit:3} delay {delay:5.2f}s in flight {in_flight:3} cap {cap}")
+        print(f"            final: {r['describe']}")
+    gain = results["adaptive"]["completed"] / max(1, results["static"]["completed"])
+    print(f"\n📊 adaptive / static throughput: {gain:.2f}x")
+    return results["adaptive"]["completed"] > results["static"]["completed"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare static and adaptive shared-lane limits on a fake provider")
+    parser.add_argument("--hours", type=int, default=2)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--trace", action="store_true", help="Print limit / in-flight samples every 5 minutes")
+    sys.exit(0 if main(parser.parse_args()) else 1)
@@ -0,0 +1,104 @@
+"""
+Simulation: one provider vs a provider with a fallback (providers.py routing).
+
+Two providers.FakeBackend instances stand in for the primary (Freepik) and an
+alternative backend, each accepting a limited number of renders at once.
+Tasks arrive at a steady rate and go through providers.submit_generation
+exactly as the worker submits them; a task refused by every backend it may
+use counts as failed (the worker fails it and refunds the credits).
+
+  * primary only:  the model has no fallback_provider,
+  * with fallback: fallback_provider points at the second backend.
+
+Runs on a virtual clock, so an hour takes a second:
+
+    python scripts/sim_provider_failover.py --minutes 60 --rate 0.5
+"""
+import os
+import sys
+import logging
+import argparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_KEY", "sim")
+
+import providers  # noqa: E402
+from providers import FakeBackend, ProviderSaturated  # noqa: E402
+
+MODEL = "kling-v2-1-std"
+STEP = 0.5  # Virtual seconds per tick
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def time(self):
+        return self.now
+
+
+class FakeCatalog:
+    def __init__(self, row):
+        self.row = row
+
+    def get(self, model_id):
+        return self.row
+
+
+def simulate(fallback, args):
+    clock = Clock()
+    providers.time = clock  # Saturation hold runs on virtual time
+    providers._backends.clear()
+    primary = providers.register(FakeBackend("primary", args.primary_capacity, args.render, 0, clock))
+    secondary = providers.register(FakeBackend("secondary", args.fallback_capacity, args.render, 0, clock))
+    providers.catalog = FakeCatalog({"provider": "primary", "fallback_provider": "secondary" if fallback else None})
+
+    accepted = {"primary": 0, "secondary": 0}
+    failed = 0
+    arrivals = 0.0
+    end = args.minutes * 60
+    while clock.now < end:
+        clock.now += STEP
+        arrivals += args.rate * STEP
+        while arrivals >= 1:
+            arrivals -= 1
+            try:
+                name, task_id, _ = providers.submit_generation({"id": "sim"}, MODEL, "sim", "https://img", "5", {})
+                accepted[name] += 1
+            except ProviderSaturated:
+                failed += 1
+
+    return {
+        "accepted": accepted,
+        "failed": failed,
+        "per_minute": sum(accepted.values()) / args.minutes,
+        "describe": f"{primary.describe()} | {secondary.describe()}",
+    }
+
+
+def main(args):
+    logging.disable(logging.WARNING)  # One warning per refused submission otherwise
+    print(
+        f"🧪 {args.minutes} min, {args.rate * 60:.0f} tasks/min, render {args.render:.0f} s, "
+        f"capacity primary {args.primary_capacity} / fallback {args.fallback_capacity}"
+    )
+    results = {}
+    for label, fallback in (("primary only", False), ("with fallback", True)):
+        r = results[label] = simulate(fallback, args)
+        print(f"\n  {label:13}  accepted {sum(r['accepted'].values()):5} ({r['per_minute']:.1f}/min)   failed: {r['failed']}")
+        print(f"                 {r['describe']}")
+    gain = results["with fallback"]["per_minute"] / max(0.01, results["primary only"]["per_minute"])
+    print(f"\n📊 with fallback / primary only throughput: {gain:.2f}x")
+    return results["with fallback"]["failed"] < results["primary only"]["failed"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare one provider with provider failover on fake backends")
+    parser.add_argument("--minutes", type=int, default=60)
+    parser.add_argument("--rate", type=float, default=0.5, help="Arriving tasks per second")
+    parser.add_argument("--render", type=float, default=60, help="Render time per task (s)")
+    parser.add_argument("--primary-capacity", type=int, default=20)
+    parser.add_argument("--fallback-capacity", type=int, default=10)
+    sys.exit(0 if main(parser.parse_args()) else 1)
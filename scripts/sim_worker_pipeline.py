@@ -0,0 +1,286 @@
+"""
+Offline simulation of the staged queue worker (queue_worker.QueueWorker).
+
+Runs the real claim / submit / poll / deliver stages against in-memory fakes:
+a generations table, a provider whose jobs finish after --render seconds, an
+R2 whose uploads take --r2 seconds, and a Telegram bot that only records
+calls. Nothing external is contacted.
+
+It reports, per run, how quickly tasks were submitted and delivered plus the
+stage metrics the worker heartbeat logs. Run it with a fast and a slow R2 to
+see that slow uploads back up only the deliver stage:
+
+    python scripts/sim_worker_pipeline.py --tasks 40 --r2 0.1
+    python scripts/sim_worker_pipeline.py --tasks 40 --r2 4
+
+With --slow-cap N every other task is a slow model (wan-v2-6-1080p, three
+times the render time) capped at N in flight, to see that the fast model's
+tasks are not held behind it:
+
+    python scripts/sim_worker_pipeline.py --tasks 40 --slow-cap 2
+
+With --flaky P each submission fails with a temporary error (like every key
+answering 429) with probability P, to see retries with backoff recover them:
+
+    python scripts/sim_worker_pipeline.py --tasks 40 --flaky 0.4
+
+With --stuck P a task's render never finishes (status checks answer
+"completed" without a video) with probability P; those must end failed and
+refunded, and the active poll gauge must drop back to 0:
+
+    python scripts/sim_worker_pipeline.py --tasks 40 --stuck 0.2
+"""
+import os
+import sys
+import time
+import asyncio
+import random
+import argparse
+import itertools
+import threading
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("SUPABASE_KEY", "sim")
+
+import queue_worker  # noqa: E402
+from concurrency_control import AimdController, ModelLimits  # noqa: E402
+from providers import ProviderUnavailable  # noqa: E402
+
+FAST_MODEL = "kling-v2-1-std"
+SLOW_MODEL = "wan-v2-6-1080p"
+
+
+# --- Fakes ---
+
+class FakeQuery:
+    """Just enough of the postgrest builder for the worker's generations reads."""
+
+    def __init__(self, db):
+        self.db = db
+        self.filters = []
+        self.excluded = {}
+        self.not_ = self
+        self.count = None
+        self.limit_n = None
+
+    def select(self, columns, count=None):
+        self.count = count
+        return self
+
+    def eq(self, column, value):
+        self.filters.append((column, value))
+        return self
+
+    def in_(self, column, values):
+        # Only reached through .not_ in the worker
+        self.excluded[column] = set(values)
+        return self
+
+    def gte(self, column, value):
+        return self
+
+    def order(self, column):
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def execute(self):
+        with self.db.lock:
+            rows = [
+                r for r in self.db.rows
+                if all(r.get(c) == v for c, v in self.filters)
+                and not any(r.get(c) in vs for c, vs in self.excluded.items())
+            ]
+        rows.sort(key=lambda r: r["created_at"])
+        if self.limit_n:
+            rows = rows[:self.limit_n]
+        return SimpleNamespace(data=[dict(r, users=self.db.user) for r in rows], count=len(rows))
+
+
+class FakeDb:
+    def __init__(self, tasks, mixed=False):
+        self.lock = threading.Lock()
+        self.user = {"id": "sim-user", "code": "SIM", "type": "UNLIMITED"}
+        self.rows = [{
+            "id": f"gen-{i}", "user_id": "sim-user", "status": "pending", "source": "telegram",
+            "lane": "shared", "created_at": i, "prompt": "sim",
+            "model_name": SLOW_MODEL if mixed and i % 2 else FAST_MODEL,
+            "thumbnail_url": "https://img", "telegram_chat_id": None,
+            "options": {"duration": "5"},
+        } for i in range(tasks)]
+        self.by_id = {r["id"]: r for r in self.rows}
+        self.events = {}  # gen id -> {"submitted": t, "delivered": t}
+
+    def table(self, name):
+        return FakeQuery(self)
+
+    def transition(self, gen_id, from_status, to_status):
+        with self.lock:
+            row = self.by_id[gen_id]
+            if row["status"] != from_status:
+                return False
+            row["status"] = to_status
+            return True
+
+
+class FakeProvider:
+    def __init__(self, render_seconds, flaky=0.0, stuck=0.0, seed=1):
+        self.render_seconds = render_seconds
+        self.flaky = flaky
+        self.stuck = stuck
+        self.stuck_ids = set()
+        self.rng = random.Random(seed)
+        self.ids = itertools.count()
+        self.started = {}
+
+    def submit(self, **kwargs):
+        time.sleep(0.2)  # Request latency
+        if self.rng.random() < self.flaky:
+            raise ProviderUnavailable("HTTP 429 on every key")
+        task_id = f"task-{next(self.ids)}"
+        render = self.render_seconds * (3 if kwargs.get("model_id") == SLOW_MODEL else 1)
+        self.started[task_id] = time.perf_counter() + render
+        if self.rng.random() < self.stuck:
+            self.stuck_ids.add(task_id)
+        return task_id, "sim-key"
+
+    def poll(self, task_id, model_id, api_key):
+        time.sleep(0.05)
+        if task_id in self.stuck_ids:
+            return "completed", None
+        if time.perf_counter() >= self.started[task_id]:
+            return "completed", f"https://provider/{task_id}.mp4"
+        return "processing", None
+
+
+class FakeR2:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def upload_from_url(self, url, name, content_type=None):
+        time.sleep(self.seconds)
+        return f"https://r2/{name}"
+
+
+class FakeBot:
+    async def send_message(self, **kwargs):
+        return SimpleNamespace(message_id=1)
+
+    async def edit_message_text(self, *args, **kwargs):
+        return True
+
+    async def send_video(self, **kwargs):
+        return True
+
+
+class FakeCatalog:
+    def __init__(self, slow_cap):
+        self.rows = {FAST_MODEL: {"model_id": FAST_MODEL}, SLOW_MODEL: {"model_id": SLOW_MODEL, "max_concurrent": slow_cap}}
+
+    def get(self, model_id):
+        return self.rows.get(model_id)
+
+
+def install(db, provider, r2, started, slow_cap=None):
+    """Point queue_worker at the fakes and a compressed clock."""
+    qw = queue_worker
+    qw.supabase = db
+    qw.catalog = FakeCatalog(slow_cap)
+    qw.model_limits = ModelLimits(qw.catalog)
+    qw.limits = AimdController(limits={
+        "adaptive": False, "initial_concurrent": 10_000, "max_concurrent": 10_000,
+        "initial_delay_seconds": 0.001, "min_delay_seconds": 0.001,
+    })
+    qw.MAX_USER_CONCURRENT_LIMIT = {"DEFAULT": 10_000, "UNLIMITED": 10_000}
+    qw.POLL_FIRST_DELAY_SECONDS = 0.2
+    qw.POLL_INTERVAL_SECONDS = 0.5
+    qw.RETRY_BASE_SECONDS = 0.2
+    qw.RETRY_MAX_SECONDS = 1.6
+    qw.POLL_DEADLINE_SECONDS = 20
+    qw.get_byok_key = lambda user: None
+    qw.get_r2 = lambda: r2
+    qw.poll_generation = lambda name, task_id, model_id, api_key: provider.poll(task_id, model_id, api_key)
+    qw.price_task = lambda model_id, options: 0
+    qw.supports_model = lambda model_id: True
+    qw.commit_credits = lambda reservation_id: None
+    qw.refund_credits = lambda reservation_id: None
+
+    def submit(**kwargs):
+        task_id, key = provider.submit(**kwargs)
+        return "sim", task_id, key
+
+    def record_submission(gen_id, task_id, key, **fields):
+        db.events.setdefault(gen_id, {})["submitted"] = time.perf_counter() - started
+        return True
+
+    def complete(gen_id, video_url, r2_url=None):
+        db.events.setdefault(gen_id, {})["delivered"] = time.perf_counter() - started
+        return db.transition(gen_id, "processing", "completed")
+
+    qw.submit_generation = submit
+    qw.generation_state = SimpleNamespace(
+        claim=lambda gen_id, **fields: db.transition(gen_id, "pending", "processing"),
+        record_submission=record_submission,
+        complete=complete,
+        fail=lambda gen_id, error, from_status="processing": db.transition(gen_id, from_status, "failed"),
+        record_retry=lambda gen_id, attempts: True,
+        dead_letter=lambda gen_id, error, attempts: db.transition(gen_id, "processing", "failed"),
+        fail_stale=lambda *args: [],
+        PROCESSING="processing", PENDING="pending",
+    )
+
+
+async def run(args):
+    started = time.perf_counter()
+    db = FakeDb(args.tasks, mixed=args.slow_cap is not None)
+    install(db, FakeProvider(args.render, args.flaky, args.stuck), FakeR2(args.r2), started, args.slow_cap)
+    application = SimpleNamespace(bot=FakeBot(), bot_data={})
+    queue_worker.HEARTBEAT_SECONDS = 3600
+
+    task = asyncio.create_task(queue_worker.worker_loop(application))
+    deadline = time.perf_counter() + args.timeout
+    while time.perf_counter() < deadline:
+        await asyncio.sleep(0.1)
+        if sum(1 for r in db.rows if r["status"] in ("completed", "failed")) >= args.tasks:
+            break
+    worker = application.bot_data["queue_worker"]
+    metrics = worker.describe()
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+    submitted = sorted(e["submitted"] for e in db.events.values() if "submitted" in e)
+    delivered = sorted(e["delivered"] for e in db.events.values() if "delivered" in e)
+    print(f"🧪 {args.tasks} tasks, render {args.render}s, R2 upload {args.r2}s, flaky submits {args.flaky:.0%}")
+    if submitted:
+        print(f"   all submitted after {submitted[-1]:6.2f} s ({len(submitted)} tasks)")
+    if delivered:
+        print(f"   all delivered after {delivered[-1]:6.2f} s ({len(delivered)} tasks)")
+    if args.slow_cap is not None:
+        for model in (FAST_MODEL, SLOW_MODEL):
+            times = sorted(db.events[r["id"]]["delivered"] for r in db.rows
+                           if r["model_name"] == model and "delivered" in db.events.get(r["id"], {}))
+            if times:
+                print(f"   {model:16} delivered {len(times)}, last after {times[-1]:6.2f} s")
+        print(f"   models: {queue_worker.model_limits.snapshot()}")
+    print(f"   stages: {metrics.replace(' | ', chr(10) + '           ')}")
+    failed = sum(1 for r in db.rows if r["status"] == "failed")
+    if failed:
+        print(f"   dead-lettered / failed: {failed}")
+    return len(delivered) + failed == args.tasks
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulate the staged queue worker with fake provider / R2")
+    parser.add_argument("--tasks", type=int, default=40)
+    parser.add_argument("--render", type=float, default=2.0, help="Provider render time per task (s)")
+    parser.add_argument("--r2", type=float, default=0.1, help="R2 upload time per video (s)")
+    parser.add_argument("--slow-cap", type=int, default=None, help="Mix in a slow model capped at this many in flight")
+    parser.add_argument("--flaky", type=float, default=0.0, help="Probability a submission fails temporarily")
+    parser.add_argument("--stuck", type=float, default=0.0, help="Probability a render never returns a video")
+    parser.add_argument("--timeout", type=float, default=120)
+    sys.exit(0 if asyncio.run(run(parser.parse_args())) else 1)
@@ -0,0 +1,312 @@
+"""
+Local multi-replica harness for webhook mode.
+
+Starts, all on 127.0.0.1:
+  * a fake Telegram Bot API (records every sendMessage),
+  * N bot replicas (separate processes) running WebhookServer +
+    PerChatUpdateProcessor + BotPersistence on a shared SQLite file,
+  * webhook_router.py in front of them,
+then replays a 4-step conversation (/start -> model -> duration -> photo) for
+many chats through the router. Between steps 2 and 3 one replica is killed,
+and it is restarted before step 4, so its chats are handed over to another
+replica and back in the middle of their conversation.
+
+Checks: wrong secret is rejected, every chat finishes its conversation with
+the values it chose (state survived the handovers), per-chat routing is
+sticky, and router latency.
+
+    python scripts/webhook_replica_harness.py --replicas 3 --chats 60
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOKEN = "123456:HARNESS"
+SECRET = "harness-secret"
+PATH = "/telegram"
+MODEL, DURATION, MEDIA = range(3)
+
+
+# --- Fake Bot API ---
+
+class FakeBotApi:
+    def __init__(self):
+        self.sent = []  # (chat_id, text)
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+    def call(self, method, params):
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "Harness", "username": "harness_bot"}
+        if method == "sendMessage":
+            with self._lock:
+                self._message_id += 1
+                self.sent.append((int(params["chat_id"]), params["text"]))
+                message_id = self._message_id
+            return {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"},
+                "text": params["text"],
+            }
+        return True
+
+    def serve(self, port):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                method = self.path.rsplit("/", 1)[-1]
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or "{}")
+                else:
+                    params = {k: v[0] for k, v in urllib.parse.parse_qs(body).items()}
+                out = json.dumps({"ok": True, "result": api.call(method, params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+# --- Replica process ---
+
+def run_replica(name, port, api_url, store_path):
+    from telegram import Update
+    from telegram.ext import ApplicationBuilder, CommandHandler, ConversationHandler, MessageHandler, filters
+    from bot_persistence import BotPersistence, SQLiteStore, SyncedConversationHandler
+    from update_processor import PerChatUpdateProcessor
+    from webhook_server import WebhookServer
+
+    async def start(update: Update, context):
+        await update.message.reply_text("pick a model")
+        return MODEL
+
+    async def pick_model(update: Update, context):
+        context.user_data["model"] = update.message.text
+        await update.message.reply_text("pick a duration")
+        return DURATION
+
+    async def pick_duration(update: Update, context):
+        context.user_data["duration"] = update.message.text
+        await update.message.reply_text("send a photo")
+        return MEDIA
+
+    async def media(update: Update, context):
+        await update.message.reply_text(
+            f"DONE {context.user_data.get('model')} {context.user_data.get('duration')} via {name}"
+        )
+        return ConversationHandler.END
+
+    async def main():
+        persistence = BotPersistence(SQLiteStore(store_path), update_interval=0.2)
+        application = ApplicationBuilder() \
+            .token(TOKEN) \
+            .base_url(f"{api_url}/bot") \
+            .updater(None) \
+            .concurrent_updates(PerChatUpdateProcessor()) \
+            .persistence(persistence) \
+            .build()
+        text = filters.TEXT & ~filters.COMMAND
+        conv_handler = SyncedConversationHandler(
+            entry_points=[CommandHandler("start", start)],
+            states={
+                MODEL: [MessageHandler(text, pick_model)],
+                DURATION: [MessageHandler(text, pick_duration)],
+                MEDIA: [MessageHandler(text, media)],
+            },
+            fallbacks=[],
+            name="harness",
+            persistent=True,
+        )
+        application.add_handler(conv_handler)
+        application.add_handler(persistence.sync_handler(conv_handler), group=-1)
+
+        server = WebhookServer(application, PATH, SECRET, on_handover=persistence.mark_stale)
+        stop_event = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop_event.set)
+        async with application:
+            await application.start()
+            await server.start("127.0.0.1", port)
+            await stop_event.wait()
+            await server.stop()
+            await application.stop()
+
+    asyncio.run(main())
+
+
+# --- Harness ---
+
+def wait_healthy(url, timeout=20):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1):
+                return True
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.1)
+    return False
+
+
+def spawn_replica(idx, port, api_url, store_path):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), "replica",
+         "--name", f"r{idx}", "--port", str(port), "--api", api_url, "--store", store_path],
+        cwd=ROOT,
+    )
+    if not wait_healthy(f"http://127.0.0.1:{port}/healthz"):
+        raise RuntimeError(f"replica r{idx} did not start")
+    return proc
+
+
+def make_update(update_id, chat_id, text):
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": f"user{chat_id}"},
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+    return {"update_id": update_id, "message": message}
+
+
+def post(url, payload, secret=SECRET):
+    request = urllib.request.Request(
+        url, data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret},
+        method="POST",
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as resp:
+            status = resp.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    return status, time.perf_counter() - started
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))] if values else 0
+
+
+def main(args):
+    import webhook_router
+
+    webhook_router.REPLICA_DOWN_SECONDS = 2
+    base_port = args.base_port
+    api_port, router_port = base_port, base_port + 1
+    replica_ports = [base_port + 10 + i for i in range(args.replicas)]
+    api_url = f"http://127.0.0.1:{api_port}"
+    router_url = f"http://127.0.0.1:{router_port}{PATH}"
+    store_path = os.path.join(tempfile.mkdtemp(prefix="bot_harness_"), "state.sqlite3")
+
+    api = FakeBotApi()
+    api.serve(api_port)
+    procs = [spawn_replica(i, port, api_url, store_path) for i, port in enumerate(replica_ports)]
+    replicas = [f"http://127.0.0.1:{port}{PATH}" for port in replica_ports]
+    _server, router = webhook_router.serve("127.0.0.1", router_port, replicas, secret=SECRET, path=PATH)
+    print(f"🧪 {args.replicas} replicas, {args.chats} chats, store {store_path}")
+
+    results = {}
+    try:
+        status, _ = post(router_url, make_update(1, 1, "/start"), secret="wrong")
+        results["wrong secret rejected"] = status == 403
+
+        chats = [10_000 + i for i in range(args.chats)]
+        steps = [
+            ("/start", None),
+            ("model-{c}", "kill"),
+            ("dur-{c}", "restart"),
+            ("photo", None),
+        ]
+        latencies = []
+        update_id = 100
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            for text, after in steps:
+                jobs = []
+                for chat_id in chats:
+                    update_id += 1
+                    jobs.append(pool.submit(post, router_url, make_update(update_id, chat_id, text.format(c=chat_id))))
+                statuses = [job.result() for job in jobs]
+                latencies.extend(lat for _, lat in statuses)
+                bad = [s for s, _ in statuses if s != 200]
+                print(f"  ▶ {text.format(c='<chat>'):10} {len(statuses) - len(bad)}/{len(statuses)} accepted")
+                time.sleep(2.0)  # Let replicas process and flush persistence
+
+                if after == "kill":
+                    procs[0].kill()
+                    procs[0].wait()
+                    print("  💥 replica r0 killed")
+                elif after == "restart":
+                    procs[0] = spawn_replica(0, replica_ports[0], api_url, store_path)
+                    time.sleep(webhook_router.REPLICA_DOWN_SECONDS)
+                    print("  ♻️  replica r0 restarted")
+
+        time.sleep(1.5)
+        done = {}
+        for chat_id, text in api.sent:
+            if text.startswith("DONE"):
+                done[chat_id] = text
+        complete = [c for c in chats if done.get(c, "").startswith(f"DONE model-{c} dur-{c} ")]
+        results["every chat finished with its own state"] = len(complete) == len(chats)
+        for chat_id in chats:
+            if chat_id not in complete:
+                print(f"   ⚠️ chat {chat_id}: {[t for c, t in api.sent if c == chat_id]}")
+
+        print(f"\n📊 Router: forwarded {router.forwarded}")
+        print(f"   handovers: {router.handovers} (includes first sight of each chat)")
+        print(f"   latency p50 {percentile(latencies, 50) * 1000:.1f} ms, p95 {percentile(latencies, 95) * 1000:.1f} ms")
+        print(f"   chats finished correctly: {len(complete)}/{len(chats)}")
+        for name, ok in results.items():
+            print(f"   {'✅' if ok else '❌'} {name}")
+        return all(results.values())
+    finally:
+        for proc in procs:
+            if proc.poll() is None:
+                proc.terminate()
+                proc.wait(timeout=10)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "replica":
+        parser = argparse.ArgumentParser()
+        parser.add_argument("replica")
+        parser.add_argument("--name", required=True)
+        parser.add_argument("--port", type=int, required=True)
+        parser.add_argument("--api", required=True)
+        parser.add_argument("--store", required=True)
+        a = parser.parse_args()
+        run_replica(a.name, a.port, a.api, a.store)
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Replay updates through the webhook router and several replicas")
+    parser.add_argument("--replicas", type=int, default=3)
+    parser.add_argument("--chats", type=int, default=60)
+    parser.add_argument("--base-port", type=int, default=18400)
+    sys.exit(0 if main(parser.parse_args()) else 1)
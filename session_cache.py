@@ -0,0 +1,157 @@
+"""
+In-memory cache of who is logged in on the bot.
+
+Most callbacks only need to know "does this chat still hold the user's
+session, and what tier is it". That answer is kept here per chat, keyed by
+the user's session_epoch. A repeating job asks the database for rows whose
+session changed since the last check (one indexed query, usually empty) and
+drops or updates the affected entries, so the web app taking a session back
+is noticed within SESSION_REFRESH_SECONDS without a users lookup per click.
+
+Sessions survive bot restarts. Each login stamps the user with
+BOT_SESSION_EPOCH; a session stamped with an older epoch is ended when the bot
+next sees that user (one single-row update), so raising BOT_SESSION_EPOCH
+logs everyone out lazily instead of with a mass update at startup.
+
+Views that show profile fields (credits, expiry, ...) still load the full row
+with get_user().
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+SESSION_REFRESH_SECONDS = 15
+REFRESH_OVERLAP_SECONDS = 30  # Re-read a margin of changes (commit delay, clock skew); applying twice is harmless
+BOT_SESSION_EPOCH = int(os.getenv("BOT_SESSION_EPOCH", "1"))  # Raise to end every Telegram session
+SESSION_COLUMNS = "id, telegram_id, active_platform, type, session_epoch, session_changed_at, bot_session_epoch"
+
+
+@dataclass(slots=True)
+class SessionEntry:
+    user_id: str
+    epoch: int
+    user_type: str  # lower-case tier: pro, ultra, unlimited, advance, ...
+
+
+class SessionCache:
+    def __init__(self, client):
+        self.client = client
+        self._lock = threading.Lock()
+        self._by_chat = {}  # telegram chat id (str) -> SessionEntry
+        self._chat_of_user = {}  # user id -> telegram chat id
+        self._checked_at = datetime.now(timezone.utc)
+        self.hits = 0
+        self.misses = 0
+
+    def remember(self, chat_id, user):
+        """Cache a users row (any select that includes the SESSION_COLUMNS fields)."""
+        chat_id = str(chat_id)
+        if user.get("active_platform") != "telegram" or str(user.get("telegram_id")) != chat_id:
+            self.forget_user(user.get("id"))
+            return None
+        if (user.get("bot_session_epoch") or 0) < BOT_SESSION_EPOCH:
+            self.expire(user)
+            return None
+        entry = SessionEntry(
+            user_id=user["id"],
+            epoch=user.get("session_epoch") or 0,
+            user_type=(user.get("type") or "try").lower(),
+        )
+        with self._lock:
+            old_chat = self._chat_of_user.get(entry.user_id)
+            if old_chat and old_chat != chat_id:
+                self._by_chat.pop(old_chat, None)
+            previous = self._by_chat.get(chat_id)
+            if previous and previous.user_id != entry.user_id:
+                self._chat_of_user.pop(previous.user_id, None)
+            self._by_chat[chat_id] = entry
+            self._chat_of_user[entry.user_id] = chat_id
+        return entry
+
+    def forget_user(self, user_id):
+        with self._lock:
+            chat_id = self._chat_of_user.pop(user_id, None)
+            if chat_id:
+                self._by_chat.pop(chat_id, None)
+
+    def forget_chat(self, chat_id):
+        with self._lock:
+            entry = self._by_chat.pop(str(chat_id), None)
+            if entry:
+                self._chat_of_user.pop(entry.user_id, None)
+
+    def expire(self, user):
+        """End a session opened under an older BOT_SESSION_EPOCH (this user only).
+        Conditional, so a login that raced ahead of us is left alone."""
+        self.forget_user(user["id"])
+        self.client.table("users") \
+            .update({"active_platform": "web"}) \
+            .eq("id", user["id"]) \
+            .eq("active_platform", "telegram") \
+            .lt("bot_session_epoch", BOT_SESSION_EPOCH) \
+            .execute()
+        logger.info(f"[SESSIONS] Session of user {user['id']} ended (epoch {user.get('bot_session_epoch')} < {BOT_SESSION_EPOCH})")
+
+    def validate(self, chat_id):
+        """SessionEntry if this chat holds an active bot session, else None.
+        Memory lookup; on a miss one narrow query (no select *)."""
+        with self._lock:
+            entry = self._by_chat.get(str(chat_id))
+        if entry:
+            self.hits += 1
+            return entry
+        self.misses += 1
+        res = self.client.table("users").select(SESSION_COLUMNS).eq("telegram_id", str(chat_id)).execute()
+        if not res.data:
+            return None
+        return self.remember(chat_id, res.data[0])
+
+    def refresh(self):
+        """Apply session changes made since the last check (logins elsewhere, web takeover, logout)."""
+        started = datetime.now(timezone.utc)
+        since = self._checked_at - timedelta(seconds=REFRESH_OVERLAP_SECONDS)
+        res = self.client.table("users") \
+            .select(SESSION_COLUMNS) \
+            .gt("session_changed_at", since.isoformat()) \
+            .execute()
+        changed = 0
+        for row in res.data or []:
+            with self._lock:
+                chat_id = self._chat_of_user.get(row["id"])
+                entry = self._by_chat.get(chat_id) if chat_id else None
+            if entry is None or entry.epoch == (row.get("session_epoch") or 0):
+                continue  # Not cached here, or already up to date
+            changed += 1
+            if row.get("active_platform") == "telegram" and row.get("telegram_id"):
+                self.remember(row["telegram_id"], row)
+            else:
+                self.forget_user(row["id"])
+        self._checked_at = started
+        return changed
+
+    def size(self):
+        with self._lock:
+            return len(self._by_chat)
+
+
+async def refresh_sessions(context):
+    """Repeating job: poll session changes (job data = SessionCache)."""
+    cache = context.job.data
+    started = time.time()
+    try:
+        changed = await asyncio.to_thread(cache.refresh)
+    except Exception as e:
+        logger.error(f"[SESSIONS] Refresh failed: {e}")
+        return
+    if changed:
+        logger.info(
+            f"[SESSIONS] {changed} cached sessions changed ({cache.size()} cached, "
+            f"{cache.hits} hits / {cache.misses} misses, {int((time.time() - started) * 1000)} ms)"
+        )
@@ -0,0 +1,100 @@
+"""
+Per-user conversation session (context.user_data).
+
+Replaces the loose user_data dict (which also held a full copy of the
+selected ai_models row) with a small slotted record: the selections the
+conversation needs and when the user was last seen. Model details are looked
+up in model_catalog by id. Idle sessions are evicted by a repeating job.
+"""
+import os
+import time
+import logging
+from dataclasses import dataclass, field
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+SESSION_IDLE_SECONDS = int(os.getenv("SESSION_IDLE_SECONDS", str(6 * 3600)))
+SESSION_SWEEP_SECONDS = 300
+CONVERSATION_TIMEOUT_SECONDS = int(os.getenv("CONVERSATION_TIMEOUT_SECONDS", str(30 * 60)))
+
+# Keys used by the old dict-based user_data (rows persisted before the switch)
+LEGACY_KEYS = {
+    "selected_model_id": "model_id",
+    "selected_duration": "duration",
+    "selected_ratio": "ratio",
+    "calculated_cost": "cost",
+}
+
+
+@dataclass(slots=True)
+class ChatSession:
+    model_id: str | None = None
+    duration: str | None = None  # "5" / "10", as picked
+    ratio: str = "16:9"
+    cost: int = 0
+    pending_photo: str | None = None   # Telegram file_id held while the user decides (queue full, see admission.py)
+    pending_prompt: str | None = None
+    pending_photo_unique_id: str | None = None  # Same photo across messages (enqueue key, see idempotency.py)
+    chat_id: int | None = None  # Chat of the user's conversation (its key, for eviction)
+    last_seen: float = field(default_factory=time.time)
+
+    def to_dict(self):
+        return {
+            "model_id": self.model_id,
+            "duration": self.duration,
+            "ratio": self.ratio,
+            "cost": self.cost,
+            "pending_photo": self.pending_photo,
+            "pending_prompt": self.pending_prompt,
+            "pending_photo_unique_id": self.pending_photo_unique_id,
+            "chat_id": self.chat_id,
+            "last_seen": self.last_seen,
+        }
+
+    def load(self, data):
+        """Replace this session's fields with a stored dict (in place)."""
+        data = {LEGACY_KEYS.get(k, k): v for k, v in (data or {}).items()}
+        self.model_id = data.get("model_id")
+        self.duration = data.get("duration")
+        self.ratio = data.get("ratio") or "16:9"
+        self.cost = data.get("cost") or 0
+        self.pending_photo = data.get("pending_photo")
+        self.pending_prompt = data.get("pending_prompt")
+        self.pending_photo_unique_id = data.get("pending_photo_unique_id")
+        self.chat_id = data.get("chat_id")
+        self.last_seen = data.get("last_seen") or time.time()
+
+    @classmethod
+    def from_dict(cls, data):
+        session = cls()
+        session.load(data)
+        return session
+
+
+async def touch_session(update, context):
+    """Group -1 handler: mark the user's session as active."""
+    if update.effective_user:
+        context.user_data.last_seen = time.time()
+        if update.effective_chat:
+            context.user_data.chat_id = update.effective_chat.id
+
+
+async def evict_idle_sessions(context):
+    """
+    Repeating job: drop sessions idle for SESSION_IDLE_SECONDS, and end their
+    conversation (job data = the SyncedConversationHandler, see bot_persistence.py).
+    Both are dropped from the persistence store too, so they stay gone after a restart.
+    """
+    application = context.application
+    conv_handler = context.job.data
+    cutoff = time.time() - SESSION_IDLE_SECONDS
+    idle = {user_id: session.chat_id for user_id, session in application.user_data.items() if session.last_seen < cutoff}
+    if not idle:
+        return
+    for user_id, chat_id in idle.items():
+        application.drop_user_data(user_id)
+        if conv_handler is not None:
+            # Sessions saved before chat_id was recorded: private chat, chat id = user id
+            conv_handler.end(conv_handler.key_for(chat_id or user_id, user_id))
+    logger.info(f"[SESSIONS] Evicted {len(idle)} idle sessions ({len(application.user_data)} left)")
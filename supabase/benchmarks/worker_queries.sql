@@ -0,0 +1,130 @@
+-- Benchmark: Telegram worker hot queries against a large generations history
+--
+-- Run against a scratch / local Postgres (NOT production):
+--   psql "$DATABASE_URL" -f supabase/benchmarks/worker_queries.sql
+--
+-- Everything lives in the `bench` schema, which is dropped and recreated.
+-- Seeds 1.2M finished rows (12 months, web + telegram), 20k abandoned
+-- 'processing' rows, 300 pending and 12 live processing rows, then times the worker's queries with only the old
+-- idx_generations_status_source index, and again with the partial indexes
+-- from 20261019000600_generations_hot_queue.sql.
+
+\set ON_ERROR_STOP on
+\timing on
+
+DROP SCHEMA IF EXISTS bench CASCADE;
+CREATE SCHEMA bench;
+
+CREATE TABLE bench.generations (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id UUID,
+    model_name TEXT,
+    prompt TEXT,
+    status TEXT DEFAULT 'pending',
+    source TEXT DEFAULT 'web',
+    lane TEXT DEFAULT 'shared',
+    video_url TEXT,
+    created_at TIMESTAMPTZ DEFAULT now()
+);
+
+\echo '== Seeding 1.2M history rows'
+INSERT INTO bench.generations (user_id, model_name, prompt, status, source, video_url, created_at)
+SELECT
+    ('00000000-0000-0000-0000-' || lpad((g % 5000)::text, 12, '0'))::uuid,
+    'kling-v2-1-std',
+    'history prompt ' || g,
+    CASE WHEN g % 10 = 0 THEN 'failed' ELSE 'completed' END,
+    CASE WHEN g % 3 = 0 THEN 'telegram' ELSE 'web' END,
+    'https://example.invalid/' || g || '.mp4',
+    now() - (g % 365) * INTERVAL '1 day' - (g % 86400) * INTERVAL '1 second'
+FROM generate_series(1, 1200000) AS g;
+
+\echo '== Seeding 20k abandoned processing rows (web tasks never finalized)'
+INSERT INTO bench.generations (user_id, model_name, status, source, created_at)
+SELECT ('00000000-0000-0000-0000-' || lpad((g % 5000)::text, 12, '0'))::uuid,
+       'kling-v2-1-std', 'processing', 'web', now() - INTERVAL '1 day' - g * INTERVAL '10 minutes'
+FROM generate_series(1, 20000) AS g;
+
+\echo '== Seeding live queue (300 pending, 12 processing)'
+INSERT INTO bench.generations (user_id, model_name, status, source, lane, created_at)
+SELECT ('00000000-0000-0000-0000-' || lpad((g % 200)::text, 12, '0'))::uuid,
+       'kling-v2-1-std', 'pending', 'telegram', CASE WHEN g % 5 = 0 THEN 'byok' ELSE 'shared' END,
+       now() - g * INTERVAL '2 seconds'
+FROM generate_series(1, 300) AS g;
+
+INSERT INTO bench.generations (user_id, model_name, status, source, lane, created_at)
+SELECT ('00000000-0000-0000-0000-' || lpad(g::text, 12, '0'))::uuid,
+       'kling-v2-1-std', 'processing', 'telegram', 'shared', now() - g * INTERVAL '1 minute'
+FROM generate_series(1, 12) AS g;
+
+CREATE INDEX idx_generations_status_source ON bench.generations (status, source);
+ANALYZE bench.generations;
+
+\echo '######## BEFORE: idx_generations_status_source only ########'
+
+\echo '-- worker fetch (oldest pending telegram task)'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT * FROM bench.generations
+ WHERE status = 'pending' AND source = 'telegram'
+ ORDER BY created_at LIMIT 1;
+
+\echo '-- worker fetch, BYOK lane only'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT * FROM bench.generations
+ WHERE status = 'pending' AND source = 'telegram' AND lane = 'byok'
+ ORDER BY created_at LIMIT 1;
+
+\echo '-- global concurrency count'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT count(*) FROM bench.generations
+ WHERE status = 'processing' AND lane = 'shared' AND created_at >= now() - INTERVAL '15 minutes';
+
+\echo '-- per-user concurrency count'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT count(*) FROM bench.generations
+ WHERE user_id = '00000000-0000-0000-0000-000000000007' AND status = 'processing';
+
+\echo '-- queue depth'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT count(*) FROM bench.generations
+ WHERE status = 'pending' AND source = 'telegram';
+
+CREATE INDEX idx_generations_pending_queue ON bench.generations (source, created_at) WHERE status = 'pending';
+CREATE INDEX idx_generations_processing_lane ON bench.generations (lane, created_at) WHERE status = 'processing';
+CREATE INDEX idx_generations_user_active ON bench.generations (user_id, status, created_at) WHERE status IN ('pending', 'processing');
+ANALYZE bench.generations;
+
+\echo '######## AFTER: partial hot-queue indexes ########'
+
+\echo '-- worker fetch (oldest pending telegram task)'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT * FROM bench.generations
+ WHERE status = 'pending' AND source = 'telegram'
+ ORDER BY created_at LIMIT 1;
+
+\echo '-- worker fetch, BYOK lane only'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT * FROM bench.generations
+ WHERE status = 'pending' AND source = 'telegram' AND lane = 'byok'
+ ORDER BY created_at LIMIT 1;
+
+\echo '-- global concurrency count'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT count(*) FROM bench.generations
+ WHERE status = 'processing' AND lane = 'shared' AND created_at >= now() - INTERVAL '15 minutes';
+
+\echo '-- per-user concurrency count'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT count(*) FROM bench.generations
+ WHERE user_id = '00000000-0000-0000-0000-000000000007' AND status = 'processing';
+
+\echo '-- queue depth'
+EXPLAIN (ANALYZE, BUFFERS, COSTS OFF)
+SELECT count(*) FROM bench.generations
+ WHERE status = 'pending' AND source = 'telegram';
+
+\echo '== Index sizes'
+SELECT indexrelname, pg_size_pretty(pg_relation_size(indexrelid)) AS size
+  FROM pg_stat_user_indexes WHERE schemaname = 'bench' ORDER BY indexrelname;
+
+DROP SCHEMA bench CASCADE;
@@ -0,0 +1,77 @@
+-- Minimal stand-in for the Supabase-managed tables the bot relies on.
+-- ONLY for a local/scratch Postgres, so supabase/migrations can be applied and
+-- tested without a copy of production:
+--   DATABASE_URL=postgresql://postgres@localhost:5432/universe_test python run_migration.py --bootstrap
+-- Never run this against Supabase.
+
+CREATE TABLE IF NOT EXISTS public.api_groups (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    name TEXT,
+    api_keys TEXT[] DEFAULT '{}',
+    created_at TIMESTAMPTZ DEFAULT now(),
+    updated_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS public.users (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    code TEXT UNIQUE,
+    name TEXT,
+    type TEXT DEFAULT 'PRO',
+    monthly_credits INTEGER DEFAULT 0,
+    extra_credits INTEGER DEFAULT 0,
+    credits INTEGER DEFAULT 0,
+    group_id UUID,
+    user_api_key TEXT,
+    custom_api_key TEXT,
+    telegram_id TEXT,
+    active_platform TEXT DEFAULT 'web',
+    last_login_at TIMESTAMPTZ,
+    expired_at TIMESTAMPTZ,
+    video_count INTEGER DEFAULT 0,
+    created_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS public.ai_models (
+    model_id TEXT PRIMARY KEY,
+    display_name TEXT,
+    credit_cost INTEGER DEFAULT 0,
+    cost_pro INTEGER,
+    is_active_telegram BOOLEAN DEFAULT TRUE,
+    sort_order INTEGER DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS public.generations (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id UUID,
+    model_name TEXT,
+    prompt TEXT,
+    status TEXT DEFAULT 'pending',
+    video_url TEXT,
+    r2_url TEXT,
+    task_id TEXT,
+    credits_used INTEGER,
+    api_key_used TEXT,
+    thumbnail_url TEXT,
+    created_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS public.tasks (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id UUID,
+    prompt TEXT,
+    status TEXT,
+    source TEXT,
+    file_url TEXT,
+    telegram_chat_id TEXT,
+    resolution TEXT,
+    created_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION public.increment_video_count(user_id UUID)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    UPDATE public.users u
+       SET video_count = COALESCE(u.video_count, 0) + 1
+     WHERE u.id = increment_video_count.user_id;
+$$;
@@ -0,0 +1,17 @@
+-- Migration: Export per-key circuit breaker state from the Telegram worker
+-- One row per Freepik API key (identified by a sha256 fingerprint, never the raw key).
+-- Rows are upserted only when a key's breaker changes state.
+
+CREATE TABLE IF NOT EXISTS public.api_key_health (
+    key_fingerprint TEXT PRIMARY KEY,
+    key_hint TEXT,
+    state TEXT NOT NULL DEFAULT 'closed',
+    consecutive_failures INTEGER DEFAULT 0,
+    open_until TIMESTAMPTZ,
+    last_error TEXT,
+    updated_at TIMESTAMPTZ DEFAULT now()
+);
+
+COMMENT ON TABLE public.api_key_health IS 'Circuit breaker state per Freepik API key (closed, open, half_open)';
+COMMENT ON COLUMN public.api_key_health.key_hint IS 'First 4 characters of the key, for humans';
+COMMENT ON COLUMN public.api_key_health.open_until IS 'Key is skipped until this time, then probed once';
@@ -0,0 +1,9 @@
+-- Migration: Queue lanes for the Telegram worker
+-- 'shared' tasks use the api_groups key pool and count against MAX_GLOBAL_CONCURRENT.
+-- 'byok' tasks run on the user's own Freepik key (ULTRA custom_api_key / ADVANCE user_api_key)
+-- and are limited per key instead.
+
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS lane TEXT DEFAULT 'shared';
+
+COMMENT ON COLUMN public.generations.lane IS 'Worker lane: shared (api_groups pool) or byok (user''s own API key)';
@@ -0,0 +1,107 @@
+-- Migration: Atomic credit reservation for the Telegram worker
+-- Replaces the read-modify-write in consume_credits (select balance, compute split
+-- in Python, write both columns back) with row-locked database functions.
+--
+-- Flow: reserve_credits() when a task is picked up -> commit_credits() when the
+-- video is delivered, or refund_credits() when submission / generation fails.
+-- Credits are taken from monthly_credits first, then extra_credits; a refund puts
+-- them back into the same buckets.
+
+CREATE TABLE IF NOT EXISTS public.credit_reservations (
+    id UUID PRIMARY KEY DEFAULT gen_random_uuid(),
+    user_id UUID NOT NULL,
+    generation_id TEXT,
+    monthly_amount INTEGER NOT NULL DEFAULT 0,
+    extra_amount INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'reserved' CHECK (status IN ('reserved', 'committed', 'refunded')),
+    created_at TIMESTAMPTZ DEFAULT now(),
+    updated_at TIMESTAMPTZ DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_credit_reservations_generation ON public.credit_reservations(generation_id);
+
+-- Returns one row (reservation_id, balance) or no rows when credits are insufficient.
+CREATE OR REPLACE FUNCTION public.reserve_credits(
+    p_user_id UUID,
+    p_amount INTEGER,
+    p_generation_id TEXT DEFAULT NULL,
+    p_commit BOOLEAN DEFAULT FALSE
+)
+RETURNS TABLE (reservation_id UUID, balance INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_monthly INTEGER;
+    v_extra INTEGER;
+    v_take_monthly INTEGER;
+BEGIN
+    SELECT COALESCE(monthly_credits, 0), COALESCE(extra_credits, 0)
+      INTO v_monthly, v_extra
+      FROM public.users
+     WHERE id = p_user_id
+       FOR UPDATE;
+
+    IF NOT FOUND OR v_monthly + v_extra < p_amount THEN
+        RETURN;
+    END IF;
+
+    v_take_monthly := LEAST(GREATEST(v_monthly, 0), p_amount);
+
+    UPDATE public.users
+       SET monthly_credits = v_monthly - v_take_monthly,
+           extra_credits = v_extra - (p_amount - v_take_monthly)
+     WHERE id = p_user_id;
+
+    INSERT INTO public.credit_reservations (user_id, generation_id, monthly_amount, extra_amount, status)
+    VALUES (p_user_id, p_generation_id, v_take_monthly, p_amount - v_take_monthly,
+            CASE WHEN p_commit THEN 'committed' ELSE 'reserved' END)
+    RETURNING id INTO reservation_id;
+
+    balance := v_monthly + v_extra - p_amount;
+    RETURN NEXT;
+END;
+$$;
+
+-- Marks a reservation as spent. Returns false if it was already committed/refunded.
+CREATE OR REPLACE FUNCTION public.commit_credits(p_reservation_id UUID)
+RETURNS BOOLEAN
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE public.credit_reservations
+       SET status = 'committed', updated_at = now()
+     WHERE id = p_reservation_id AND status = 'reserved';
+    RETURN FOUND;
+END;
+$$;
+
+-- Gives reserved credits back. Idempotent: returns the new balance, or NULL when
+-- the reservation was already committed/refunded.
+CREATE OR REPLACE FUNCTION public.refund_credits(p_reservation_id UUID)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_res public.credit_reservations%ROWTYPE;
+    v_balance INTEGER;
+BEGIN
+    UPDATE public.credit_reservations
+       SET status = 'refunded', updated_at = now()
+     WHERE id = p_reservation_id AND status = 'reserved'
+    RETURNING * INTO v_res;
+
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+
+    UPDATE public.users
+       SET monthly_credits = COALESCE(monthly_credits, 0) + v_res.monthly_amount,
+           extra_credits = COALESCE(extra_credits, 0) + v_res.extra_amount
+     WHERE id = v_res.user_id
+    RETURNING COALESCE(monthly_credits, 0) + COALESCE(extra_credits, 0) INTO v_balance;
+
+    RETURN v_balance;
+END;
+$$;
+
+COMMENT ON TABLE public.credit_reservations IS 'Credits held for a generation: reserved -> committed | refunded';
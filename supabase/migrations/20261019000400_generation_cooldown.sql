@@ -0,0 +1,76 @@
+-- Migration: Single-round-trip cooldown check + increment (Kling Motion Control)
+-- Replaces check_cooldown / update_user_cooldown, which each selected
+-- total_gen_cycle + last_generation_time and redid the WIB day rollover in Python
+-- (three round trips, racy between check and update).
+--
+-- Rules (unchanged):
+--   * total_gen_cycle resets when the WIB (Asia/Jakarta) date changes
+--   * every 3rd generation triggers a cooldown measured from last_generation_time
+--     UNLIMITED / ULTRA: 30 min * 2^((cycle / 3) - 1), capped at 24h
+--     PRO / ADVANCE:     15 min
+-- user_type is compared case-insensitively.
+
+ALTER TABLE public.users ADD COLUMN IF NOT EXISTS total_gen_cycle BIGINT DEFAULT 0;
+ALTER TABLE public.users ADD COLUMN IF NOT EXISTS last_generation_time TIMESTAMPTZ;
+
+CREATE OR REPLACE FUNCTION public.claim_generation_cooldown(p_user_id UUID, p_user_type TEXT)
+RETURNS TABLE (allowed BOOLEAN, remaining_seconds INTEGER, cycle INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_cycle INTEGER;
+    v_last TIMESTAMPTZ;
+    v_wait_minutes INTEGER := 0;
+    v_remaining DOUBLE PRECISION;
+BEGIN
+    SELECT COALESCE(u.total_gen_cycle, 0), u.last_generation_time
+      INTO v_cycle, v_last
+      FROM public.users u
+     WHERE u.id = p_user_id
+       FOR UPDATE;
+
+    IF NOT FOUND THEN
+        allowed := TRUE; remaining_seconds := 0; cycle := 0;
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    -- Lazy reset on WIB day change
+    IF v_last IS NULL OR (v_last AT TIME ZONE 'Asia/Jakarta')::date <> (now() AT TIME ZONE 'Asia/Jakarta')::date THEN
+        v_cycle := 0;
+    END IF;
+
+    IF v_cycle > 0 AND v_cycle % 3 = 0 THEN
+        IF upper(p_user_type) IN ('UNLIMITED', 'ULTRA') THEN
+            v_wait_minutes := LEAST(30 * power(2, (v_cycle / 3) - 1), 1440)::INTEGER;
+        ELSIF upper(p_user_type) IN ('PRO', 'ADVANCE') THEN
+            v_wait_minutes := 15;
+        END IF;
+
+        v_remaining := v_wait_minutes * 60 - EXTRACT(EPOCH FROM (now() - v_last));
+        IF v_remaining > 0 THEN
+            allowed := FALSE; remaining_seconds := CEIL(v_remaining)::INTEGER; cycle := v_cycle;
+            RETURN NEXT;
+            RETURN;
+        END IF;
+    END IF;
+
+    UPDATE public.users
+       SET total_gen_cycle = v_cycle + 1,
+           last_generation_time = now()
+     WHERE id = p_user_id;
+
+    allowed := TRUE; remaining_seconds := 0; cycle := v_cycle + 1;
+    RETURN NEXT;
+END;
+$$;
+
+-- Undo a claim when the task could not be created.
+CREATE OR REPLACE FUNCTION public.release_generation_cooldown(p_user_id UUID)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    UPDATE public.users
+       SET total_gen_cycle = GREATEST(COALESCE(total_gen_cycle, 0) - 1, 0)
+     WHERE id = p_user_id;
+$$;
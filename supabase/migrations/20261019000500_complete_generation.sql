@@ -0,0 +1,32 @@
+-- Migration: One-round-trip completion for generations
+-- processing -> completed and increment_video_count in a single RPC.
+-- Returns FALSE (and changes nothing) if the row is not in 'processing',
+-- so a duplicate poll callback can never count a video twice.
+
+CREATE OR REPLACE FUNCTION public.complete_generation(
+    p_generation_id UUID,
+    p_video_url TEXT,
+    p_r2_url TEXT DEFAULT NULL
+)
+RETURNS BOOLEAN
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_user_id UUID;
+BEGIN
+    UPDATE public.generations
+       SET status = 'completed',
+           video_url = p_video_url,
+           r2_url = COALESCE(p_r2_url, p_video_url)
+     WHERE id = p_generation_id
+       AND status = 'processing'
+    RETURNING user_id INTO v_user_id;
+
+    IF NOT FOUND THEN
+        RETURN FALSE;
+    END IF;
+
+    PERFORM public.increment_video_count(v_user_id);
+    RETURN TRUE;
+END;
+$$;
@@ -0,0 +1,107 @@
+-- Migration: Keep the Telegram worker's queries off the cold history
+-- `generations` is both the live queue and the permanent log. The only index,
+-- idx_generations_status_source, has no created_at, so "oldest pending" sorts
+-- every matching row and the concurrency counts scan all 'processing' history.
+--
+-- 1. Partial indexes that only contain live rows (pending / processing). They stay
+--    tiny no matter how large the history grows.
+-- 2. A monthly-partitioned generations_archive plus archive_finished_generations()
+--    to move old completed/failed rows out of the hot table (opt-in, run from
+--    pg_cron or by hand). generations_history shows both for reporting.
+--
+-- Benchmark: supabase/benchmarks/worker_queries.sql
+--
+-- Indexes are built CONCURRENTLY so the live queue is never locked; the runner
+-- executes this file statement by statement outside a transaction.
+-- migrate:no-transaction
+
+-- 1. Hot-path indexes --------------------------------------------------------
+
+-- Worker fetch: status = 'pending' AND source = 'telegram' [AND lane = 'byok'] ORDER BY created_at LIMIT 1
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_generations_pending_queue
+    ON public.generations (source, created_at)
+    WHERE status = 'pending';
+
+-- Global concurrency: status = 'processing' AND lane = 'shared' AND created_at >= now() - 15 min
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_generations_processing_lane
+    ON public.generations (lane, created_at)
+    WHERE status = 'processing';
+
+-- Per-user concurrency, stale cleanup and the PRO anti-spam check: user_id + status
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_generations_user_active
+    ON public.generations (user_id, status, created_at)
+    WHERE status IN ('pending', 'processing');
+
+-- 2. Cold history -------------------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS public.generations_archive
+    (LIKE public.generations INCLUDING DEFAULTS)
+    PARTITION BY RANGE (created_at);
+
+-- Creates the monthly partition holding p_month (no-op if it exists).
+CREATE OR REPLACE FUNCTION public.ensure_generations_archive_partition(p_month DATE)
+RETURNS TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_start DATE := date_trunc('month', p_month)::date;
+    v_name TEXT := 'generations_archive_' || to_char(v_start, 'YYYY_MM');
+BEGIN
+    IF to_regclass('public.' || v_name) IS NULL THEN
+        EXECUTE format(
+            'CREATE TABLE public.%I PARTITION OF public.generations_archive FOR VALUES FROM (%L) TO (%L)',
+            v_name, v_start, (v_start + INTERVAL '1 month')::date
+        );
+        EXECUTE format('CREATE INDEX ON public.%I (user_id, created_at)', v_name);
+    END IF;
+    RETURN v_name;
+END;
+$$;
+
+-- Moves finished rows older than p_older_than into the archive, at most p_batch
+-- rows per call. Returns the number of rows moved; call until it returns 0.
+CREATE OR REPLACE FUNCTION public.archive_finished_generations(
+    p_older_than INTERVAL DEFAULT INTERVAL '90 days',
+    p_batch INTEGER DEFAULT 5000
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_month DATE;
+    v_moved INTEGER;
+BEGIN
+    CREATE TEMP TABLE IF NOT EXISTS _archive_batch ON COMMIT DROP AS
+        SELECT * FROM public.generations WITH NO DATA;
+
+    WITH moved AS (
+        DELETE FROM public.generations
+         WHERE id IN (
+            SELECT id FROM public.generations
+             WHERE status IN ('completed', 'failed')
+               AND created_at < now() - p_older_than
+             ORDER BY created_at
+             LIMIT p_batch
+         )
+        RETURNING *
+    )
+    INSERT INTO _archive_batch SELECT * FROM moved;
+
+    FOR v_month IN SELECT DISTINCT date_trunc('month', created_at)::date FROM _archive_batch LOOP
+        PERFORM public.ensure_generations_archive_partition(v_month);
+    END LOOP;
+
+    INSERT INTO public.generations_archive SELECT * FROM _archive_batch;
+    GET DIAGNOSTICS v_moved = ROW_COUNT;
+    TRUNCATE _archive_batch;
+    RETURN v_moved;
+END;
+$$;
+
+CREATE OR REPLACE VIEW public.generations_history AS
+    SELECT * FROM public.generations
+    UNION ALL
+    SELECT * FROM public.generations_archive;
+
+COMMENT ON TABLE public.generations_archive IS 'Finished generations moved out of the hot table (monthly partitions). Keep columns in sync with generations.';
+COMMENT ON FUNCTION public.archive_finished_generations(INTERVAL, INTEGER) IS 'Move completed/failed generations older than the interval into generations_archive';
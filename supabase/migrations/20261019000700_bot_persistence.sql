@@ -0,0 +1,14 @@
+-- Migration: Shared conversation state for the Telegram bot
+-- Lets several bot replicas (webhook mode) continue each other's conversations.
+-- scope: 'conversation:<handler name>' (key = '<chat_id>:<user_id>', data = state)
+--        'user_data'                  (key = '<user_id>',           data = context.user_data)
+
+CREATE TABLE IF NOT EXISTS public.bot_persistence (
+    scope TEXT NOT NULL,
+    key TEXT NOT NULL,
+    data JSONB NOT NULL,
+    updated_at TIMESTAMPTZ DEFAULT now(),
+    PRIMARY KEY (scope, key)
+);
+
+COMMENT ON TABLE public.bot_persistence IS 'python-telegram-bot persistence (conversation states and user_data), shared by all bot replicas';
@@ -0,0 +1,41 @@
+-- migrate:no-transaction
+-- Migration: Session epoch for the Telegram bot's in-memory session cache
+-- Every change of who holds a user's session (login on the bot, web taking the
+-- session back, logout, tier change) bumps session_epoch and stamps
+-- session_changed_at. The bot validates callbacks from memory and polls only the
+-- rows changed since its last check (see session_cache.py), so the web app needs
+-- no changes: its usual `active_platform = 'web'` update fires the trigger.
+
+ALTER TABLE public.users
+ADD COLUMN IF NOT EXISTS session_epoch BIGINT NOT NULL DEFAULT 0;
+
+ALTER TABLE public.users
+ADD COLUMN IF NOT EXISTS session_changed_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE OR REPLACE FUNCTION public.bump_user_session_epoch()
+RETURNS trigger
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    IF NEW.active_platform IS DISTINCT FROM OLD.active_platform
+       OR NEW.telegram_id IS DISTINCT FROM OLD.telegram_id
+       OR NEW.type IS DISTINCT FROM OLD.type THEN
+        NEW.session_epoch := OLD.session_epoch + 1;
+        NEW.session_changed_at := now();
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS trg_users_session_epoch ON public.users;
+
+CREATE TRIGGER trg_users_session_epoch
+BEFORE UPDATE OF active_platform, telegram_id, type ON public.users
+FOR EACH ROW
+EXECUTE FUNCTION public.bump_user_session_epoch();
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_session_changed_at
+ON public.users (session_changed_at);
+
+COMMENT ON COLUMN public.users.session_epoch IS 'Bumped whenever the session owner changes (login, web takeover, logout, tier change)';
+COMMENT ON COLUMN public.users.session_changed_at IS 'When session_epoch last changed; the bot polls rows newer than its last check';
@@ -0,0 +1,13 @@
+-- Migration: Bot session epoch stamped at login
+-- Replaces the force logout the bot ran on every start (one UPDATE over all
+-- Telegram users). The bot now stamps bot_session_epoch = BOT_SESSION_EPOCH when
+-- a user logs in and, when it next sees that user, logs out only that user if
+-- the stamp is older than its own BOT_SESSION_EPOCH. Raising BOT_SESSION_EPOCH
+-- is the explicit "log everyone out" switch; a plain restart keeps sessions.
+-- Existing rows get 1 (the default epoch), so current sessions stay valid.
+-- Adding a column with a constant default does not rewrite the table.
+
+ALTER TABLE public.users
+ADD COLUMN IF NOT EXISTS bot_session_epoch INTEGER NOT NULL DEFAULT 1;
+
+COMMENT ON COLUMN public.users.bot_session_epoch IS 'BOT_SESSION_EPOCH of the bot when this user last logged in on Telegram';
@@ -0,0 +1,41 @@
+-- Migration: Hot-reloadable limits for the Telegram worker's shared lane
+-- The worker adapts its shared-lane concurrency and delay between submissions
+-- (AIMD on provider 429s / timeouts / latency, see concurrency_control.py)
+-- within the bounds of this row, re-read every 30 s. Set adaptive = false to
+-- pin initial_concurrent / initial_delay_seconds (the old static limits).
+-- NULL columns fall back to the worker's defaults.
+
+CREATE TABLE IF NOT EXISTS public.worker_limits (
+    name TEXT PRIMARY KEY,
+    adaptive BOOLEAN NOT NULL DEFAULT true,
+    initial_concurrent INTEGER,
+    min_concurrent INTEGER,
+    max_concurrent INTEGER,
+    initial_delay_seconds REAL,
+    min_delay_seconds REAL,
+    max_delay_seconds REAL,
+    increase_step REAL,
+    rate_step REAL,
+    decrease_factor REAL,
+    decrease_cooldown_seconds REAL,
+    latency_target_ms INTEGER,
+    updated_at TIMESTAMPTZ DEFAULT now(),
+    CONSTRAINT worker_limits_concurrency_bounds CHECK (min_concurrent IS NULL OR max_concurrent IS NULL OR min_concurrent <= max_concurrent),
+    CONSTRAINT worker_limits_delay_bounds CHECK (min_delay_seconds IS NULL OR max_delay_seconds IS NULL OR (min_delay_seconds > 0 AND min_delay_seconds <= max_delay_seconds)),
+    CONSTRAINT worker_limits_decrease_factor CHECK (decrease_factor IS NULL OR (decrease_factor > 0 AND decrease_factor < 1))
+);
+
+INSERT INTO public.worker_limits (
+    name, adaptive, initial_concurrent, min_concurrent, max_concurrent,
+    initial_delay_seconds, min_delay_seconds, max_delay_seconds,
+    increase_step, rate_step, decrease_factor, decrease_cooldown_seconds, latency_target_ms
+) VALUES (
+    'telegram', true, 12, 2, 48,
+    5, 0.5, 15,
+    1, 0.1, 0.7, 5, 10000
+)
+ON CONFLICT (name) DO NOTHING;
+
+COMMENT ON TABLE public.worker_limits IS 'Bounds and tuning for the worker''s adaptive shared-lane limits (one row per worker, hot reloaded)';
+COMMENT ON COLUMN public.worker_limits.adaptive IS 'false = fixed initial_concurrent / initial_delay_seconds';
+COMMENT ON COLUMN public.worker_limits.latency_target_ms IS 'Submit latency EWMA above this counts as congestion';
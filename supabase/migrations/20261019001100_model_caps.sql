@@ -0,0 +1,23 @@
+-- Migration: Per-model concurrency and rate caps for the queue worker
+-- Freepik enforces quotas per model endpoint, and slow models (the 1080p
+-- renders) could take every shared slot. The worker now reads two caps per
+-- ai_models row (through its model catalog, so edits apply within a minute):
+--   max_concurrent  generations of this model in flight at once
+--   max_per_minute  submissions of this model per minute
+-- NULL means no cap (only the global / per-user limits apply). While a model
+-- is at its cap, the worker keeps claiming pending tasks of other models.
+
+ALTER TABLE public.ai_models
+ADD COLUMN IF NOT EXISTS max_concurrent INTEGER CHECK (max_concurrent IS NULL OR max_concurrent > 0);
+
+ALTER TABLE public.ai_models
+ADD COLUMN IF NOT EXISTS max_per_minute INTEGER CHECK (max_per_minute IS NULL OR max_per_minute > 0);
+
+COMMENT ON COLUMN public.ai_models.max_concurrent IS 'Queue worker: max generations of this model in flight (NULL = no cap)';
+COMMENT ON COLUMN public.ai_models.max_per_minute IS 'Queue worker: max submissions of this model per minute (NULL = no cap)';
+
+-- The slow 1080p models get a cap so they leave room for everything else
+UPDATE public.ai_models
+SET max_concurrent = 4
+WHERE model_id IN ('wan-v2-6-1080p', 'seedance-pro-1080p')
+  AND max_concurrent IS NULL;
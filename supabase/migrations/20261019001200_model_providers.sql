@@ -0,0 +1,24 @@
+-- Migration: Provider routing per model
+-- The worker submits through a provider backend registry (providers.py) instead
+-- of calling Freepik directly. Each ai_models row picks its backend:
+--   provider           primary backend (NULL = freepik)
+--   fallback_provider  backend used while the primary is saturated (429 on every
+--                      key / no usable key); NULL = no failover
+-- generations.provider records which backend accepted the task, so polls go to
+-- the same one. Also added to generations_archive to keep the two in sync.
+
+ALTER TABLE public.ai_models
+ADD COLUMN IF NOT EXISTS provider TEXT;
+
+ALTER TABLE public.ai_models
+ADD COLUMN IF NOT EXISTS fallback_provider TEXT;
+
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS provider TEXT;
+
+ALTER TABLE public.generations_archive
+ADD COLUMN IF NOT EXISTS provider TEXT;
+
+COMMENT ON COLUMN public.ai_models.provider IS 'Provider backend for this model (NULL = freepik)';
+COMMENT ON COLUMN public.ai_models.fallback_provider IS 'Backend used while the primary provider is saturated (NULL = no failover)';
+COMMENT ON COLUMN public.generations.provider IS 'Provider backend that accepted the task (NULL = freepik)';
@@ -0,0 +1,59 @@
+-- Migration: Submission retries and dead-lettered generations
+-- A submission that fails for a temporary reason (every key 429 / 5xx / timeout)
+-- is no longer failed on the spot: the worker keeps the row processing (credits
+-- stay reserved) and retries it with exponential backoff and jitter, counting
+-- the attempts in submit_attempts. When the budget runs out the row is
+-- dead-lettered: status 'failed' (the apps only know the four statuses) with
+-- dead_lettered_at set, and the reservation is refunded.
+-- requeue_dead_lettered_generations() puts recent dead-lettered rows back in
+-- the queue once the provider has recovered.
+-- Columns are also added to generations_archive to keep the two in sync.
+-- migrate:no-transaction
+
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS submit_attempts INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS dead_lettered_at TIMESTAMPTZ;
+
+ALTER TABLE public.generations_archive
+ADD COLUMN IF NOT EXISTS submit_attempts INTEGER NOT NULL DEFAULT 0;
+
+ALTER TABLE public.generations_archive
+ADD COLUMN IF NOT EXISTS dead_lettered_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN public.generations.submit_attempts IS 'Failed provider submissions so far (temporary errors, retried by the worker)';
+COMMENT ON COLUMN public.generations.dead_lettered_at IS 'Set when the worker gave up after the retry budget (row is failed, credits refunded)';
+
+-- Dead letters are rare: a partial index keeps looking them up free
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_generations_dead_lettered
+    ON public.generations (dead_lettered_at)
+    WHERE dead_lettered_at IS NOT NULL;
+
+-- Back to pending (the worker claims, prices and reserves them again).
+-- Returns the number of rows requeued.
+CREATE OR REPLACE FUNCTION public.requeue_dead_lettered_generations(
+    p_since INTERVAL DEFAULT INTERVAL '1 day'
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_count INTEGER;
+BEGIN
+    UPDATE public.generations
+       SET status = 'pending',
+           error = NULL,
+           submit_attempts = 0,
+           dead_lettered_at = NULL,
+           -- Back of the queue, and not "stale" to the worker's 10 minute cleanup
+           created_at = now()
+     WHERE status = 'failed'
+       AND dead_lettered_at IS NOT NULL
+       AND dead_lettered_at >= now() - p_since;
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$;
+
+COMMENT ON FUNCTION public.requeue_dead_lettered_generations(INTERVAL) IS 'Put generations dead-lettered within the interval back in the queue';
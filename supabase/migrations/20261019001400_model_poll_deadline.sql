@@ -0,0 +1,15 @@
+-- Migration: Per-model poll deadline for the queue worker
+-- The worker polls a submitted generation every few seconds. It used to keep
+-- polling forever when the provider answered with an error or with
+-- "completed" but no video. Now every task has a deadline counted from
+-- submission: POLL_DEADLINE_SECONDS (600) by default, or this column for slow
+-- models. When the deadline passes, or after POLL_MAX_ERRORS checks in a row
+-- with no answer, the worker checks one last time. Then it fails the row and
+-- refunds the credits.
+-- Note: the worker's stale cleanup still fails processing rows 10 minutes
+-- after they were queued, so values above 600 only help once that changes.
+
+ALTER TABLE public.ai_models
+ADD COLUMN IF NOT EXISTS poll_deadline_seconds INTEGER CHECK (poll_deadline_seconds IS NULL OR poll_deadline_seconds > 0);
+
+COMMENT ON COLUMN public.ai_models.poll_deadline_seconds IS 'Queue worker: give up polling this long after submission (NULL = POLL_DEADLINE_SECONDS)';
@@ -0,0 +1,57 @@
+-- Migration: Idempotent enqueue from the Telegram bot
+-- A re-sent photo (same user, same Telegram file, prompt, model, duration and
+-- ratio) used to run the whole enqueue path again: R2 upload, a second
+-- generations row, credits charged twice. The bot now stores a hash of those
+-- inputs in idempotency_key, skips duplicates it has seen itself before the
+-- upload, and this unique index rejects the rest at insert (other replica,
+-- restart). Only pending / processing rows count: once a generation has
+-- finished, the same photo may be sent again on purpose.
+-- Columns are also added to generations_archive to keep the two in sync.
+-- migrate:no-transaction
+
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+
+ALTER TABLE public.generations_archive
+ADD COLUMN IF NOT EXISTS idempotency_key TEXT;
+
+COMMENT ON COLUMN public.generations.idempotency_key IS 'Bot enqueue key: sha256 of user, file_unique_id, prompt, model, duration, ratio (unique while pending / processing)';
+
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS idx_generations_active_idempotency_key
+    ON public.generations (idempotency_key)
+    WHERE idempotency_key IS NOT NULL AND status IN ('pending', 'processing');
+
+-- Requeueing a dead letter must not collide with the same request sent again
+-- meanwhile: those rows stay failed (the newer row is the one that runs).
+CREATE OR REPLACE FUNCTION public.requeue_dead_lettered_generations(
+    p_since INTERVAL DEFAULT INTERVAL '1 day'
+)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_count INTEGER;
+BEGIN
+    UPDATE public.generations g
+       SET status = 'pending',
+           error = NULL,
+           submit_attempts = 0,
+           dead_lettered_at = NULL,
+           -- Back of the queue, and not "stale" to the worker's 10 minute cleanup
+           created_at = now()
+     WHERE g.status = 'failed'
+       AND g.dead_lettered_at IS NOT NULL
+       AND g.dead_lettered_at >= now() - p_since
+       AND (
+           g.idempotency_key IS NULL
+           OR NOT EXISTS (
+               SELECT 1
+                 FROM public.generations a
+                WHERE a.idempotency_key = g.idempotency_key
+                  AND a.status IN ('pending', 'processing')
+           )
+       );
+    GET DIAGNOSTICS v_count = ROW_COUNT;
+    RETURN v_count;
+END;
+$$;
@@ -0,0 +1,48 @@
+-- Migration: Fail stale generations and refund their credits in one call
+-- The worker's stale cleanup used to mark a user's old processing rows failed
+-- with a plain UPDATE. Rows left behind by the worker (a restart drops the
+-- in-memory polls) kept their credit reservation 'reserved' forever, so the
+-- user's credits leaked. fail_stale_generations() fails the rows and refunds
+-- every open reservation of those rows in the same transaction, like
+-- complete_generation / refund_credits.
+
+CREATE OR REPLACE FUNCTION public.fail_stale_generations(
+    p_user_id UUID,
+    p_created_before TIMESTAMPTZ,
+    p_error TEXT
+)
+RETURNS TABLE (gen_id UUID, chat_id TEXT, gen_options JSONB, refunded INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_gen RECORD;
+    v_res RECORD;
+BEGIN
+    FOR v_gen IN
+        UPDATE public.generations g
+           SET status = 'failed', error = p_error
+         WHERE g.user_id = p_user_id
+           AND g.status = 'processing'
+           AND g.created_at < p_created_before
+        RETURNING g.id, g.telegram_chat_id, g.options
+    LOOP
+        gen_id := v_gen.id;
+        chat_id := v_gen.telegram_chat_id;
+        gen_options := v_gen.options;
+        refunded := 0;
+        FOR v_res IN
+            SELECT r.id, r.monthly_amount + r.extra_amount AS amount
+              FROM public.credit_reservations r
+             WHERE r.generation_id = v_gen.id::TEXT
+               AND r.status = 'reserved'
+        LOOP
+            IF public.refund_credits(v_res.id) IS NOT NULL THEN
+                refunded := refunded + v_res.amount;
+            END IF;
+        END LOOP;
+        RETURN NEXT;
+    END LOOP;
+END;
+$$;
+
+COMMENT ON FUNCTION public.fail_stale_generations(UUID, TIMESTAMPTZ, TEXT) IS 'Worker stale cleanup: processing -> failed for a user''s old rows, refunding their reserved credits';
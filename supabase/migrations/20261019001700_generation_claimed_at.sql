@@ -0,0 +1,80 @@
+-- Migration: Stale cleanup measured from the claim, skipping rows the worker holds
+-- The worker's stale cleanup failed processing rows 10 minutes after
+-- created_at, which is when the task was queued. A task that waited in the
+-- queue could be failed while the worker was still polling it (so the
+-- per-model poll_deadline_seconds never applied), and a later successful poll
+-- then delivered a row that was already failed.
+-- The worker now sets claimed_at when it claims a row (pending ->
+-- processing). fail_stale_generations() counts staleness from claimed_at
+-- (created_at for rows claimed before this column existed) and skips the ids
+-- the worker still holds (submitting, retrying or polling); those end through
+-- the worker's own deadline, fail and refund path.
+-- The worker's shared-lane load count (check_global_concurrency) also filters
+-- on claimed_at now: rows processing at migration time get claimed_at =
+-- created_at so the count keeps seeing them, and idx_generations_processing_claimed
+-- serves it (idx_generations_processing_lane is on created_at).
+-- Columns are also added to generations_archive to keep the two in sync.
+-- migrate:no-transaction
+
+ALTER TABLE public.generations
+ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ;
+
+ALTER TABLE public.generations_archive
+ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN public.generations.claimed_at IS 'Set by the queue worker on pending -> processing (stale cleanup and load counting start here)';
+
+UPDATE public.generations
+   SET claimed_at = created_at
+ WHERE status = 'processing'
+   AND claimed_at IS NULL;
+
+-- Global concurrency: status = 'processing' AND lane = 'shared' AND claimed_at >= now() - 15 min
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_generations_processing_claimed
+    ON public.generations (lane, claimed_at)
+    WHERE status = 'processing';
+
+DROP FUNCTION IF EXISTS public.fail_stale_generations(UUID, TIMESTAMPTZ, TEXT);
+
+CREATE OR REPLACE FUNCTION public.fail_stale_generations(
+    p_user_id UUID,
+    p_claimed_before TIMESTAMPTZ,
+    p_error TEXT,
+    p_exclude UUID[] DEFAULT '{}'
+)
+RETURNS TABLE (gen_id UUID, chat_id TEXT, gen_options JSONB, refunded INTEGER)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_gen RECORD;
+    v_res RECORD;
+BEGIN
+    FOR v_gen IN
+        UPDATE public.generations g
+           SET status = 'failed', error = p_error
+         WHERE g.user_id = p_user_id
+           AND g.status = 'processing'
+           AND COALESCE(g.claimed_at, g.created_at) < p_claimed_before
+           AND NOT (g.id = ANY (COALESCE(p_exclude, '{}')))
+        RETURNING g.id, g.telegram_chat_id, g.options
+    LOOP
+        gen_id := v_gen.id;
+        chat_id := v_gen.telegram_chat_id;
+        gen_options := v_gen.options;
+        refunded := 0;
+        FOR v_res IN
+            SELECT r.id, r.monthly_amount + r.extra_amount AS amount
+              FROM public.credit_reservations r
+             WHERE r.generation_id = v_gen.id::TEXT
+               AND r.status = 'reserved'
+        LOOP
+            IF public.refund_credits(v_res.id) IS NOT NULL THEN
+                refunded := refunded + v_res.amount;
+            END IF;
+        END LOOP;
+        RETURN NEXT;
+    END LOOP;
+END;
+$$;
+
+COMMENT ON FUNCTION public.fail_stale_generations(UUID, TIMESTAMPTZ, TEXT, UUID[]) IS 'Worker stale cleanup: processing -> failed for a user''s rows claimed before the cutoff (except p_exclude), refunding their reserved credits';
@@ -0,0 +1,87 @@
+-- Migration: Cooldown enforcement as before, and a release that restores the claim
+-- claim_generation_cooldown (20261019000400) compared user_type
+-- case-insensitively. The bot passes lowercase tiers and the old Python check
+-- compared them against uppercase names, so the wait was never enforced;
+-- comparing case-insensitively started denying paying users. The tiers are
+-- compared exactly again (counting is unchanged).
+-- release_generation_cooldown only decremented total_gen_cycle and left
+-- last_generation_time at the released claim. The claim now also returns
+-- the time it set (claimed_at) and the one it replaced (previous_time), and
+-- the release puts previous_time back as long as no later claim moved it.
+
+DROP FUNCTION IF EXISTS public.claim_generation_cooldown(UUID, TEXT);
+DROP FUNCTION IF EXISTS public.release_generation_cooldown(UUID);
+
+CREATE OR REPLACE FUNCTION public.claim_generation_cooldown(p_user_id UUID, p_user_type TEXT)
+RETURNS TABLE (allowed BOOLEAN, remaining_seconds INTEGER, cycle INTEGER, claimed_at TIMESTAMPTZ, previous_time TIMESTAMPTZ)
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    v_cycle INTEGER;
+    v_last TIMESTAMPTZ;
+    v_wait_minutes INTEGER := 0;
+    v_remaining DOUBLE PRECISION;
+BEGIN
+    SELECT COALESCE(u.total_gen_cycle, 0), u.last_generation_time
+      INTO v_cycle, v_last
+      FROM public.users u
+     WHERE u.id = p_user_id
+       FOR UPDATE;
+
+    IF NOT FOUND THEN
+        allowed := TRUE; remaining_seconds := 0; cycle := 0;
+        RETURN NEXT;
+        RETURN;
+    END IF;
+
+    -- Lazy reset on WIB day change
+    IF v_last IS NULL OR (v_last AT TIME ZONE 'Asia/Jakarta')::date <> (now() AT TIME ZONE 'Asia/Jakarta')::date THEN
+        v_cycle := 0;
+    END IF;
+
+    IF v_cycle > 0 AND v_cycle % 3 = 0 THEN
+        -- Exact tier names, like the original check_cooldown
+        IF p_user_type IN ('UNLIMITED', 'ULTRA') THEN
+            v_wait_minutes := LEAST(30 * power(2, (v_cycle / 3) - 1), 1440)::INTEGER;
+        ELSIF p_user_type IN ('PRO', 'ADVANCE') THEN
+            v_wait_minutes := 15;
+        END IF;
+
+        v_remaining := v_wait_minutes * 60 - EXTRACT(EPOCH FROM (now() - v_last));
+        IF v_remaining > 0 THEN
+            allowed := FALSE; remaining_seconds := CEIL(v_remaining)::INTEGER; cycle := v_cycle;
+            RETURN NEXT;
+            RETURN;
+        END IF;
+    END IF;
+
+    UPDATE public.users
+       SET total_gen_cycle = v_cycle + 1,
+           last_generation_time = now()
+     WHERE id = p_user_id;
+
+    allowed := TRUE; remaining_seconds := 0; cycle := v_cycle + 1;
+    claimed_at := now(); previous_time := v_last;
+    RETURN NEXT;
+END;
+$$;
+
+-- Undo a claim when the task could not be created.
+-- p_claimed_at / p_previous_time: claimed_at / previous_time returned by the claim
+-- (without them only the counter is given back).
+CREATE OR REPLACE FUNCTION public.release_generation_cooldown(
+    p_user_id UUID,
+    p_claimed_at TIMESTAMPTZ DEFAULT NULL,
+    p_previous_time TIMESTAMPTZ DEFAULT NULL
+)
+RETURNS VOID
+LANGUAGE sql
+AS $$
+    UPDATE public.users
+       SET total_gen_cycle = GREATEST(COALESCE(total_gen_cycle, 0) - 1, 0),
+           last_generation_time = CASE
+               WHEN p_claimed_at IS NOT NULL AND last_generation_time = p_claimed_at THEN p_previous_time
+               ELSE last_generation_time
+           END
+     WHERE id = p_user_id;
+$$;
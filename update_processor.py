@@ -0,0 +1,87 @@
+import os
+import asyncio
+import logging
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+# Updates handled at the same time across all chats
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "32"))
+# Updates allowed to wait (e.g. behind their own chat) before PTB stops pulling more
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", str(MAX_CONCURRENT_UPDATES * 8)))
+
+
+def update_chat_id(update):
+    """Chat an update belongs to, or None for updates without a chat (polls, inline, ...)."""
+    if isinstance(update, Update) and update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """
+    Runs updates from different chats concurrently while updates from the
+    same chat are handled strictly one after another, in arrival order.
+
+    ConversationHandler keeps its state per chat/user and assumes the previous
+    update of that conversation has finished; serialising per chat keeps that
+    guarantee while a slow upload in one chat no longer blocks every other
+    user's buttons.
+
+    Two limits apply:
+      * max_concurrent: handlers actually running at once (all chats).
+      * max_pending: updates PTB may hand us before it waits. Updates queued
+        behind their own chat count here but NOT against max_concurrent, so a
+        user who spams buttons cannot take the running slots from others.
+    """
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT_UPDATES, max_pending=MAX_PENDING_UPDATES):
+        super().__init__(max(max_pending, max_concurrent))
+        self.max_concurrent = max_concurrent
+        self._running = asyncio.BoundedSemaphore(max_concurrent)
+        self._chat_locks = {}  # chat_id -> [asyncio.Lock, waiters]
+        self.active = 0
+        self.peak_active = 0
+
+    async def do_process_update(self, update, coroutine):
+        chat_id = update_chat_id(update)
+        if chat_id is None:
+            await self._run(coroutine)
+            return
+
+        entry = self._chat_locks.get(chat_id)
+        if entry is None:
+            entry = self._chat_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                # Last update of this chat: drop the lock so the dict does not grow forever
+                del self._chat_locks[chat_id]
+
+    async def _run(self, coroutine):
+        async with self._running:
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            try:
+                await coroutine
+            finally:
+                self.active -= 1
+
+    def waiting_chats(self):
+        """Number of chats with at least one update running or queued."""
+        return len(self._chat_locks)
+
+    async def initialize(self):
+        logger.info(
+            f"[UPDATES] Concurrent update processing: {self.max_concurrent} running, "
+            f"{self.max_concurrent_updates} pending max, ordered per chat"
+        )
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,210 @@
+"""
+Front router for several webhook replicas.
+
+Telegram posts every update to this router. It checks the secret token and
+forwards the update to one replica chosen by chat id (rendezvous hashing), so
+a chat always lands on the same replica and its updates stay in order. If
+that replica is down the update goes to the next one in the chat's ranking;
+the receiving replica is told (X-Bot-Handover) to reload the chat's
+conversation state from the shared store first.
+
+    WEBHOOK_REPLICAS=http://10.0.0.11:8081/telegram,http://10.0.0.12:8081/telegram \
+    WEBHOOK_SECRET=... python webhook_router.py --port 8443
+
+    # once, to point Telegram at the router:
+    python webhook_router.py --set-webhook https://bot.example.com/telegram
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from webhook_server import update_chat_id, check_secret, SECRET_HEADER, HANDOVER_HEADER, MAX_BODY_BYTES  # noqa: E402
+
+logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+logger = logging.getLogger("webhook_router")
+
+# --- CONFIGURATION ---
+WEBHOOK_REPLICAS = [u.strip() for u in os.getenv("WEBHOOK_REPLICAS", "").split(",") if u.strip()]
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+FORWARD_TIMEOUT_SECONDS = 5
+REPLICA_DOWN_SECONDS = 10    # A replica that failed is skipped this long
+MAX_TRACKED_CHATS = 100_000  # chat -> last replica, for handover detection
+
+
+def rank_replicas(chat_id, replicas):
+    """Replicas ordered by preference for this chat (rendezvous hashing).
+    Adding or removing a replica only moves the chats that hashed to it."""
+    def weight(replica):
+        return hashlib.sha256(f"{replica}|{chat_id}".encode()).digest()
+    return sorted(replicas, key=weight, reverse=True)
+
+
+class Router:
+    def __init__(self, replicas, secret=WEBHOOK_SECRET):
+        if not secret:
+            raise ValueError("WEBHOOK_SECRET is required to accept webhook updates")
+        self.replicas = list(replicas)
+        self.secret = secret
+        self._lock = threading.Lock()
+        self._down_until = {}
+        self._owner = OrderedDict()  # chat_id -> replica that handled its last update
+        self.forwarded = {replica: 0 for replica in self.replicas}
+        self.handovers = 0
+
+    def _is_down(self, replica):
+        with self._lock:
+            return time.time() < self._down_until.get(replica, 0)
+
+    def _mark_down(self, replica, reason):
+        logger.warning(f"[ROUTER] {replica} unavailable ({reason}), skipping for {REPLICA_DOWN_SECONDS}s")
+        with self._lock:
+            self._down_until[replica] = time.time() + REPLICA_DOWN_SECONDS
+
+    def _needs_handover(self, chat_id, replica):
+        with self._lock:
+            return self._owner.get(chat_id) != replica
+
+    def _set_owner(self, chat_id, replica):
+        with self._lock:
+            self._owner[chat_id] = replica
+            self._owner.move_to_end(chat_id)
+            while len(self._owner) > MAX_TRACKED_CHATS:
+                self._owner.popitem(last=False)
+            self.forwarded[replica] += 1
+
+    def forward(self, body, route_key, chat_id):
+        """Send the update to the chat's replica (falling back down the ranking). Returns an HTTP status."""
+        ranked = rank_replicas(route_key, self.replicas)
+        # Replicas marked down are tried last, not never (all of them may have recovered)
+        ranked = [r for r in ranked if not self._is_down(r)] + [r for r in ranked if self._is_down(r)]
+        for replica in ranked:
+            headers = {"Content-Type": "application/json", SECRET_HEADER: self.secret}
+            # First update this router sees for a chat counts as a handover too: after a
+            # router restart we do not know where the chat was handled before.
+            handover = chat_id is not None and self._needs_handover(chat_id, replica)
+            if handover:
+                headers[HANDOVER_HEADER] = "1"
+            request = urllib.request.Request(replica, data=body, headers=headers, method="POST")
+            try:
+                with urllib.request.urlopen(request, timeout=FORWARD_TIMEOUT_SECONDS) as resp:
+                    status = resp.status
+            except urllib.error.HTTPError as e:
+                status = e.code
+            except (urllib.error.URLError, OSError) as e:
+                self._mark_down(replica, e)
+                continue
+            if status >= 500:
+                self._mark_down(replica, f"HTTP {status}")
+                continue
+            if chat_id is not None:
+                if handover:
+                    self.handovers += 1
+                self._set_owner(chat_id, replica)
+            return status
+        logger.error("[ROUTER] No replica accepted the update")
+        return 503  # Telegram retries later
+
+
+class RouterServer(ThreadingHTTPServer):
+    request_queue_size = 128  # Default of 5 resets connections under bursts
+    daemon_threads = True
+
+
+def make_handler(router, path):
+    class RouterHandler(BaseHTTPRequestHandler):
+        def _reply(self, status):
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def do_GET(self):
+            self._reply(200 if self.path == "/healthz" else 404)
+
+        def do_POST(self):
+            if self.path.split("?")[0] != path:
+                return self._reply(404)
+            headers = {k.lower(): v for k, v in self.headers.items()}
+            if not check_secret(headers, router.secret):
+                logger.warning("[ROUTER] Rejected update with wrong secret token")
+                return self._reply(403)
+            length = int(self.headers.get("Content-Length", 0))
+            if length > MAX_BODY_BYTES:
+                return self._reply(413)
+            body = self.rfile.read(length)
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return self._reply(400)
+            chat_id = update_chat_id(data)
+            route_key = chat_id if chat_id is not None else data.get("update_id")
+            self._reply(router.forward(body, route_key, chat_id))
+
+        def log_message(self, format, *args):
+            pass  # Per-request access log is too noisy
+
+    return RouterHandler
+
+
+def serve(host, port, replicas, secret=WEBHOOK_SECRET, path=WEBHOOK_PATH):
+    """Start the router in a background thread. Returns (server, router)."""
+    router = Router(replicas, secret)
+    server = RouterServer((host, port), make_handler(router, path))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, router
+
+
+def set_webhook(url, secret=WEBHOOK_SECRET):
+    token = os.getenv("TELEGRAM_BOT_TOKEN")
+    if not token:
+        print("❌ TELEGRAM_BOT_TOKEN not found.")
+        sys.exit(1)
+    if not secret:
+        print("❌ WEBHOOK_SECRET is not set (the router rejects updates without it).")
+        sys.exit(1)
+    payload = {"url": url, "drop_pending_updates": False, "secret_token": secret}
+    request = urllib.request.Request(
+        f"https://api.telegram.org/bot{token}/setWebhook",
+        data=json.dumps(payload).encode(),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request, timeout=15) as resp:
+        print(resp.read().decode())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Route Telegram webhook updates to bot replicas by chat id.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8443)
+    parser.add_argument("--set-webhook", metavar="URL", help="Register URL (this router) with Telegram and exit")
+    args = parser.parse_args()
+
+    if args.set_webhook:
+        set_webhook(args.set_webhook)
+        sys.exit(0)
+    if not WEBHOOK_REPLICAS:
+        print("❌ WEBHOOK_REPLICAS is empty (comma-separated replica URLs).")
+        sys.exit(1)
+    if not WEBHOOK_SECRET:
+        # Replicas refuse unauthenticated updates too; never run the router open
+        print("❌ WEBHOOK_SECRET is not set (the secret token Telegram sends with every update).")
+        sys.exit(1)
+
+    server, _router = serve(args.host, args.port, WEBHOOK_REPLICAS)
+    logger.info(f"[ROUTER] Listening on {args.host}:{args.port}{WEBHOOK_PATH} -> {len(WEBHOOK_REPLICAS)} replicas")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
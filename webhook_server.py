@@ -0,0 +1,120 @@
+"""
+Webhook endpoint for one bot replica.
+
+A tiny asyncio HTTP server (no extra dependencies) that accepts Telegram
+updates, checks the X-Telegram-Bot-Api-Secret-Token header and puts the
+update on application.update_queue. It answers 200 right away; the update is
+processed by the application like a polled one.
+
+Telegram can post here directly (single replica, WEBHOOK_URL set) or through
+webhook_router.py, which spreads chats over several replicas.
+"""
+import os
+import hmac
+import json
+import asyncio
+import logging
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8081"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # Only set when Telegram should post to this replica directly
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+HANDOVER_HEADER = "x-bot-handover"  # Set by webhook_router.py when a chat moved to this replica
+MAX_BODY_BYTES = 1024 * 1024
+
+
+def update_chat_id(data):
+    """Chat id of a raw update dict (None for inline queries, polls, ...)."""
+    for field in ("message", "edited_message", "channel_post", "edited_channel_post", "my_chat_member",
+                  "chat_member", "chat_join_request", "business_message"):
+        chat = (data.get(field) or {}).get("chat")
+        if chat:
+            return chat.get("id")
+    query = data.get("callback_query")
+    if query:
+        chat = (query.get("message") or {}).get("chat")
+        if chat:
+            return chat.get("id")
+        return (query.get("from") or {}).get("id")
+    return None
+
+
+def check_secret(headers, secret):
+    """Constant-time comparison of the secret token header. Without a secret nothing is accepted."""
+    if not secret:
+        return False
+    return hmac.compare_digest(headers.get(SECRET_HEADER, ""), secret)
+
+
+class WebhookServer:
+    def __init__(self, application, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET, on_handover=None):
+        if not secret:
+            raise ValueError("WEBHOOK_SECRET is required to accept webhook updates")
+        self.application = application
+        self.path = path
+        self.secret = secret
+        self.on_handover = on_handover  # callback(chat_id)
+        self.received = 0
+        self._server = None
+
+    async def start(self, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT):
+        self._server = await asyncio.start_server(self._handle, host, port)
+        logger.info(f"[WEBHOOK] Listening on {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            status = await self._handle_request(reader)
+        except Exception as e:
+            logger.error(f"[WEBHOOK] Bad request: {e}")
+            status = 400
+        reason = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found", 413: "Payload Too Large"}
+        writer.write(
+            f"HTTP/1.1 {status} {reason.get(status, '')}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode()
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _handle_request(self, reader):
+        request_line = await reader.readline()
+        method, target, _ = request_line.decode("latin-1").split(" ", 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if method == "GET" and target == "/healthz":
+            return 200
+        if method != "POST" or target.split("?")[0] != self.path:
+            return 404
+        if not check_secret(headers, self.secret):
+            logger.warning("[WEBHOOK] Rejected update with wrong secret token")
+            return 403
+        length = int(headers.get("content-length", 0))
+        if length > MAX_BODY_BYTES:
+            return 413
+
+        data = json.loads(await reader.readexactly(length))
+        if headers.get(HANDOVER_HEADER) and self.on_handover:
+            chat_id = update_chat_id(data)
+            if chat_id is not None:
+                self.on_handover(chat_id)
+        await self.application.update_queue.put(Update.de_json(data, self.application.bot))
+        self.received += 1
+        return 200
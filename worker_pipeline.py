@@ -0,0 +1,123 @@
+"""
+Stages for the queue worker (see queue_worker.py).
+
+A Stage is a bounded asyncio.Queue drained by a fixed number of worker tasks.
+Stages are chained by the handlers themselves (`await next_stage.put(item)`),
+so a full queue pushes back on the stage before it and nothing else: a slow R2
+upload fills the deliver queue and slows polling hand-offs, while claiming and
+submitting keep going.
+
+Blocking calls made by a handler go through `stage.run(fn, ...)`, which uses
+the stage's own thread pool (one thread per worker). Stages therefore do not
+compete for asyncio's default executor, which is small on small machines
+(cpu count + 4) and also serves the bot's handlers.
+
+Every stage keeps its own numbers (queue depth, in flight, processed, failed,
+service time) for the worker heartbeat.
+"""
+import time
+import asyncio
+import logging
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# --- CONFIGURATION ---
+SERVICE_TIME_WINDOW = 200  # Recent service times kept per stage (avg / p95)
+
+
+class Stage:
+    def __init__(self, name, handler, concurrency, maxsize):
+        self.name = name
+        self.handler = handler  # async def handler(item)
+        self.concurrency = concurrency
+        self.queue = asyncio.Queue(maxsize)
+        self.in_flight = 0
+        self.processed = 0
+        self.failed = 0
+        self.scheduled = 0  # Items parked by put_later, not yet back in the queue
+        self._service_times = deque(maxlen=SERVICE_TIME_WINDOW)
+        self._tasks = []
+        self._requeues = set()
+        self._executor = ThreadPoolExecutor(concurrency, thread_name_prefix=f"stage-{name}")
+
+    def start(self):
+        self._tasks = [
+            asyncio.create_task(self._work(), name=f"stage-{self.name}-{i}")
+            for i in range(self.concurrency)
+        ]
+        return self
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def run(self, fn, *args, **kwargs):
+        """Run a blocking call on this stage's threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    async def put(self, item):
+        """Enqueue, waiting while the stage is full (backpressure)."""
+        await self.queue.put(item)
+
+    def put_later(self, item, delay):
+        """Re-enqueue after delay without blocking the caller (used for repeated polls)."""
+        self.scheduled += 1
+        asyncio.get_running_loop().call_later(delay, self._requeue, item)
+
+    def _requeue(self, item):
+        self.scheduled -= 1
+        task = asyncio.create_task(self.put(item))
+        self._requeues.add(task)
+        task.add_done_callback(self._requeues.discard)
+
+    def full(self):
+        return self.queue.full()
+
+    async def _work(self):
+        while True:
+            item = await self.queue.get()
+            self.in_flight += 1
+            started = time.perf_counter()
+            try:
+                await self.handler(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"[PIPELINE] Stage {self.name} failed on an item: {e}", exc_info=True)
+            finally:
+                self._service_times.append(time.perf_counter() - started)
+                self.in_flight -= 1
+                self.processed += 1
+                self.queue.task_done()
+
+    def snapshot(self):
+        times = sorted(self._service_times)
+        avg_ms = sum(times) / len(times) * 1000 if times else 0
+        p95_ms = times[min(len(times) - 1, int(len(times) * 0.95))] * 1000 if times else 0
+        return {
+            "depth": self.queue.qsize(),
+            "capacity": self.queue.maxsize,
+            "in_flight": self.in_flight,
+            "scheduled": self.scheduled,
+            "workers": self.concurrency,
+            "processed": self.processed,
+            "failed": self.failed,
+            "avg_ms": int(avg_ms),
+            "p95_ms": int(p95_ms),
+        }
+
+    def describe(self):
+        s = self.snapshot()
+        parked = f"parked {s['scheduled']}, " if s["scheduled"] else ""
+        return (
+            f"{self.name}: depth {s['depth']}/{s['capacity']}, busy {s['in_flight']}/{s['workers']}, {parked}"
+            f"done {s['processed']} (failed {s['failed']}), avg {s['avg_ms']} ms, p95 {s['p95_ms']} ms"
+        )